@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+import argparse
+from dataclasses import asdict
+from pathlib import Path
+from context.context import ContextConfig
+from benchmark.scenario import run_scenario, MIN_PEERS
+from benchmark.report import summarize, write_results, compare
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a cluster of peers on 127.0.0.1 and measures joins, commits, rejoins, evictions and elections.")
+    parser.add_argument("--peers", type=int, default=MIN_PEERS, help=f"number of peers, the first one is the leader, at least {MIN_PEERS}")
+    parser.add_argument("--proposals", type=int, default=50, help="proposals submitted to the leader in every round")
+    parser.add_argument("--window", type=int, default=4, help="proposals pending at the same time")
+    parser.add_argument("--rounds", type=int, default=1, help="times the whole scenario is repeated")
+    parser.add_argument("--heartbeat-interval", type=float, default=ContextConfig.heartbeat_interval)
+    parser.add_argument("--max-silence", type=float, default=ContextConfig.heartbeat_max_silence)
+    parser.add_argument("--trace-dir", help="directory where every peer writes its trace file")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    # The certificates paths used by the context are relative to the root of the project.
+    os.chdir(Path(__file__).resolve().parent.parent)
+    config = ContextConfig(heartbeat_interval=args.heartbeat_interval, heartbeat_max_silence=args.max_silence)
+    run = run_scenario(args.peers, args.proposals, args.window, args.rounds, config, args.trace_dir)
+    results = {
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "tolerance", "trace_dir")},
+        "config": asdict(config),
+        "metrics": summarize(run["samples"]),
+        "throughput": run["throughput"],
+    }
+    write_results(args.output, results)
+    for name, stats in results["metrics"].items():
+        print(f"{name}: p50 {stats["p50"] * 1000:.1f} ms, p99 {stats["p99"] * 1000:.1f} ms ({stats["count"]} samples)")
+    print(f"throughput: {results["throughput"]:.1f} proposals/s")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines = compare(results, json.load(f), args.tolerance)
+        print("\n".join(lines))
+        if any(line.startswith("REGRESSION") for line in lines):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import os
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Connection
+from pathlib import Path
+from threading import Barrier, Lock, Thread
+from time import perf_counter, sleep, time
+from typing import Any
+from Pyro5.api import Proxy
+from Pyro5.errors import PyroError
+from context.context import ContextApp, ContextConfig
+from database.db_local import DBLocal
+from remote.db_expose import DBExpose
+from remote.db_remote import DBRemote
+from remote.remote_data_structures import Notification, Operation, ProposalStatus
+
+CA_CERT = "certs/CA/ca.crt"
+CA_KEY = "certs/CA/ca.key"
+PEERS_CERTS = "certs/peers"
+POLL_INTERVAL = 0.005 # seconds between two checks of a condition awaited by a peer
+
+def peer_identities(count: int, workdir: str) -> list[tuple[str, str]]:
+    """Returns the certificate and key of count peers: the ones in certs/peers
+    first, then new ones signed on the fly by the CA of the project. An expired
+    certificate is replaced by a new one with the same Common Name."""
+    identities = []
+    for peer_dir in sorted(Path(PEERS_CERTS).iterdir())[:count]:
+        cert_path = str(peer_dir / f"{peer_dir.name}.crt")
+        if is_expired(cert_path):
+            identities.append(generate_identity(peer_dir.name, workdir))
+        else:
+            identities.append((cert_path, str(peer_dir / f"{peer_dir.name}.key")))
+    while len(identities) < count:
+        identities.append(generate_identity(f"bench_peer_{len(identities) + 1}", workdir))
+    return identities
+
+def is_expired(cert_path: str) -> bool:
+    result = subprocess.run(["openssl", "x509", "-checkend", "0", "-noout", "-in", cert_path], capture_output=True)
+    return result.returncode != 0
+
+def generate_identity(common_name: str, workdir: str) -> tuple[str, str]:
+    """Creates a key and a certificate for localhost signed by the project CA."""
+    key_path = os.path.join(workdir, f"{common_name}.key")
+    csr_path = os.path.join(workdir, f"{common_name}.csr")
+    cert_path = os.path.join(workdir, f"{common_name}.crt")
+    ext_path = os.path.join(workdir, f"{common_name}.ext")
+    with open(ext_path, "w") as f:
+        f.write("basicConstraints = CA:FALSE\n"
+                "keyUsage = digitalSignature, keyEncipherment\n"
+                "extendedKeyUsage = serverAuth, clientAuth\n"
+                "subjectAltName = DNS:localhost, IP:127.0.0.1\n")
+    subprocess.run(["openssl", "req", "-new", "-newkey", "rsa:2048", "-nodes", "-subj", f"/CN={common_name}",
+                    "-keyout", key_path, "-out", csr_path], check=True, capture_output=True)
+    subprocess.run(["openssl", "x509", "-req", "-in", csr_path, "-CA", CA_CERT, "-CAkey", CA_KEY,
+                    "-CAserial", os.path.join(workdir, "ca.srl"), "-CAcreateserial",
+                    "-days", "1", "-sha256", "-extfile", ext_path, "-out", cert_path], check=True, capture_output=True)
+    return (cert_path, key_path)
+
+class BenchContext(ContextApp):
+    """Context of a benchmark peer: every notification is approved as soon as it arrives."""
+    def __init__(self, cert_path: str, cert_key_path: str, config: ContextConfig | None = None):
+        super().__init__(cert_path, cert_key_path, config)
+        self._vote_lock = Lock() # a remote database shares a single proxy to its leader
+
+    def add_notification(self, notification: Notification) -> None:
+        Thread(target=self._approve, args=(notification,), daemon=True).start()
+
+    def _approve(self, notification: Notification) -> None:
+        # The database is registered in the context right after joining, a proposal could arrive just before.
+        while (db := self.get_database(notification.db_id)) is None and time() < notification.timestamp:
+            sleep(POLL_INTERVAL)
+        if db is not None:
+            with self._vote_lock:
+                db.answer_notification(True, notification)
+
+    def print_message(self, message: str) -> None:
+        pass
+
+class PeerWorker:
+    """Runs in the process of a peer and executes the commands of the coordinator."""
+    def __init__(self, ctx: BenchContext, workdir: str) -> None:
+        self._ctx = ctx
+        self._workdir = workdir
+        self._db_id = None
+
+    def _db(self) -> Any:
+        return self._ctx.get_database(self._db_id)
+
+    def create(self, name: str, passwd: str) -> str:
+        db = DBLocal.create_db(os.path.join(self._workdir, f"{name}.kdbx"), passwd, name, self._ctx.config.write_behind)
+        self._db_id = self._ctx.add_database(db)
+        db.local_id = self._db_id
+        expose_db = DBExpose.create_and_register(db, self._ctx)
+        self._ctx.register_ignored_service(expose_db.uri)
+        self._ctx.replace_database(self._db_id, expose_db)
+        return expose_db.uri
+
+    def join(self, leader_uri: str, name: str, passwd: str) -> tuple[float, str]:
+        start = time()
+        db_remote = DBRemote.create_and_register(leader_uri, self._ctx, passwd, os.path.join(self._workdir, f"{name}.kdbx"))
+        elapsed = time() - start
+        if db_remote is None:
+            raise RuntimeError("The peer couldn't join the database")
+        self._ctx.register_ignored_service(leader_uri)
+        self._db_id = self._ctx.add_database(db_remote)
+        db_remote.local_id = self._db_id
+        return (elapsed, db_remote.uri)
+
+    def propose(self, count: int, window: int, prefix: str) -> tuple[list[float], float]:
+        """Submits count proposals keeping at most window of them pending, returns
+        their commit latencies and the total duration."""
+        db = self._db()
+        pending = []
+        latencies = []
+        start = time()
+        for i in range(count):
+            if len(pending) >= window:
+                latencies.append(self._wait_commit(db, *pending.pop(0)))
+            data = {"destination_group": [], "title": f"{prefix}-{i}", "username": "bench", "passwd": "bench"}
+            pending.append((db.submit_operation(Operation.ADD_ENTRY, data), time()))
+        for ticket, submitted in pending:
+            latencies.append(self._wait_commit(db, ticket, submitted))
+        return (latencies, time() - start)
+
+    @staticmethod
+    def _wait_commit(db: DBExpose, ticket: int | None, submitted: float) -> float:
+        if ticket is None:
+            raise RuntimeError("The proposal queue of the leader is full")
+        status = db.wait_request(ticket, timeout=60)
+        if status != ProposalStatus.APPROVED:
+            raise RuntimeError(f"Proposal {ticket} ended as {status}")
+        return time() - submitted
+
+    def leave(self) -> None:
+        """Closes the copy of the database like the CLI does, its file and log position are kept."""
+        db_remote = self._ctx.remove_database(self._db_id)
+        db_remote.leave_db().close()
+        self._ctx.daemon.unregister(db_remote)
+        self._ctx.unregister_ignored_service(db_remote.leader_uri)
+
+    def reconnect(self, leader_uri: str, name: str, passwd: str, entries: int) -> tuple[float, str]:
+        """Connects again with the copy left by leave and checks that it holds the entries
+        of the leader. Returns the time taken and the new URI."""
+        elapsed, uri = self.join(leader_uri, name, passwd)
+        if len(self._db().list_entries(limit=entries + 1)) != entries:
+            raise RuntimeError("The copy of the peer missed some changes of the leader")
+        return (elapsed, uri)
+
+    def close_leader(self) -> float:
+        """Closes the exposed database like the CLI does and returns when it started."""
+        start = time()
+        closed_db = self._ctx.remove_database(self._db_id)
+        local_db = closed_db.close_database()
+        closed_db.unregister_object()
+        self._ctx.unregister_ignored_service(closed_db.uri)
+        self._ctx.replace_database(local_db.local_id, local_db)
+        return start
+
+    def wait_new_leader(self, old_leader_uri: str, timeout: float) -> tuple[float, str]:
+        """Returns when this peer has a leader other than the old one, and its URI."""
+        deadline = time() + timeout
+        while time() < deadline:
+            db = self._db()
+            if isinstance(db, DBExpose):
+                return (time(), db.uri)
+            if isinstance(db, DBRemote) and db.leader_uri not in (None, old_leader_uri):
+                return (time(), db.leader_uri)
+            sleep(POLL_INTERVAL)
+        raise TimeoutError("No new leader was elected")
+
+    def cluster_view(self) -> tuple[str | None, list[str] | None]:
+        """Returns the URI of the leader this peer knows, its own one if it is the leader,
+        and the URIs of its followers when it is the leader."""
+        db = self._db()
+        if isinstance(db, DBExpose):
+            with db._followers_lock:
+                return (db.uri, list(db._followers_cn))
+        if isinstance(db, DBRemote):
+            return (db.leader_uri, None)
+        return (None, None)
+
+    def read_load(self, leader_uri: str, passwd: str, entry_path: list[str], threads: int, calls: int) -> tuple[list[float], int, float]:
+        """Reads an entry calls times from each of threads connections to the leader, all
+        started together, as thin clients do. Returns the latencies of the calls, how many
+        failed and the total duration."""
+        latencies = []
+        errors = 0
+        lock = Lock()
+        barrier = Barrier(threads + 1)
+
+        def reader(proxy: Proxy | None, reader_uri: str) -> None:
+            nonlocal errors
+            samples = []
+            failed = calls if proxy is None else 0 # the server refused the connection
+            barrier.wait()
+            if proxy is not None:
+                proxy._pyroClaimOwnership()
+                for _ in range(calls):
+                    start = perf_counter()
+                    try:
+                        proxy.read_entry(entry_path)
+                        samples.append(perf_counter() - start)
+                    except PyroError:
+                        failed += 1
+                try:
+                    proxy.reader_logout(reader_uri)
+                except PyroError:
+                    pass
+                proxy._pyroRelease()
+            with lock:
+                latencies.extend(samples)
+                errors += failed
+
+        # The connections are opened one at a time: Pyro creates its client TLS context
+        # at the first connection and concurrent ones could use it before it holds the certificate.
+        readers = []
+        for index in range(threads):
+            reader_uri = f"PYRO:reader-{index}@{self._ctx.daemon.locationStr}"
+            proxy = Proxy(leader_uri)
+            try:
+                proxy.reader_login(passwd, reader_uri)
+            except PyroError:
+                proxy = None
+            readers.append((proxy, reader_uri))
+        workers = [Thread(target=reader, args=reader_args, daemon=True) for reader_args in readers]
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        start = time()
+        for worker in workers:
+            worker.join()
+        return (latencies, errors, time() - start)
+
+    def wait_eviction(self, follower_uri: str, timeout: float) -> float:
+        """Returns when the leader has removed the follower."""
+        deadline = time() + timeout
+        while time() < deadline:
+            if follower_uri not in self._db().get_replica_positions():
+                return time()
+            sleep(POLL_INTERVAL)
+        raise TimeoutError("The dead follower was not evicted")
+
+def peer_main(conn: Connection, cert: str, key: str, workdir: str, config: ContextConfig) -> None:
+    ctx = BenchContext(cert, key, config)
+    ctx.start_daemon_loop()
+    worker = PeerWorker(ctx, workdir)
+    conn.send(("ready", None))
+    while True:
+        command, args = conn.recv()
+        if command == "stop":
+            break
+        try:
+            conn.send(("ok", getattr(worker, command)(*args)))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+    ctx.close()
+    conn.send(("ok", None))
+
+class Peer:
+    """Handle used by the coordinator to drive a peer process."""
+    def __init__(self, cert: str, key: str, workdir: str, config: ContextConfig) -> None:
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(target=peer_main, args=(child_conn, cert, key, workdir, config), daemon=True)
+        self.process.start()
+        self._receive()
+
+    def call(self, command: str, *args: Any) -> Any:
+        self._conn.send((command, args))
+        return self._receive()
+
+    def call_async(self, command: str, *args: Any) -> None:
+        """Sends a command without waiting for the result, to be read later with result()."""
+        self._conn.send((command, args))
+
+    def result(self) -> Any:
+        return self._receive()
+
+    def kill(self) -> float:
+        """Kills the process without letting it leave the database and returns when."""
+        killed = time()
+        self.process.kill()
+        self.process.join()
+        return killed
+
+    def stop(self) -> None:
+        if self.process.is_alive():
+            self.call("stop")
+            self.process.join()
+
+    def _receive(self) -> Any:
+        status, value = self._conn.recv()
+        if status == "error":
+            raise RuntimeError(value)
+        return value
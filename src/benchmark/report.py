@@ -0,0 +1,49 @@
+import json
+
+def percentile(samples: list[float], q: float) -> float:
+    """Returns the q-th percentile (0-100) with linear interpolation between the closest ranks."""
+    ordered = sorted(samples)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+def summarize(samples: dict[str, list[float]]) -> dict[str, dict[str, float]]:
+    """Turns the latency samples of every metric, in seconds, into their statistics."""
+    return {
+        name: {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p99": percentile(values, 99),
+            "max": max(values),
+        }
+        for name, values in samples.items() if values
+    }
+
+def write_results(path: str, results: dict) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Compares the p50 and p99 latencies and the throughput with a baseline and
+    returns a line for each value, marking the ones worse than the tolerance."""
+    lines = []
+    for name, stats in results["metrics"].items():
+        base_stats = baseline.get("metrics", {}).get(name)
+        if base_stats is None:
+            lines.append(f"{name}: not in the baseline")
+            continue
+        for key in ("p50", "p99"):
+            ratio = stats[key] / base_stats[key] if base_stats[key] else float("inf")
+            marker = "REGRESSION " if ratio > 1 + tolerance else ""
+            lines.append(f"{marker}{name} {key}: {stats[key] * 1000:.1f} ms vs {base_stats[key] * 1000:.1f} ms ({ratio:.2f}x)")
+    throughput = results.get("throughput")
+    base_throughput = baseline.get("throughput")
+    if throughput and base_throughput:
+        ratio = throughput / base_throughput
+        marker = "REGRESSION " if ratio < 1 - tolerance else ""
+        lines.append(f"{marker}throughput: {throughput:.1f} vs {base_throughput:.1f} proposals/s ({ratio:.2f}x)")
+    return lines
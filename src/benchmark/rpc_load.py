@@ -0,0 +1,50 @@
+from dataclasses import replace
+from tempfile import TemporaryDirectory
+from context.context import ContextConfig, ServerPolicy
+from .cluster import Peer, peer_identities
+from .report import summarize
+from .scenario import DB_NAME, DB_PASSWORD
+
+def run_rpc_load(policies: list[ServerPolicy], clients: int, threads: int, calls: int, entries: int, config: ContextConfig) -> list[dict]:
+    """Measures the reads served by a leader under each server policy: clients peers
+    open threads connections each and read an entry calls times from every one of
+    them, all at the same time. For every policy returns the latencies of the reads,
+    the failed ones and the reads per second."""
+    results = []
+    with TemporaryDirectory(prefix="kdbx-rpc-bench-") as workdir:
+        identities = peer_identities(clients + 1, workdir)
+        for policy in policies:
+            peers = []
+            try:
+                leader_cert, leader_key = identities[0]
+                leader = Peer(leader_cert, leader_key, workdir, replace(config, server=policy))
+                peers.append(leader)
+                name = f"{DB_NAME}-{policy.server_type.value}-{policy.max_workers}"
+                leader_uri = leader.call("create", name, DB_PASSWORD)
+                leader.call("propose", entries, 1, name)
+                for cert, key in identities[1:]:
+                    peers.append(Peer(cert, key, workdir, config))
+                for client in peers[1:]:
+                    client.call_async("read_load", leader_uri, DB_PASSWORD, [f"{name}-0"], threads, calls)
+                latencies = []
+                errors = 0
+                duration = 0.0
+                for client in peers[1:]:
+                    client_latencies, client_errors, client_duration = client.result()
+                    latencies.extend(client_latencies)
+                    errors += client_errors
+                    duration = max(duration, client_duration)
+                results.append({
+                    "policy": {"server_type": policy.server_type.value, "max_workers": policy.max_workers,
+                               "min_workers": policy.min_workers, "backlog": policy.backlog},
+                    "latency": summarize({"read": latencies}).get("read"),
+                    "errors": errors,
+                    "throughput": len(latencies) / duration if duration else None,
+                })
+            finally:
+                for peer in peers:
+                    try:
+                        peer.stop()
+                    except (RuntimeError, OSError, EOFError):
+                        peer.process.kill()
+    return results
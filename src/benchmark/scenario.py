@@ -0,0 +1,99 @@
+import os
+from collections import defaultdict
+from dataclasses import replace
+from tempfile import TemporaryDirectory
+from time import sleep, time
+from context.context import ContextConfig
+from .cluster import Peer, peer_identities
+
+DB_NAME = "bench"
+DB_PASSWORD = "bench"
+TIMEOUT = 120.0 # seconds after which an awaited election or eviction is considered failed
+MIN_PEERS = 5 # the election is checked on at least 3 survivors, after the leader closes and a follower is killed
+POLL_INTERVAL = 0.1 # seconds between two checks of the views of the survivors
+
+def run_scenario(peers_count: int, proposals: int, window: int, rounds: int, config: ContextConfig, trace_dir: str | None = None) -> dict:
+    """Starts a cluster of peers on the loopback interface and measures, for every round:
+    - join: time taken by a follower to log in and receive the database
+    - commit: time from the submission of a proposal to its application, every peer approving it
+    - rejoin: time taken by a follower to connect again with the copy it left and catch up
+      from the operation log with the changes made while it was away
+    - eviction: time taken by the leader to remove a killed follower
+    - election: time from the leader closing the database to the last follower knowing the new one;
+      the survivors must then agree on a single leader having all the others as followers
+    The throughput is the number of committed proposals per second. With a trace
+    directory, every peer writes its spans to its own file there."""
+    if peers_count < MIN_PEERS:
+        raise ValueError(f"At least {MIN_PEERS} peers are needed to check an election among 3 survivors")
+    samples = defaultdict(list)
+    missed = max(1, proposals // 4) # changes committed while the followers are away
+    committed = 0
+    committing_time = 0.0
+    with TemporaryDirectory(prefix="kdbx-bench-") as workdir:
+        identities = peer_identities(peers_count, workdir)
+        for round_number in range(rounds):
+            peers = []
+            try:
+                for index, (cert, key) in enumerate(identities):
+                    peer_config = config
+                    if trace_dir is not None:
+                        peer_config = replace(config, trace_file=os.path.join(trace_dir, f"peer_{index + 1}.jsonl"))
+                    peers.append(Peer(cert, key, workdir, peer_config))
+                leader, followers = peers[0], peers[1:]
+                name = f"{DB_NAME}-{round_number}"
+                leader_uri = leader.call("create", f"{name}-leader", DB_PASSWORD)
+                follower_uris = []
+                for index, follower in enumerate(followers):
+                    elapsed, uri = follower.call("join", leader_uri, f"{name}-follower-{index}", DB_PASSWORD)
+                    samples["join"].append(elapsed)
+                    follower_uris.append(uri)
+
+                latencies, duration = leader.call("propose", proposals, window, name)
+                samples["commit"].extend(latencies)
+                committed += len(latencies)
+                committing_time += duration
+
+                for follower in followers:
+                    follower.call("leave")
+                missed_latencies, _ = leader.call("propose", missed, window, f"{name}-missed")
+                for index, follower in enumerate(followers):
+                    elapsed, follower_uris[index] = follower.call("reconnect", leader_uri, f"{name}-follower-{index}", DB_PASSWORD, proposals + len(missed_latencies))
+                    samples["rejoin"].append(elapsed)
+
+                killed_at = followers[-1].kill()
+                samples["eviction"].append(leader.call("wait_eviction", follower_uris[-1], TIMEOUT) - killed_at)
+                survivors = followers[:-1]
+                survivor_uris = follower_uris[:-1]
+
+                closed_at = leader.call("close_leader")
+                for follower in survivors:
+                    follower.call_async("wait_new_leader", leader_uri, TIMEOUT)
+                elected_at = max(follower.result()[0] for follower in survivors)
+                samples["election"].append(elected_at - closed_at)
+                check_single_leader(survivors, survivor_uris, TIMEOUT)
+                # A survivor that didn't receive the announcement would elect itself after the election timeout.
+                sleep(config.election_timeout)
+                check_single_leader(survivors, survivor_uris, 0.0)
+            finally:
+                for peer in peers:
+                    try:
+                        peer.stop()
+                    except (RuntimeError, OSError, EOFError):
+                        peer.process.kill()
+    return {"samples": dict(samples), "throughput": committed / committing_time if committing_time else None}
+
+def check_single_leader(survivors: list[Peer], survivor_uris: list[str], timeout: float) -> None:
+    """Waits until the survivors know the same leader, one of them, which has all the
+    others as followers. Raises RuntimeError with their views if it doesn't happen in time."""
+    deadline = time() + timeout
+    while True:
+        views = [survivor.call("cluster_view") for survivor in survivors]
+        leaders = {leader_uri for leader_uri, _ in views}
+        elected = [(uri, followers) for uri, (_, followers) in zip(survivor_uris, views) if followers is not None]
+        if len(leaders) == 1 and len(elected) == 1:
+            leader_member_uri, followers = elected[0]
+            if set(followers) == set(survivor_uris) - {leader_member_uri}:
+                return
+        if time() >= deadline:
+            raise RuntimeError(f"The survivors don't agree on a single leader: {views}")
+        sleep(POLL_INTERVAL)
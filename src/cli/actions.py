@@ -1,3 +1,4 @@
+import csv
 from pykeepass.exceptions import CredentialsError
 import questionary
 from questionary import prompt, ValidationError, Validator, Choice
@@ -5,9 +6,22 @@ from prettytable import PrettyTable, TableStyle
 from pathlib import Path
 from itertools import zip_longest
 from database.db_local import DBLocal
+from database.bulk_io import read_csv, read_kdbx
 from remote.db_expose import DBExpose
 from remote.db_remote import DBRemote
+from remote.db_thin import DBThin
+from remote.snapshot_transfer import log_position_path
 from context.context import ContextApp
+from context.metrics import Histogram
+
+IMPORT_ERRORS_SHOWN = 10 # rejected rows of an import listed one by one
+PAGE_SIZE = 25 # entries or groups shown at a time
+ENTRY_COLUMNS = ["Title", "Username", "URL", "Path", "Password"]
+DEFAULT_ENTRY_COLUMNS = ["Title", "Username", "Path"]
+PASSWORD_MASK = "********" # passwords are shown only when revealed one at a time
+SEARCH_RESULTS = 20 # best matches shown by a search across the databases
+FULL_COPY = "Full copy (download the database and vote the changes)"
+THIN_CLIENT = "Thin client (read through the leader, nothing is downloaded)"
 
 class NameValidator(Validator):
     def validate(self, document):
@@ -34,6 +48,17 @@ class NameValidator(Validator):
                 cursor_position=len(document.text),
             )  # Move cursor to end
 
+class ReplicaNameValidator(NameValidator):
+    def validate(self, document):
+        # The copy left by a previous connection is accepted too: only the changes it missed are downloaded.
+        input_text = document.text.strip()
+        try:
+            if input_text.endswith(".kdbx") and Path(log_position_path(str(Path(input_text).expanduser().resolve()))).exists():
+                return
+        except Exception:
+            pass
+        super().validate(document)
+
 class ListValidator(Validator):
     def __init__(self, ctx):
         self.ctx = ctx
@@ -75,7 +100,7 @@ def database_selection(ctx: ContextApp) -> int:
     """Prompts the user to select a database and returns the associated index"""
     choices = {}
     for db_id, db in ctx.get_indexes_databases():
-        db_type_str = "Local" if isinstance(db, DBLocal) else "Exposed" if isinstance(db, DBExpose) else "Remote"
+        db_type_str = "Local" if isinstance(db, DBLocal) else "Exposed" if isinstance(db, DBExpose) else "Thin" if isinstance(db, DBThin) else "Remote"
         display_name = f"[{db_type_str}] {db.get_name()} ({db_id})"
         choices[display_name] = db_id
 
@@ -125,7 +150,7 @@ def create_database(ctx: ContextApp) -> None:
     if results:
         path = Path(results["db_path"].strip()).expanduser().resolve()
         path.parent.mkdir(parents=True, exist_ok=True)
-        db = DBLocal.create_db(path, results["db_passwd"], results["db_name"])
+        db = DBLocal.create_db(path, results["db_passwd"], results["db_name"], ctx.config.write_behind)
         local_id = ctx.add_database(db)
         db.local_id = local_id
 
@@ -146,7 +171,7 @@ def open_database(ctx: ContextApp) -> None:
     results = prompt(questions)
     if results:
         try:
-            local_db = DBLocal(Path(results["db_path"]).expanduser().resolve(), results["db_passwd"])
+            local_db = DBLocal(Path(results["db_path"]).expanduser().resolve(), results["db_passwd"], ctx.config.write_behind)
             local_id = ctx.add_database(local_db)
             local_db.local_id = local_id
         except CredentialsError:
@@ -156,12 +181,15 @@ def list_databases(ctx: ContextApp) -> None:
     local_lines = []
     remote_lines = []
     for idx, db in ctx.get_indexes_databases():
-        line = [idx, db.get_name(), Path(db.get_filename()).expanduser().resolve()]
+        line = [idx, db.get_name(), db.get_filename() if isinstance(db, DBThin) else Path(db.get_filename()).expanduser().resolve()]
         if isinstance(db, DBLocal): 
             local_lines.append(line)
         elif isinstance(db, DBRemote):
             line[1] = "[r] " + line[1] # Stilystic choice to differentiate remote dbs from exposed ones
             remote_lines.append(line)
+        elif isinstance(db, DBThin):
+            line[1] = "[t] " + line[1]
+            remote_lines.append(line)
         else:
             line[1] = "[e] " + line[1] # Stilystic choice to differentiate remote dbs from exposed ones
             remote_lines.append(line)
@@ -189,34 +217,123 @@ def list_entries(ctx: ContextApp) -> None:
     db = ctx.get_database(idx)
     if not db:
         return
+    filters = _listing_filters("Insert the beginning of the titles to show, or leave an empty input:")
+    if filters is None:
+        return
+    group_path, prefix = filters
+    columns = questionary.checkbox("Select the columns to show:", choices=[
+        Choice(column, checked=column in DEFAULT_ENTRY_COLUMNS) for column in ENTRY_COLUMNS
+        ]).ask()
+    if not columns:
+        return
 
-    table = PrettyTable()
-    table.set_style(TableStyle.SINGLE_BORDER)
-    table.field_names = ["Title", "Username", "Password", "Path"]
-    table.title = "Database entries"
-
-    table.add_rows([
-        [entry.title, entry.username, entry.password, "/".join(entry.path)] 
-        for entry in db.get_entries()
-        ])
+    offset = 0
+    while True:
+        # One entry more than the page tells if there is a next page.
+        entries = db.list_entries(group_path, prefix, offset, PAGE_SIZE + 1)
+        page = entries[:PAGE_SIZE]
+        if not page:
+            questionary.print("There are no entries to show", style="bold fg:yellow")
+            return
 
-    questionary.print(str(table))
+        table = PrettyTable()
+        table.set_style(TableStyle.SINGLE_BORDER)
+        table.field_names = ["N.", *columns]
+        table.title = f"Database entries {offset + 1}-{offset + len(page)}"
+        for number, entry in enumerate(page, start=offset + 1):
+            values = {"Title": entry["title"], "Username": entry["username"], "URL": entry["url"],
+                      "Path": "/".join(entry["path"]), "Password": PASSWORD_MASK}
+            table.add_row([number, *(values[column] for column in columns)])
+        questionary.print(str(table))
+
+        choices = ["Reveal a password"]
+        if len(entries) > PAGE_SIZE:
+            choices.insert(0, "Next page")
+        choices.append("Stop")
+        match questionary.select("What do you want to do?", choices=choices).ask():
+            case "Next page":
+                offset += PAGE_SIZE
+            case "Reveal a password":
+                entry_choices = {f"{number}. {'/'.join(entry["path"])}": entry["path"] for number, entry in enumerate(page, start=offset + 1)}
+                selected = questionary.select("Select the entry:", choices=entry_choices.keys()).ask()
+                if selected is None:
+                    return
+                password = db.get_entry_password(entry_choices[selected])
+                if password is None:
+                    questionary.print("The entry doesn't exist anymore", style="bold fg:red")
+                else:
+                    questionary.print(f"Password: {password}")
+            case _:
+                return
 
 def list_groups(ctx: ContextApp) -> None:
     idx = database_selection(ctx)
     db = ctx.get_database(idx)
     if not db:
         return
+    filters = _listing_filters("Insert the beginning of the names to show, or leave an empty input:")
+    if filters is None:
+        return
+    group_path, prefix = filters
 
-    table = PrettyTable()
-    table.set_style(TableStyle.SINGLE_BORDER)
-    table.field_names = ["Name", "Path"]
-    table.title = "Database groups"
+    offset = 0
+    while True:
+        groups = db.list_groups(group_path, prefix, offset, PAGE_SIZE + 1)
+        page = groups[:PAGE_SIZE]
+        if not page:
+            questionary.print("There are no groups to show", style="bold fg:yellow")
+            return
 
-    table.add_rows([[group.name, "/".join(group.path)] for group in db.get_groups()])
+        table = PrettyTable()
+        table.set_style(TableStyle.SINGLE_BORDER)
+        table.field_names = ["Name", "Path"]
+        table.title = f"Database groups {offset + 1}-{offset + len(page)}"
+        table.add_rows([[path[-1], "/".join(path)] for path in page])
+        questionary.print(str(table))
 
-    questionary.print(str(table))
+        if len(groups) <= PAGE_SIZE or not questionary.confirm("Show the next page?").ask():
+            return
+        offset += PAGE_SIZE
+
+def _listing_filters(prefix_message: str) -> tuple[list[str] | None, str] | None:
+    """Asks the group to list and the prefix of the names, None if the user cancelled."""
+    questions = [
+            {
+                "type": "text",
+                "name": "group_path",
+                "message": "Insert the group path to list (separated by \"/\")\n  For the whole database leave an empty input:",
+                },
+            {
+                "type": "text",
+                "name": "prefix",
+                "message": prefix_message,
+                },
+            ]
+    results = prompt(questions)
+    if not results:
+        return None
+    group_path = results["group_path"].strip("/")
+    return (group_path.split("/") if group_path else None, results["prefix"])
     
+def search_entries(ctx: ContextApp) -> None:
+    query = questionary.text("Insert the words to search in the titles, usernames, URLs and groups:").ask()
+    if not query or not query.strip():
+        return
+
+    results = ctx.search_entries(query, SEARCH_RESULTS)
+    if not results:
+        questionary.print("No entry matches the search", style="bold fg:yellow")
+        return
+
+    table = PrettyTable()
+    table.set_style(TableStyle.SINGLE_BORDER)
+    table.field_names = ["N.", "Database", "Path", "Username", "URL", "Score"]
+    table.title = "Search results"
+    for number, (db_id, result) in enumerate(results, start=1):
+        db = ctx.get_database(db_id)
+        table.add_row([number, db.get_name() if db else db_id, "/".join(result["path"]), result["username"], result["url"], f"{result["score"]:.1f}"])
+    questionary.print(str(table))
+
 def add_group(ctx: ContextApp) -> None:
     idx = database_selection(ctx)
     db = ctx.get_database(idx)
@@ -324,12 +441,67 @@ def delete_entry(ctx: ContextApp) -> None:
     except KeyError as e:
         questionary.print(f"{e}", style="bold fg:red")
 
+def import_entries(ctx: ContextApp) -> None:
+    idx = database_selection(ctx)
+    db = ctx.get_database(idx)
+    if not db:
+        return
+    source = questionary.path("Insert the path of the CSV or .kdbx file to import:").ask()
+    if not source:
+        return
+    source = Path(source).expanduser().resolve()
+
+    try:
+        if source.suffix.lower() == ".kdbx":
+            source_passwd = questionary.password("Insert the password of the database to import:").ask()
+            if source_passwd is None:
+                return
+            rows = read_kdbx(source, source_passwd)
+        else:
+            rows = read_csv(source)
+        imported, rejected = db.import_entries(rows)
+    except CredentialsError:
+        questionary.print("Incorrect credentials", style="bold fg:red")
+        return
+    except (OSError, ValueError, csv.Error) as e:
+        questionary.print(f"Unable to read the file: {e}", style="bold fg:red")
+        return
+
+    verb = "imported" if isinstance(db, DBLocal) else "proposed"
+    questionary.print(f"{imported} entries were {verb}", style="bold fg:green")
+    if rejected:
+        questionary.print(f"{len(rejected)} rows were skipped:", style="bold fg:red")
+        for reason in rejected[:IMPORT_ERRORS_SHOWN]:
+            questionary.print(f"- {reason}")
+        if len(rejected) > IMPORT_ERRORS_SHOWN:
+            questionary.print(f"- and {len(rejected) - IMPORT_ERRORS_SHOWN} more")
+
+def export_entries(ctx: ContextApp) -> None:
+    idx = database_selection(ctx)
+    db = ctx.get_database(idx)
+    if not db:
+        return
+    destination = questionary.path("Insert the path of the CSV file to write:").ask()
+    if not destination:
+        return
+    if not questionary.confirm("The passwords will be written in clear text. Do you want to continue?").ask():
+        return
+
+    try:
+        with open(Path(destination).expanduser().resolve(), "w", newline="") as f:
+            exported = db.export_csv(f)
+    except OSError as e:
+        questionary.print(f"Unable to write the file: {e}", style="bold fg:red")
+        return
+    questionary.print(f"{exported} entries were exported", style="bold fg:green")
+
 def close_db(ctx: ContextApp) -> None:
     idx = database_selection(ctx)
     closed_db = ctx.remove_database(idx)
     if not closed_db:
         questionary.print("The chosen database is not open!", style="bold fg:red")
     elif isinstance(closed_db, DBLocal):
+        closed_db.close()
         questionary.print(f"Closed local database: {closed_db.get_name()}")
     elif isinstance(closed_db, DBExpose):
         local_db = closed_db.close_database()
@@ -338,6 +510,12 @@ def close_db(ctx: ContextApp) -> None:
         ctx.unregister_ignored_service(closed_db.uri)
         ctx.replace_database(local_db.local_id, local_db)
         questionary.print(f"Closed exposed database {closed_db.get_name()}")
+    elif isinstance(closed_db, DBThin):
+        closed_db.leave()
+        ctx.daemon.unregister(closed_db)
+        ctx.unregister_ignored_service(closed_db.leader_uri)
+        ctx.add_service_from_db_name(closed_db.get_name())
+        questionary.print(f"Closed thin client of database {closed_db.get_name()}")
     else:
         local_db = closed_db.leave_db()
         ctx.daemon.unregister(closed_db)
@@ -347,7 +525,10 @@ def close_db(ctx: ContextApp) -> None:
         questionary.print(f"Closed remote database {closed_db.get_name()}")
 
 def list_available_dbs(ctx: ContextApp) -> None:
-    lines = [[name.split(".")[0], info[1], info[2]] for name, info in ctx.get_services_information()]
+    prefix = questionary.text("Show only the databases whose name starts with (empty for all):").ask()
+    if prefix is None:
+        return
+    lines = [[name.split(".")[0], info[1], info[2]] for name, info in ctx.get_services_information(prefix.strip())]
     table = PrettyTable()
     table.set_style(TableStyle.SINGLE_BORDER)
     table.field_names = ["Name", "IP address", "Port"]
@@ -363,7 +544,7 @@ def share_database(ctx: ContextApp) -> None:
     if not db:
         return
 
-    if isinstance(db, DBExpose) or isinstance(db, DBRemote):
+    if isinstance(db, (DBExpose, DBRemote, DBThin)):
         questionary.print("The database to share needs to be local!", style="bold fg:red")
         return
     
@@ -411,13 +592,28 @@ def connect_database(ctx: ContextApp) -> None:
         if not selected_choice:
             continue
         selected_uri = selected_choice[0]
+
+        mode = questionary.select("How do you want to connect?", choices=[FULL_COPY, THIN_CLIENT]).ask()
+        if mode is None:
+            return
+        if mode == THIN_CLIENT:
+            passwd = questionary.password("Insert the database password:").ask()
+            if passwd is None:
+                return
+            db_thin = DBThin.create_and_register(selected_uri, ctx, passwd)
+            if db_thin:
+                db_thin.set_name(selected_display_name.split()[0])
+                ctx.register_ignored_service(selected_uri)
+                ctx.remove_service(choices[selected_display_name][1])
+                db_thin.local_id = ctx.add_database(db_thin)
+            return
         
         questions = [
                 {
                     "type": "path",
                     "name": "db_path",
-                    "message": "Insert a file name for the local copy of the database:",
-                    "validate": NameValidator
+                    "message": "Insert a file name for the local copy of the database (or the one of a previous copy):",
+                    "validate": ReplicaNameValidator
                     },
                 {
                     "type": "password",
@@ -442,6 +638,57 @@ def connect_database(ctx: ContextApp) -> None:
             db_remote.local_id = local_id
         return
     
+def request_status(ctx: ContextApp) -> None:
+    idx = database_selection(ctx)
+    db = ctx.get_database(idx)
+    if not db:
+        return
+    if isinstance(db, DBLocal):
+        questionary.print("Changes to a local database are applied immediately", style="bold fg:red")
+        return
+    if isinstance(db, DBThin):
+        questionary.print("A thin client can't request changes", style="bold fg:red")
+        return
+    ticket = questionary.text(
+        "Insert the ticket of the request:",
+        validate=lambda text: text.strip().isdigit() or "The ticket must be a number",
+    ).ask()
+    if ticket is None:
+        return
+
+    status = db.get_request_status(int(ticket))
+    if status is None:
+        questionary.print("The ticket is unknown", style="bold fg:red")
+    else:
+        questionary.print(f"Request {ticket.strip()}: {status.name.lower()}", style="bold")
+
+def statistics(ctx: ContextApp) -> None:
+    counters_lines = []
+    histograms_lines = []
+    for name, labels, metric in ctx.metrics.snapshot():
+        labels_text = ", ".join(f"{key}={value}" for key, value in labels.items())
+        if isinstance(metric, Histogram):
+            if metric.count == 0:
+                continue
+            histograms_lines.append([name, labels_text, metric.count, f"{metric.sum / metric.count * 1000:.1f}",
+                                     f"{metric.quantile(0.5) * 1000:.1f}", f"{metric.quantile(0.99) * 1000:.1f}"])
+        else:
+            counters_lines.append([name, labels_text, f"{metric.value:g}"])
+
+    table = PrettyTable()
+    table.set_style(TableStyle.SINGLE_BORDER)
+    table.field_names = ["Metric", "Labels", "Count", "Mean (ms)", "p50 (ms)", "p99 (ms)"]
+    table.title = "Latencies"
+    table.add_rows(histograms_lines)
+    questionary.print(str(table))
+
+    table = PrettyTable()
+    table.set_style(TableStyle.SINGLE_BORDER)
+    table.field_names = ["Metric", "Labels", "Value"]
+    table.title = "Counters"
+    table.add_rows(counters_lines)
+    questionary.print(str(table))
+
 def read_notifications(ctx: ContextApp) -> None:
     if ctx.notifications_counter() <= 0:
         questionary.print("There are no notifications to read!", style="bold fg:red")
@@ -449,14 +696,12 @@ def read_notifications(ctx: ContextApp) -> None:
 
     for notification in ctx.get_notifications():
         questionary.print(notification.message)
-    
-    questionary.print("Expired notifications will be deleted", style="bold fg:green")
-    ctx.remove_stale_notifications()
 
 def answer_notification(ctx: ContextApp) -> None:
     """Prompts the user to select a notification and answers"""
     notifications = ctx.get_notifications()
-    notifications_messages = {notification.message: idx for idx, notification in enumerate(notifications)}
+    # Two proposals can have the same description, the ID of the proposition tells them apart.
+    notifications_messages = {f"{notification.message} (#{notification.proposition_id})": notification for notification in notifications}
 
     if not notifications:
         questionary.print("There are no notifications!", style="bold fg:red")
@@ -472,21 +717,24 @@ def answer_notification(ctx: ContextApp) -> None:
 
         if selected_notification is None:
             return
+
+        notification = notifications_messages.get(selected_notification)
+        if notification is None:
+            questionary.print("Select one of the notifications!", style="bold fg:red")
+            continue
         
         choice = questionary.confirm("Do you approve the change").ask()
 
         if not choice:
             return
         
-        notification_id = notifications_messages[selected_notification]
-        notification = notifications[notification_id]
         db = ctx.get_database(notification.db_id)
         if isinstance(db, DBLocal):
             questionary.print("The selected notification belongs to a database that right now is local", style="bold fg:red")
             return
         if db.answer_notification(choice, notification):
             questionary.print("The vote was cast", style="bold")
-            ctx.delete_notification(notifications_messages[selected_notification])
+            ctx.delete_notification(notification)
         else:
             questionary.print("There was a problem during the voting process", style="bold fg:red")
 
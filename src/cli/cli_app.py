@@ -15,14 +15,19 @@ class CLIApp():
                     "List databases": actions.list_databases,
                     "List entries": actions.list_entries,
                     "List groups": actions.list_groups,
+                    "Search entries": actions.search_entries,
                     "Add group": actions.add_group,
                     "Add entry": actions.add_entry,
                     "Delete group": actions.delete_group,
                     "Delete entry": actions.delete_entry,
+                    "Import entries": actions.import_entries,
+                    "Export entries": actions.export_entries,
                     "Close database": actions.close_db,
                     "List available exposed databases": actions.list_available_dbs,
                     "Share local database": actions.share_database,
                     "Connect to a remote database": actions.connect_database,
+                    "Check request status": actions.request_status,
+                    "Statistics": actions.statistics,
                     "Read notifications": actions.read_notifications,
                     "Answer notification": actions.answer_notification,
                     "Exit": self._exit_loop,
@@ -41,9 +46,9 @@ class CLIApp():
     def _exit_loop(self, ctx: ContextApp) -> None:
         confirmation = questionary.confirm("Are you sure you want to exit?").ask()
         if confirmation:
-            ctx.close_mdns_service()
+            ctx.close()
             exit(0)
 
     def _forced_exit(self, ctx: ContextApp) -> None:
-        ctx.close_mdns_service()
+        ctx.close()
         exit(1)
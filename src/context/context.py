@@ -1,17 +1,85 @@
-from collections.abc import ItemsView
+from collections.abc import Callable, ItemsView, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager
+from dataclasses import dataclass, field
+from enum import Enum
+from heapq import nlargest
+from pathlib import Path
+from typing import Any
 import threading
 from Pyro5.server import Daemon
 import Pyro5.api
-from zeroconf import Zeroconf, ServiceBrowser
+from zeroconf import Zeroconf
 from questionary import print
 from database.db_interface import DBInterface
+from database.db_local import WriteBehindPolicy
+from database.key_cache import key_cache
+from database.save_pool import save_pool
 from remote.mdns_services import ContinuousListener, UriAdvertiser, SERVICE_TYPE
-from remote.remote_data_structures import Notification, NotificationQueue
+from remote.broadcast import broadcast
+from remote.connection_pool import ConnectionPool, DEFAULT_TIMEOUT
+from remote.failure_detector import HeartbeatMonitor
+from remote.scheduler import FairScheduler
+from .metrics import metrics, MetricsExporter, MetricsRegistry
+from .tracing import tracer
+from remote.remote_data_structures import Notification, NotificationQueue, SearchResult
+
+class ServerType(str, Enum):
+    THREAD = "thread" # a worker of a pool serves each connection for its whole life
+    MULTIPLEX = "multiplex" # one thread serves every connection, a request at a time
+
+@dataclass
+class ServerPolicy:
+    """Server model of the Pyro daemon shared by all the exposed objects"""
+    server_type: ServerType = ServerType.THREAD
+    max_workers: int = 80 # connections served at the same time by the thread pool, the others are refused
+    min_workers: int = 4 # idle workers kept ready by the thread pool
+    backlog: int = 100 # connections waiting to be accepted
+
+@dataclass
+class ContextConfig:
+    """Tunable parameters shared by the components of the application"""
+    write_behind: WriteBehindPolicy = field(default_factory=WriteBehindPolicy)
+    save_workers: int = 0 # processes encrypting the saved databases, with 0 a database is encrypted by the thread saving it
+    server: ServerPolicy = field(default_factory=ServerPolicy)
+    rpc_workers: int = 16 # maximum number of peers contacted at the same time by a broadcast
+    max_outbound_rpcs: int = 32 # remote calls made at the same time through the pooled connections, by all the databases
+    scheduler_workers: int = 4 # threads running the proposals of all the exposed databases
+    max_concurrent_ballots: int = 4 # non conflicting proposals voted at the same time on an exposed database
+    ballot_timeout: float = 30.0 # seconds the peers have to vote a proposal
+    max_queued_proposals: int = 256 # proposals waiting to be voted on an exposed database
+    pool_max_idle_per_uri: int = 4 # idle connections kept open towards the same peer
+    pool_max_idle: int = 64 # idle connections kept open towards all the peers
+    pool_max_idle_time: float = 60.0 # seconds after which an idle connection is closed
+    max_log_entries: int = 1024 # committed operations kept to catch up the followers without sending the whole database
+    snapshot_chunk_size: int = 256 * 1024 # bytes of database sent with each remote call when a follower needs a full copy
+    snapshot_compression: int = 6 # zlib level of the database chunks, 0 disables the compression
+    heartbeat_interval: float = 1.0 # seconds between two pings of the monitored peers
+    heartbeat_timeout: float = 2.0 # seconds a ping can take before counting as missed
+    phi_threshold: float = 8.0 # suspicion level after which a silent peer is considered dead
+    heartbeat_max_silence: float = 10.0 # seconds of silence after which a peer is considered dead anyway
+    suspicion_timeout: float = 2.0 # seconds a suspected follower has to answer before being removed
+    max_membership_tombstones: int = 256 # removed followers remembered to gossip their removal
+    election_timeout: float = 10.0 # seconds a follower waits for the new leader announcement before probing again
+    election_rounds: int = 5 # probing rounds after which a failed election disconnects the database
+    read_cache_entries: int = 256 # answers of the leader kept by a thin client
+    read_cache_ttl: float = 300.0 # seconds after which a thin client asks again a cached answer, in case an invalidation was lost
+    max_notifications: int = 256 # notifications kept waiting for an answer, the ones closest to expiring are dropped first
+    mdns_cache_ttl: float = 120.0 # seconds after which a discovered database is checked again before being listed
+    mdns_resolve_timeout: float = 3.0 # seconds the resolution of a discovered database can take
+    metrics_file: str | None = None # file rewritten with the metrics in the Prometheus text format
+    metrics_port: int | None = None # port of 127.0.0.1 on which the metrics are served over HTTP
+    metrics_interval: float = 15.0 # seconds between two rewrites of the metrics file
+    trace_file: str | None = None # JSON lines file of the spans of the traced proposals and joins
+    trace_max_bytes: int = 10 * 1024 * 1024 # size after which the trace file is rotated
+    trace_backups: int = 3 # rotated trace files kept
 
 class ContextApp():
     """Context class that holds essential values used by different compontents
     of the application."""
-    def __init__(self, cert_path: str, cert_key_path: str):
+    def __init__(self, cert_path: str, cert_key_path: str, config: ContextConfig | None = None):
+        self.config = config or ContextConfig()
+
         # ---GENERAL TLS CONFIGURATIONS---
         Pyro5.config.SSL = True
         Pyro5.config.SSL_CACERTS = "certs/CA/ca.crt"    # to make ssl accept the self-signed server cert
@@ -26,19 +94,43 @@ class ContextApp():
         Pyro5.config.SSL_SERVERKEY = cert_key_path
         self._dbs = {}
         self._counter = 0
+        save_pool.configure(self.config.save_workers)
+
+        # ---SERVER MODEL CONFIGURATIONS---
+        Pyro5.config.SERVERTYPE = ServerType(self.config.server.server_type).value
+        Pyro5.config.THREADPOOL_SIZE = self.config.server.max_workers
+        Pyro5.config.THREADPOOL_SIZE_MIN = min(self.config.server.min_workers, self.config.server.max_workers)
         self.daemon = Daemon()
+        self.daemon.sock.listen(self.config.server.backlog) # Pyro listens with a fixed backlog, listening again resizes it
         self._zeroconf = Zeroconf()
         ip, port = self.daemon.locationStr.split(":")
-        self._listener = ContinuousListener(ip, port)
+        self._listener = ContinuousListener(self._zeroconf, self.config.mdns_cache_ttl, self.config.mdns_resolve_timeout)
         self._advertiser = UriAdvertiser(self._zeroconf, ip, port)
-        # Start continuous browsing in background without having to call any method
-        self._browser = ServiceBrowser(self._zeroconf, SERVICE_TYPE, self._listener)
-        self._notifications = NotificationQueue()
+        self._notifications = NotificationQueue(self.config.max_notifications)
+        self._rpc_executor = ThreadPoolExecutor(max_workers=self.config.rpc_workers, thread_name_prefix="rpc")
+        self._pool = ConnectionPool(self.config.pool_max_idle_per_uri, self.config.pool_max_idle, self.config.pool_max_idle_time,
+                                    self.config.max_outbound_rpcs)
+        self.scheduler = FairScheduler(self.config.scheduler_workers)
+        self._heartbeat = HeartbeatMonitor(self.broadcast, self.config.heartbeat_interval, self.config.heartbeat_timeout,
+                                           self.config.phi_threshold, self.config.heartbeat_max_silence)
+        self._heartbeat.start()
+        self.metrics = metrics
+        self.metrics.add_collector(self._collect_metrics)
+        self._metrics_exporter = MetricsExporter(self.metrics, self.config.metrics_file, self.config.metrics_port, self.config.metrics_interval)
+        self._metrics_exporter.start()
+        if self.config.trace_file:
+            # The peer is identified in the spans by its certificate and its daemon address.
+            tracer.configure(self.config.trace_file, self.config.trace_max_bytes, self.config.trace_backups,
+                             f"{Path(cert_path).stem}@{self.daemon.locationStr}")
 
     def start_daemon_loop(self) -> None:
         """Starts the Pyro5 daemon in a separate thread."""
         threading.Thread(target=self.daemon.requestLoop, daemon=True).start()
 
+    def start_discovery(self) -> None:
+        """Starts browsing the databases exposed on the network, in the background."""
+        self._listener.start()
+
     def add_database(self, db: DBInterface) -> int:
         """Adds a new database to the context and returns its ID."""
         self._counter += 1
@@ -61,6 +153,13 @@ class ContextApp():
         """Return all the dbs and their indexes."""
         return self._dbs.items()
     
+    def search_entries(self, query: str, limit: int = 20) -> list[tuple[int, SearchResult]]:
+        """Searches every open database, returns the best results with the ID of their database"""
+        results = []
+        for db_id, db in list(self._dbs.items()):
+            results.extend((db_id, result) for result in db.search_entries(query, limit))
+        return nlargest(limit, results, key=lambda item: item[1]["score"])
+
     def register_uri(self, name: str, uri: str) -> None:
         """Registers a URI with the specified name inside the mDNS service"""
         self._advertiser.register_uri(name, uri)
@@ -79,25 +178,85 @@ class ContextApp():
 
     def add_service_from_db_name(self, name: str) -> None:
         service_name = name + "." + SERVICE_TYPE     
-        self._listener.add_service(self._zeroconf, SERVICE_TYPE, service_name)
+        self._listener.add_service(service_name)
 
     def remove_service(self, name: str) -> None:
-        self._listener.remove_service(self._zeroconf, SERVICE_TYPE, name)
+        self._listener.remove_service(name)
 
-    def get_services_information(self) -> ItemsView[str, tuple[str, str, int]]:
-        """Returns the registered URIs and their associated names"""
-        return self._listener.get_services_information()
+    def get_services_information(self, prefix: str = "") -> list[tuple[str, tuple[str, str, int]]]:
+        """Returns the registered URIs and their associated names, only the ones
+        whose name starts with the prefix if given"""
+        return self._listener.get_services_information(prefix)
     
+    def flush_databases(self) -> None:
+        """Saves the pending changes of every open database"""
+        for db in list(self._dbs.values()):
+            db.flush()
+
     def close_mdns_service(self) -> None:
         """Terminates the mDNS service"""
+        self._listener.stop()
         self._zeroconf.close()
 
+    def close(self) -> None:
+        """Saves the open databases, stops the save workers, forgets the cached keys, stops the heartbeats and the scheduler,
+        writes the last metrics and spans, closes the pooled connections and stops the mDNS service"""
+        self._heartbeat.stop()
+        self.scheduler.close()
+        self._notifications.close()
+        self.flush_databases()
+        save_pool.close()
+        self._metrics_exporter.stop()
+        tracer.close()
+        key_cache.clear()
+        self._pool.close_all()
+        self.close_mdns_service()
+
     def get_listener(self) -> ContinuousListener:
         return self._listener
     
     def get_advertiser(self) -> UriAdvertiser:
         return self._advertiser
     
+    def broadcast(self, uris: Iterable[str], call: Callable[[Pyro5.api.Proxy], Any], timeout: float = DEFAULT_TIMEOUT) -> dict[str, Any]:
+        """Runs a remote call on every URI in parallel and returns the results by URI"""
+        return broadcast(self._rpc_executor, self._pool, uris, call, timeout)
+
+    def connection(self, uri: str, timeout: float | None = DEFAULT_TIMEOUT) -> AbstractContextManager[Pyro5.api.Proxy]:
+        """Lends a pooled proxy to the URI, to be used in a with statement"""
+        return self._pool.connection(uri, timeout)
+
+    def watch_peer(self, uri: str, on_suspect: Callable[[str], None], probe: Callable[[Pyro5.api.Proxy], bool] | None = None) -> None:
+        """Monitors a peer with heartbeats, the callback is called with its URI when it is suspected to be dead.
+        The heartbeats are pings, unless a probe returning True when the peer answers is given"""
+        self._heartbeat.watch(uri, on_suspect, probe)
+
+    def unwatch_peer(self, uri: str) -> None:
+        self._heartbeat.unwatch(uri)
+
+    def get_connection_stats(self) -> dict[str, int]:
+        """Returns the counters of the connection pool"""
+        return self._pool.get_stats()
+
+    def _collect_metrics(self, registry: MetricsRegistry) -> None:
+        for name, value in self._pool.get_stats().items():
+            registry.set(f"connection_pool_{name}", value, help="Counters of the pooled connections to the peers")
+        registry.set("notifications_pending", self.notifications_counter(), help="Notifications waiting for an answer")
+        registry.set("databases_open", len(self._dbs), help="Databases open in the application")
+        registry.set("server_connections", self._server_connections(), help="Connections open towards the Pyro daemon")
+        for database, (scheduled, held) in self.scheduler.depths().items():
+            registry.set("scheduler_queue_depth", scheduled, {"database": str(database), "state": "scheduled"},
+                         help="Work of every exposed database waiting for a worker of the scheduler or held back by the database")
+            registry.set("scheduler_queue_depth", held, {"database": str(database), "state": "held"})
+
+    def _server_connections(self) -> int:
+        server = self.daemon.transportServer
+        if server is None:
+            return 0
+        if self.config.server.server_type == ServerType.THREAD:
+            return len(server.pool.busy) # every connection keeps a worker busy
+        return len(server.selector.get_map()) - 1 # the listening socket is registered too
+
     def add_notification(self, notification: Notification) -> None:
         self._notifications.push(notification)
         print(f"[Notifications]: {self.notifications_counter()}", style="bold fg:yellow")
@@ -108,11 +267,8 @@ class ContextApp():
     def get_notifications(self) -> list[Notification]:
         return self._notifications.get_all()
 
-    def delete_notification(self, idx: int) -> None:
-        self._notifications.remove_at(idx)
-
-    def remove_stale_notifications(self) -> None:
-        self._notifications.remove_expired()
+    def delete_notification(self, notification: Notification) -> None:
+        self._notifications.remove(notification.db_id, notification.proposition_id)
     
     def print_message(self, message: str) -> None:
         print(message, style="bold")
\ No newline at end of file
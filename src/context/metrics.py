@@ -0,0 +1,227 @@
+import os
+from bisect import bisect_left
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import inf
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Any
+from .tracing import tracer
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, inf)
+
+class Counter:
+    """Value that can only grow, e.g. the number of calls of a method"""
+    kind = "counter"
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+class Gauge:
+    """Value that can go up and down, e.g. the size of a file"""
+    kind = "gauge"
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+class Histogram:
+    """Distribution of observed values, counted in cumulative buckets like Prometheus does"""
+    kind = "histogram"
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile (0-1) interpolating inside the bucket that contains it."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.bucket_counts):
+            if seen + bucket_count >= rank and bucket_count > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if self.buckets[i] != inf else lower
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-2]
+
+class MetricsRegistry:
+    """Thread-safe collection of the metrics of the application, identified by
+    name and labels. The metrics are updated only through the registry methods,
+    which hold its lock. Collectors are called before reading the metrics, to update
+    the gauges whose value is kept elsewhere (e.g. the connection pool)."""
+    def __init__(self) -> None:
+        self._metrics = {} # (name, sorted labels) -> metric
+        self._help = {} # name -> description
+        self._collectors = []
+        self._lock = Lock()
+
+    def inc(self, name: str, labels: dict[str, str] | None = None, amount: float = 1.0, help: str = "") -> None:
+        with self._lock:
+            self._get_locked(Counter, name, labels, help).inc(amount)
+
+    def set(self, name: str, value: float, labels: dict[str, str] | None = None, help: str = "") -> None:
+        with self._lock:
+            self._get_locked(Gauge, name, labels, help).set(value)
+
+    def observe(self, name: str, value: float, labels: dict[str, str] | None = None, help: str = "") -> None:
+        with self._lock:
+            self._get_locked(Histogram, name, labels, help).observe(value)
+
+    @contextmanager
+    def time(self, name: str, labels: dict[str, str] | None = None, help: str = "") -> Iterator[None]:
+        """Observes in a histogram the seconds spent inside the block."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, labels, help)
+
+    def add_collector(self, collector: Callable[["MetricsRegistry"], None]) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def snapshot(self) -> list[tuple[str, dict[str, str], Any]]:
+        """Returns the name, the labels and a copy of every metric, sorted by name."""
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            collector(self)
+        with self._lock:
+            return [(name, dict(labels), self._copy(metric)) for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0])]
+
+    def render_prometheus(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for name, labels, metric in self.snapshot():
+            if name not in described:
+                described.add(name)
+                if self._help.get(name):
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets, metric.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_labels_text({**labels, "le": "+Inf" if bound == inf else repr(bound)})} {cumulative}")
+                lines.append(f"{name}_sum{_labels_text(labels)} {metric.sum}")
+                lines.append(f"{name}_count{_labels_text(labels)} {metric.count}")
+            else:
+                lines.append(f"{name}{_labels_text(labels)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def _get_locked(self, kind: type, name: str, labels: dict[str, str] | None, help: str) -> Any:
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = kind()
+            if help:
+                self._help.setdefault(name, help)
+        return metric
+
+    @staticmethod
+    def _copy(metric: Any) -> Any:
+        copy = type(metric).__new__(type(metric))
+        copy.__dict__ = {k: list(v) if isinstance(v, list) else v for k, v in metric.__dict__.items()}
+        return copy
+
+def _labels_text(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace("\\", "\\\\").replace("\"", "\\\"")}"' for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+def instrument_exposed(cls: type) -> type:
+    """Class decorator that times every method exposed with Pyro, counts the
+    calls that raised an exception and records a span for the calls that are part
+    of a trace. The Pyro attributes are kept by wraps."""
+    for attribute, method in list(vars(cls).items()):
+        if callable(method) and getattr(method, "_pyroExposed", False):
+            setattr(cls, attribute, _timed_rpc(cls.__name__, attribute, method))
+    return cls
+
+def _timed_rpc(class_name: str, method_name: str, method: Callable) -> Callable:
+    labels = {"class": class_name, "method": method_name}
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            with metrics.time("rpc_duration_seconds", labels, "Time spent serving the remote calls"), tracer.span(method_name, served_by=class_name):
+                return method(*args, **kwargs)
+        except Exception:
+            metrics.inc("rpc_errors_total", labels, help="Remote calls that raised an exception")
+            raise
+    return wrapper
+
+class MetricsExporter:
+    """Publishes the metrics in the Prometheus text format: periodically rewrites a
+    file and/or serves them over HTTP on the loopback interface only."""
+    def __init__(self, registry: MetricsRegistry, file_path: str | None, port: int | None, interval: float) -> None:
+        self._registry = registry
+        self._file_path = file_path
+        self._port = port
+        self._interval = interval
+        self._stop = Event()
+        self._server = None
+
+    def start(self) -> None:
+        if self._file_path:
+            Thread(target=self._write_loop, daemon=True, name="metrics-file").start()
+        if self._port is not None:
+            registry = self._registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    body = registry.render_prometheus().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format: str, *args: Any) -> None:
+                    pass
+
+            self._server = ThreadingHTTPServer(("127.0.0.1", self._port), Handler)
+            Thread(target=self._server.serve_forever, daemon=True, name="metrics-http").start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+        if self._file_path:
+            self.write_file()
+
+    def write_file(self) -> None:
+        """Replaces the metrics file atomically, so a reader never sees it half written."""
+        temp_path = self._file_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(self._registry.render_prometheus())
+        os.replace(temp_path, self._file_path)
+
+    def _write_loop(self) -> None:
+        while not self._stop.wait(self._interval):
+            try:
+                self.write_file()
+            except OSError:
+                pass
+
+metrics = MetricsRegistry()
@@ -0,0 +1,132 @@
+import os
+import json
+import logging
+import threading
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from time import perf_counter, time
+from uuid import UUID
+from Pyro5.api import current_context
+from Pyro5.protocol import FLAGS_CORR_ID
+
+_local = threading.local() # trace ID of the operation started on this thread, if any
+
+def proposal_trace_id(proposition_id: int) -> str:
+    """The trace of a proposal is identified by its proposition ID, which is an UUID4"""
+    return str(UUID(int=proposition_id))
+
+def current_trace_id() -> str | None:
+    """Returns the trace ID of the traced operation running on this thread or of
+    the remote call being served, if its caller was part of a trace."""
+    trace_id = getattr(_local, "trace_id", None)
+    if trace_id is not None:
+        return trace_id
+    # Pyro gives a random correlation ID to the calls that didn't carry one.
+    if current_context.msg_flags & FLAGS_CORR_ID and current_context.correlation_id is not None:
+        return str(current_context.correlation_id)
+    return None
+
+@contextmanager
+def trace_context(trace_id: str | None) -> Iterator[None]:
+    """Makes the remote calls done by this thread inside the block carry the trace ID,
+    through the correlation ID that Pyro sends with every message."""
+    if trace_id is None:
+        yield
+        return
+    previous_trace_id = getattr(_local, "trace_id", None)
+    previous_correlation_id = current_context.correlation_id
+    _local.trace_id = trace_id
+    current_context.correlation_id = UUID(trace_id)
+    try:
+        yield
+    finally:
+        _local.trace_id = previous_trace_id
+        current_context.correlation_id = previous_correlation_id
+
+class Tracer:
+    """Writes the spans of the traced operations as JSON lines to a local file,
+    rotated when it becomes too big. Nothing is recorded until it is configured."""
+    def __init__(self) -> None:
+        self._logger = None
+        self._peer = None
+
+    def configure(self, path: str, max_bytes: int, backups: int, peer: str) -> None:
+        logger = logging.getLogger(f"{__name__}.spans")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.handlers = [handler]
+        self._peer = peer
+        self._logger = logger
+
+    def close(self) -> None:
+        if self._logger is not None:
+            for handler in self._logger.handlers:
+                handler.close()
+            self._logger = None
+
+    @contextmanager
+    def span(self, name: str, **attributes: object) -> Iterator[None]:
+        """Records the block as a span of the current trace, if there is one."""
+        trace_id = current_trace_id() if self._logger is not None else None
+        if trace_id is None:
+            yield
+            return
+        start = time()
+        start_counter = perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if error is not None:
+                attributes["error"] = error
+            self._write(trace_id, name, start, perf_counter() - start_counter, attributes)
+
+    def record(self, name: str, start: float, duration: float, **attributes: object) -> None:
+        """Records a span of the current trace that didn't run as a single block, e.g. a
+        ballot, which starts and ends on different threads."""
+        trace_id = current_trace_id() if self._logger is not None else None
+        if trace_id is not None:
+            self._write(trace_id, name, start, duration, attributes)
+
+    def _write(self, trace_id: str, name: str, start: float, duration: float, attributes: dict) -> None:
+        record = {"trace_id": trace_id, "name": name, "peer": self._peer, "start": start,
+                  "duration": duration, "thread": threading.current_thread().name, **attributes}
+        logger = self._logger
+        if logger is not None:
+            logger.info(json.dumps(record, default=str))
+
+def trace_files(paths: Iterable[str]) -> list[str]:
+    """Expands every trace file path with its rotated backups."""
+    files = []
+    for path in paths:
+        files.append(path)
+        backup = 1
+        while os.path.exists(f"{path}.{backup}"):
+            files.append(f"{path}.{backup}")
+            backup += 1
+    return files
+
+def merge_traces(paths: Iterable[str]) -> dict[str, list[dict]]:
+    """Reads the span files of several peers and returns the spans of every trace
+    sorted by start time, so they form a single timeline."""
+    traces = defaultdict(list)
+    for path in trace_files(paths):
+        with open(path) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # a line cut by a crash
+                traces[span["trace_id"]].append(span)
+    for spans in traces.values():
+        spans.sort(key=lambda span: span["start"])
+    return dict(sorted(traces.items(), key=lambda item: item[1][0]["start"]))
+
+tracer = Tracer()
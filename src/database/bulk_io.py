@@ -0,0 +1,62 @@
+import csv
+from collections.abc import Iterable, Iterator
+from typing import TextIO, TypedDict
+from pykeepass import PyKeePass, Group
+
+CSV_COLUMNS = ["Group", "Title", "Username", "Password"]
+
+class ImportRow(TypedDict):
+    """Entry read from a file, with the path of its group from the root"""
+    group: list[str]
+    title: str
+    username: str
+    passwd: str
+
+def read_csv(path: str) -> Iterator[ImportRow]:
+    """Reads lazily the entries of a CSV file. The header must have a Title column,
+    the Group (path separated by "/"), Username and Password columns are optional
+    and the names are case insensitive."""
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+        if "title" not in columns:
+            raise ValueError("The CSV file has no Title column")
+
+        def value(row: dict[str, str], column: str) -> str:
+            return (row.get(columns[column]) or "") if column in columns else ""
+
+        for row in reader:
+            group = value(row, "group").strip("/")
+            yield ImportRow(group=group.split("/") if group else [], title=value(row, "title"),
+                            username=value(row, "username"), passwd=value(row, "password"))
+
+def read_kdbx(path: str, passwd: str) -> Iterator[ImportRow]:
+    """Reads lazily the entries of another database, except the ones in its recycle bin."""
+    kp_db = PyKeePass(path, passwd)
+    try:
+        recyclebin_group = kp_db.recyclebin_group
+    except (AttributeError, ValueError):
+        recyclebin_group = None # the database has no recycle bin
+    yield from database_rows(kp_db.root_group, recyclebin_group)
+
+def database_rows(root_group: Group, skipped_group: Group | None = None) -> Iterator[ImportRow]:
+    """Visits the tree of a database yielding its entries one at a time, so the
+    path of every group is computed once instead of once per entry."""
+    stack = [(root_group, [])]
+    while stack:
+        group, path = stack.pop()
+        if skipped_group is not None and group == skipped_group:
+            continue
+        for entry in group.entries:
+            yield ImportRow(group=path, title=entry.title or "", username=entry.username or "", passwd=entry.password or "")
+        stack.extend((subgroup, path + [subgroup.name]) for subgroup in reversed(group.subgroups))
+
+def write_csv(rows: Iterable[ImportRow], f: TextIO) -> int:
+    """Writes the rows as they come, in the format read by read_csv, and returns how many they were."""
+    writer = csv.writer(f)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(["/".join(row["group"]), row["title"], row["username"], row["passwd"]])
+        count += 1
+    return count
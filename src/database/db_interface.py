@@ -1,5 +1,8 @@
 from abc import ABC, abstractmethod
-from pykeepass import Entry, Group
+from collections.abc import Iterable
+from typing import TextIO
+from remote.remote_data_structures import BatchItem, EntrySummary, SearchResult
+from .bulk_io import ImportRow
 
 class DBInterface(ABC):
 
@@ -19,6 +22,22 @@ class DBInterface(ABC):
     def delete_group(self, path: list[str]) -> None:
         pass
     
+    @abstractmethod
+    def submit_batch(self, operations: list[BatchItem]) -> bool:
+        pass
+
+    @abstractmethod
+    def import_entries(self, rows: Iterable[ImportRow]) -> tuple[int, list[str]]:
+        pass
+
+    @abstractmethod
+    def export_csv(self, f: TextIO) -> int:
+        pass
+
+    @abstractmethod
+    def flush(self) -> None:
+        pass
+
     @abstractmethod
     def get_name(self) -> str:
         pass
@@ -32,9 +51,17 @@ class DBInterface(ABC):
         pass
     
     @abstractmethod
-    def get_entries(self) -> list[Entry]:
+    def list_entries(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[EntrySummary]:
         pass
-    
+
+    @abstractmethod
+    def list_groups(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[list[str]]:
+        pass
+
+    @abstractmethod
+    def search_entries(self, query: str, limit: int = 20) -> list[SearchResult]:
+        pass
+
     @abstractmethod
-    def get_groups(self) -> list[Group]:
+    def get_entry_password(self, entry_path: list[str]) -> str | None:
         pass
@@ -1,14 +1,51 @@
-from typing import Self
-from threading import Lock
-from pykeepass import PyKeePass, create_database, Entry, Group
+from typing import Self, TextIO
+from collections import defaultdict
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from copy import deepcopy
+from itertools import islice
+from enum import Enum, auto
+from dataclasses import dataclass
+from os import path as os_path
+from threading import RLock, Timer
+from time import perf_counter
+from pykeepass import PyKeePass, Entry, Group
+from pykeepass.exceptions import CredentialsError
+from pykeepass.pykeepass import BLANK_DATABASE_LOCATION, BLANK_DATABASE_PASSWORD
 from .db_interface import DBInterface
+from .key_cache import key_cache
+from .save_pool import save_pool
+from .bulk_io import ImportRow, database_rows, write_csv
+from .search_index import SearchIndex
+from context.metrics import metrics
+from remote.remote_data_structures import Operation, OperationData, BatchItem, EntrySummary, EntryData, SearchResult
+
+class Durability(Enum):
+    """How durable a mutation must be when the call returns"""
+    DEFERRED = auto() # the change can wait for the next group commit
+    FLUSHED = auto() # the change is saved to disk before returning
+
+@dataclass(frozen=True)
+class WriteBehindPolicy:
+    """Group commit parameters for the saves of a local database"""
+    max_pending_ops: int = 1 # with 1 every mutation is saved immediately
+    flush_interval: float = 0.0 # seconds a deferred mutation can stay unsaved
+    durability: Durability | None = None # of the mutations that don't ask for one, with None it's FLUSHED only if max_pending_ops is 1
 
 class DBLocal(DBInterface):
 
-    def __init__(self, path: str, passwd: str) -> None:
-        self._kp_db = PyKeePass(path, passwd)
+    def __init__(self, path: str, passwd: str, write_behind: WriteBehindPolicy | None = None) -> None:
+        self._kp_db = self._open(path, passwd)
         self._local_id = None
-        self._db_lock = Lock()
+        self._db_lock = RLock() # reentrant so that a batch can call the single mutations
+        self._write_behind = write_behind or WriteBehindPolicy()
+        self._pending_ops = 0 # mutations applied in memory but not yet saved
+        self._flush_timer = None
+        self._batch_depth = 0 # mutations inside a batch are committed when the batch ends
+        self._groups_index = {} # group path -> group
+        self._group_entries = {} # group path -> {entry title -> entry}, its keys are the titles set of the group
+        self._search_index = None # built at the first search, then kept up to date by the mutations
+        self._build_index()
 
     @property
     def local_id(self) -> int | None:
@@ -21,63 +58,378 @@ class DBLocal(DBInterface):
         self._local_id = value
 
     @classmethod
-    def create_db(cls, path: str, passwd: str, name: str) -> Self:
-        db = create_database(path, passwd)
-        db.database_name = name
-        db.save()
-        return cls(path, passwd)
+    def create_db(cls, path: str, passwd: str, name: str, write_behind: WriteBehindPolicy | None = None) -> Self:
+        cls._create_file(path, passwd)
+        # Opening the new file caches its key, so naming the database doesn't derive it again.
+        db = cls(path, passwd, write_behind)
+        db.set_name(name, Durability.FLUSHED)
+        return db
 
     def reset_db(self, path: str, passwd: str) -> None:
-        self._kp_db = create_database(path, passwd)
+        with self._db_lock:
+            self._cancel_flush_timer()
+            self._pending_ops = 0
+            self._create_file(path, passwd)
+            self._kp_db = self._open(path, passwd)
+            self._build_index()
+
+    @staticmethod
+    def _open(path: str, passwd: str) -> PyKeePass:
+        """Opens the database reusing the cached transformed key when possible."""
+        transformed_key = key_cache.get(path, passwd)
+        start = perf_counter()
+        try:
+            kp_db = PyKeePass(path, passwd, transformed_key=transformed_key)
+        except CredentialsError:
+            if transformed_key is None:
+                raise
+            key_cache.evict(path)
+            transformed_key = None
+            kp_db = PyKeePass(path, passwd)
+        # A cache miss includes the key derivation, which is usually the slowest part.
+        metrics.observe("db_open_seconds", perf_counter() - start, {"key_cache": "miss" if transformed_key is None else "hit"}, "Time spent opening a database file")
+        key_cache.put(path, passwd, kp_db.kdbx.header, kp_db.transformed_key)
+        return kp_db
 
-    def add_entry(self, destination_group, title: str, username: str, passwd: str) -> None:
+    @staticmethod
+    def _create_file(path: str, passwd: str) -> None:
+        """Writes a new empty database like pykeepass create_database does, but
+        reusing the cached keys of the blank template and of the new file."""
+        kp_db = DBLocal._open(BLANK_DATABASE_LOCATION, BLANK_DATABASE_PASSWORD)
+        kp_db.filename = path
+        kp_db.password = passwd
+        # The new file keeps the KDF parameters of the blank template, not the ones of a file previously at path.
+        kp_db.save(transformed_key=key_cache.get(path, passwd, kp_db.kdbx.header))
+
+    def add_entry(self, destination_group, title: str, username: str, passwd: str, durability: Durability | None = None) -> None:
         with self._db_lock:
-            group = self._kp_db.find_groups(path=destination_group, first=True)
+            group_key = self._group_key(destination_group)
+            group = self._groups_index.get(group_key)
             if group is None:
                 raise KeyError("The group for the entry doesn't exist!")
-            
-            if self._kp_db.find_entries(group=group, title=title, first=True, recursive=False) is not None:
+
+            if title in self._group_entries[group_key]:
                 raise KeyError("The entry under the specified group, with the specified title already exists!")
-            
-            self._kp_db.add_entry(group, title, username, passwd)
-            self._kp_db.save()
 
-    def add_group(self, parent_group: list[str], group_name: str) -> None:
+            # The index already rules out duplicate titles, so pykeepass doesn't need to search the group again.
+            entry = self._kp_db.add_entry(group, title, username, passwd, force_creation=True)
+            self._group_entries[group_key][title] = entry
+            self._index_entry(group_key, title, entry)
+            self._commit(durability)
+
+    def add_group(self, parent_group: list[str], group_name: str, durability: Durability | None = None) -> None:
         with self._db_lock:
-            parent = self._kp_db.find_groups(path=parent_group, first=True)
+            parent_key = self._group_key(parent_group)
+            parent = self._groups_index.get(parent_key)
 
             if parent is None:
                 raise ValueError("The parent group does not exist!")
 
-            if self._kp_db.find_groups(group=parent, name=group_name, first=True, recursive=False) is not None:
+            group_key = parent_key + (group_name,)
+            if group_key in self._groups_index:
                 raise ValueError("The group is already present in the parent group!")
 
-            self._kp_db.add_group(parent, group_name) 
-            self._kp_db.save()
+            self._groups_index[group_key] = self._kp_db.add_group(parent, group_name)
+            self._group_entries[group_key] = {}
+            self._commit(durability)
 
-    def delete_entry(self, entry_path: list[str]) -> None:
+    def delete_entry(self, entry_path: list[str], durability: Durability | None = None) -> None:
         with self._db_lock:
-            entry = self._kp_db.find_entries(path=entry_path, first=True)
+            group_key, title = tuple(entry_path[:-1]), entry_path[-1] if entry_path else ""
+            entry = self._group_entries.get(group_key, {}).get(title)
             if entry is None:
                 raise KeyError("The entry doesn't exist!")
 
             self._kp_db.delete_entry(entry)
-            self._kp_db.save()
+            del self._group_entries[group_key][title]
+            self._unindex_entry(group_key, title)
+            # A database created elsewhere could hold more entries with the same title in the group.
+            duplicate = next((e for e in self._groups_index[group_key].entries if e.title == title), None)
+            if duplicate is not None:
+                self._group_entries[group_key][title] = duplicate
+                self._index_entry(group_key, title, duplicate)
+            self._commit(durability)
 
-    def delete_group(self, path: list[str]) -> None:
+    def delete_group(self, path: list[str], durability: Durability | None = None) -> None:
         with self._db_lock:
-            group = self._kp_db.find_groups(path=path, first=True) 
+            group_key = self._group_key(path)
+            group = self._groups_index.get(group_key)
             if group is None:
                 raise KeyError("The group doesn't exist!")
 
+            parent = group.parentgroup
+            self._unindex_group(group_key, group)
             self._kp_db.delete_group(group)
-            self._kp_db.save()
-    
-    def set_name(self, name: str) -> None:
+            if parent is not None:
+                # A database created elsewhere could hold more groups with the same name in the parent.
+                duplicate = next((g for g in parent.subgroups if g.name == group.name), None)
+                if duplicate is not None:
+                    self._index_group(duplicate, group_key)
+            self._commit(durability)
+
+    def set_name(self, name: str, durability: Durability | None = None) -> None:
         with self._db_lock:
             self._kp_db.database_name = name
-            self._kp_db.save()
-    
+            self._commit(durability)
+
+    def apply_operation(self, operation: Operation, data: OperationData, durability: Durability | None = None) -> None:
+        """Applies an operation described by its data, raising the same errors as the specific methods."""
+        match operation:
+            case Operation.ADD_ENTRY:
+                self.add_entry(data["destination_group"], data["title"], data["username"], data["passwd"], durability)
+            case Operation.ADD_GROUP:
+                self.add_group(data["parent_group"], data["group_name"], durability)
+            case Operation.DELETE_ENTRY:
+                self.delete_entry(data["entry_path"], durability)
+            case Operation.DELETE_GROUP:
+                self.delete_group(data["path"], durability)
+            case Operation.BATCH:
+                self.submit_batch(data["operations"], durability)
+            case _:
+                raise ValueError("The specified operation is not supported")
+
+    def submit_batch(self, operations: list[BatchItem], durability: Durability | None = None) -> bool:
+        """Applies the operations in order as a single atomic change with a single save."""
+        with self.batch(durability):
+            for item in operations:
+                self.apply_operation(Operation(item["operation"]), item["data"])
+        return True
+
+    @contextmanager
+    def batch(self, durability: Durability | None = None) -> Iterator[None]:
+        """Groups the mutations made inside the block: if one of them raises, the
+        database goes back to the state it had before the block, otherwise they
+        are committed together."""
+        with self._db_lock:
+            backup = deepcopy(self._kp_db.tree)
+            self._batch_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._kp_db.kdbx.body.payload.xml = backup
+                self._build_index()
+                raise
+            finally:
+                self._batch_depth -= 1
+            self._commit(durability)
+
+    def list_entries(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[EntrySummary]:
+        """Returns a page of the entries, optionally only the ones in a group and its
+        subgroups and/or whose title starts with a prefix (case insensitive). The
+        entries are visited lazily through the index and only under the requested
+        group, so without a prefix a page costs time proportional to its offset and
+        size instead of to the size of the database."""
+        with self._db_lock:
+            return list(islice(self._iter_entries_locked(group_path, prefix.casefold()), offset, offset + limit))
+
+    def list_groups(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[list[str]]:
+        """Returns a page of the paths of the groups under a group, optionally only
+        the ones whose name starts with a prefix (case insensitive)."""
+        prefix = prefix.casefold()
+        with self._db_lock:
+            group_keys = (group_key for group_key in self._subtree_keys_locked(group_path)
+                          if group_key and group_key[-1].casefold().startswith(prefix))
+            return [list(group_key) for group_key in islice(group_keys, offset, offset + limit)]
+
+    def get_entry_password(self, entry_path: list[str]) -> str | None:
+        """Returns the password of a single entry, None if it doesn't exist."""
+        entry = self.get_entry(entry_path)
+        return entry["passwd"] if entry is not None else None
+
+    def get_entry(self, entry_path: list[str]) -> EntryData | None:
+        """Returns the fields of a single entry, password included, None if it doesn't exist."""
+        with self._db_lock:
+            entry = self._group_entries.get(tuple(entry_path[:-1]), {}).get(entry_path[-1]) if entry_path else None
+            if entry is None:
+                return None
+            return EntryData(path=list(entry_path), title=entry_path[-1], username=entry.username or "", url=entry.url or "", passwd=entry.password or "")
+
+    def search_entries(self, query: str, limit: int = 20) -> list[SearchResult]:
+        """Returns the entries that best match the words of the query in their title,
+        username, URL or group path, best first."""
+        with self._db_lock:
+            if self._search_index is None:
+                self._search_index = SearchIndex()
+                for group_key, titles in self._group_entries.items():
+                    for title, entry in titles.items():
+                        self._index_entry(group_key, title, entry)
+            results = []
+            for score, key in self._search_index.search(query, limit):
+                entry = self._group_entries[key[:-1]][key[-1]]
+                results.append(SearchResult(path=list(key), title=key[-1], username=entry.username or "", url=entry.url or "", score=score))
+            return results
+
+    def _index_entry(self, group_key: tuple[str, ...], title: str, entry: Entry) -> None:
+        if self._search_index is not None:
+            self._search_index.add((*group_key, title), entry.username or "", entry.url or "")
+
+    def _unindex_entry(self, group_key: tuple[str, ...], title: str) -> None:
+        if self._search_index is not None:
+            self._search_index.remove((*group_key, title))
+
+    def _iter_entries_locked(self, group_path: list[str] | None, prefix: str) -> Iterator[EntrySummary]:
+        for group_key in self._subtree_keys_locked(group_path):
+            for title, entry in self._group_entries[group_key].items():
+                if title.casefold().startswith(prefix):
+                    yield EntrySummary(path=[*group_key, title], title=title, username=entry.username or "", url=entry.url or "")
+
+    def _subtree_keys_locked(self, group_path: list[str] | None) -> Iterator[tuple[str, ...]]:
+        """Yields the keys of a group and of its indexed subgroups, visiting only that
+        part of the tree. Without a group every key of the index is yielded."""
+        if group_path is None:
+            yield from self._groups_index
+            return
+        parent_key = self._group_key(group_path)
+        if parent_key not in self._groups_index:
+            return
+        stack = [parent_key]
+        while stack:
+            group_key = stack.pop()
+            yield group_key
+            subgroup_keys = (group_key + (subgroup.name,) for subgroup in self._groups_index[group_key].subgroups)
+            # A subgroup shadowed by a sibling with the same name isn't indexed, as in _index_group.
+            stack.extend(reversed([key for key in dict.fromkeys(subgroup_keys) if key in self._groups_index]))
+
+    def prepare_import(self, rows: Iterable[ImportRow]) -> tuple[list[BatchItem], list[str]]:
+        """Validates the rows against the index and turns the valid ones into a batch,
+        preceded by the creation of their missing groups. A row is rejected if its
+        title is empty or already used in its group, by the database or by a previous row.
+        Returns the batch and the reasons of the rejections."""
+        operations = []
+        rejected = []
+        new_groups = set()
+        new_titles = defaultdict(set) # group path -> titles added by the previous rows
+        # The rows are read before taking the lock: reading a file mustn't block the other users of the database.
+        rows = list(rows)
+        with self._db_lock:
+            for number, row in enumerate(rows, start=1):
+                group_key = self._group_key(row["group"])
+                title = row["title"]
+                if not title:
+                    rejected.append(f"Row {number}: the entry has no title")
+                    continue
+                if not all(group_key):
+                    rejected.append(f"Row {number}: the group path /{'/'.join(group_key)} has an empty name")
+                    continue
+                if title in self._group_entries.get(group_key, {}) or title in new_titles[group_key]:
+                    rejected.append(f"Row {number}: an entry titled {title} already exists in /{'/'.join(group_key)}")
+                    continue
+                for depth in range(1, len(group_key) + 1):
+                    missing_key = group_key[:depth]
+                    if missing_key not in self._groups_index and missing_key not in new_groups:
+                        new_groups.add(missing_key)
+                        operations.append(BatchItem(operation=Operation.ADD_GROUP, data={"parent_group": list(missing_key[:-1]), "group_name": missing_key[-1]}))
+                new_titles[group_key].add(title)
+                operations.append(BatchItem(operation=Operation.ADD_ENTRY, data={"destination_group": list(group_key), "title": title, "username": row["username"], "passwd": row["passwd"]}))
+        return (operations, rejected)
+
+    def import_entries(self, rows: Iterable[ImportRow], durability: Durability | None = None) -> tuple[int, list[str]]:
+        """Adds the valid rows as a single batch, so the import ends with a single save.
+        Returns the number of entries added and the reasons of the rejected rows."""
+        return self.import_rows(rows, lambda operations: self.submit_batch(operations, durability))
+
+    def import_rows(self, rows: Iterable[ImportRow], submit_batch: Callable[[list[BatchItem]], bool]) -> tuple[int, list[str]]:
+        """Validates the rows against this database and hands the valid ones to submit_batch,
+        which applies or proposes them. Returns the number of entries submitted, 0 if the
+        batch was refused, and the reasons of the rejected rows."""
+        operations, rejected = self.prepare_import(rows)
+        if operations and not submit_batch(operations):
+            return (0, rejected)
+        return (sum(item["operation"] == Operation.ADD_ENTRY for item in operations), rejected)
+
+    def export_csv(self, f: TextIO) -> int:
+        """Writes the entries to a CSV file while visiting the tree, without listing
+        them first, and returns how many they were."""
+        with self._db_lock:
+            return write_csv(database_rows(self._kp_db.root_group), f)
+
+    def flush(self) -> None:
+        """Saves the pending mutations to disk, if there are any."""
+        with self._db_lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        """Saves the pending mutations, stops the group commit timer and forgets
+        the cached key of the database."""
+        with self._db_lock:
+            self._flush_locked()
+            self._cancel_flush_timer()
+            key_cache.evict(self._kp_db.filename)
+
+    @staticmethod
+    def _group_key(path: list[str]) -> tuple[str, ...]:
+        """Normalizes a group path into an index key. Like pykeepass, a trailing
+        empty name (e.g. the root group typed as an empty input) is ignored."""
+        if path and not path[-1]:
+            path = path[:-1]
+        return tuple(path)
+
+    def _build_index(self) -> None:
+        """Indexes every group and entry of the database with a single visit of the tree."""
+        self._groups_index = {}
+        self._group_entries = {}
+        self._search_index = None
+        self._index_group(self._kp_db.root_group, ())
+
+    def _index_group(self, group: Group, group_key: tuple[str, ...]) -> None:
+        # The first match in document order wins, as it happens for the pykeepass path lookups.
+        if group_key in self._groups_index:
+            return
+        self._groups_index[group_key] = group
+        titles = self._group_entries[group_key] = {}
+        for entry in group.entries:
+            if entry.title not in titles:
+                titles[entry.title] = entry
+                self._index_entry(group_key, entry.title, entry)
+        for subgroup in group.subgroups:
+            self._index_group(subgroup, group_key + (subgroup.name,))
+
+    def _unindex_group(self, group_key: tuple[str, ...], group: Group) -> None:
+        if self._groups_index.get(group_key) != group:
+            return
+        del self._groups_index[group_key]
+        for title in self._group_entries.pop(group_key):
+            self._unindex_entry(group_key, title)
+        for subgroup in group.subgroups:
+            self._unindex_group(group_key + (subgroup.name,), subgroup)
+
+    def _commit(self, durability: Durability | None) -> None:
+        """Records a mutation and saves it according to the requested durability
+        and the write-behind policy. Must be called while holding the database lock."""
+        if self._batch_depth > 0:
+            return
+        self._pending_ops += 1
+        if durability is None:
+            durability = self._write_behind.durability
+        if durability is None:
+            durability = Durability.FLUSHED if self._write_behind.max_pending_ops <= 1 else Durability.DEFERRED
+
+        if durability == Durability.FLUSHED or self._pending_ops >= self._write_behind.max_pending_ops:
+            self._flush_locked()
+        elif self._flush_timer is None and self._write_behind.flush_interval > 0:
+            self._flush_timer = Timer(self._write_behind.flush_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_locked(self) -> None:
+        self._cancel_flush_timer()
+        if self._pending_ops == 0:
+            return
+        # The header, and so the KDF salt, never changes after opening: the key derived then is still valid.
+        with metrics.time("db_save_seconds", help="Time spent encrypting and writing a database file"):
+            if save_pool.enabled:
+                save_pool.save(self._kp_db, self._kp_db.transformed_key)
+            else:
+                self._kp_db.save(transformed_key=self._kp_db.transformed_key)
+        metrics.set("db_file_bytes", os_path.getsize(self._kp_db.filename), {"file": os_path.basename(self._kp_db.filename)}, "Size of the saved database files")
+        metrics.inc("db_saved_ops_total", amount=self._pending_ops, help="Mutations written by the saves, more than one per save with group commit")
+        self._pending_ops = 0
+
+    def _cancel_flush_timer(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
     def get_name(self) -> str:
         with self._db_lock:
             return self._kp_db.database_name
@@ -89,12 +441,3 @@ class DBLocal(DBInterface):
     def get_filename(self) -> str:
         with self._db_lock:
             return self._kp_db.filename
-
-    def get_entries(self) -> list[Entry]:
-        with self._db_lock:
-            return self._kp_db.entries
-
-    def get_groups(self) -> list[Group]:
-        with self._db_lock:
-            return self._kp_db.groups
-    
\ No newline at end of file
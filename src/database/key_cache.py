@@ -0,0 +1,66 @@
+from hashlib import sha256
+from os import path as os_path
+from threading import Lock
+from construct import Container, ConstructError
+from pykeepass.kdbx_parsing import KDBX
+
+# Only the outer header of the file is needed to know which KDF parameters were used.
+_HEADER = KDBX.subcons[0]
+
+def read_header(path: str) -> Container:
+    """Parses the outer header of a KDBX file without deriving any key"""
+    with open(path, "rb") as f:
+        return _HEADER.parse_stream(f)
+
+def kdf_fingerprint(header: Container) -> bytes:
+    """Returns a digest of the key derivation parameters stored in a KDBX header"""
+    dynamic_header = header.value.dynamic_header
+    if header.value.major_version == 3:
+        parts = [dynamic_header.transform_seed.data, repr(dynamic_header.transform_rounds.data).encode()]
+    else:
+        kdf_parameters = dynamic_header.kdf_parameters.data.dict
+        parts = [key.encode() + repr(kdf_parameters[key].value).encode() for key in sorted(kdf_parameters)]
+    return sha256(b"\0".join(parts)).digest()
+
+class KeyCache:
+    """In-memory cache of the transformed master keys. It allows to skip the
+    key derivation when the same database file is opened or saved again with
+    the same credentials and KDF parameters."""
+    def __init__(self) -> None:
+        self._keys = {} # (file path, KDF fingerprint, credentials digest) -> transformed key
+        self._lock = Lock()
+
+    def get(self, path: str, passwd: str, header: Container | None = None) -> bytes | None:
+        """Returns the cached key for the database, reading its header from the
+        file when it is not passed."""
+        try:
+            cache_key = self._cache_key(path, passwd, header)
+        except (OSError, ConstructError):
+            # Missing or unreadable file, the normal open will report the problem.
+            return None
+        with self._lock:
+            return self._keys.get(cache_key)
+
+    def put(self, path: str, passwd: str, header: Container, transformed_key: bytes) -> None:
+        cache_key = self._cache_key(path, passwd, header)
+        with self._lock:
+            self._keys[cache_key] = transformed_key
+
+    def evict(self, path: str) -> None:
+        """Forgets every key associated to a database file."""
+        path = os_path.realpath(path)
+        with self._lock:
+            for cache_key in [k for k in self._keys if k[0] == path]:
+                del self._keys[cache_key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+
+    def _cache_key(self, path: str, passwd: str, header: Container | None) -> tuple[str, bytes, bytes]:
+        if header is None:
+            header = read_header(path)
+        credentials = sha256((passwd or "").encode()).digest()
+        return (os_path.realpath(path), kdf_fingerprint(header), credentials)
+
+key_cache = KeyCache()
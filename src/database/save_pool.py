@@ -0,0 +1,107 @@
+import os
+import pickle
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from construct import Container, ListContainer
+from lxml import etree
+from pykeepass import PyKeePass
+from pykeepass.kdbx_parsing import KDBX
+
+def _strip_streams(value: object) -> object:
+    """Copies a parsed KDBX structure without the streams it was read from, which can't be pickled."""
+    if isinstance(value, Container):
+        stripped = Container()
+        for key, item in value.items():
+            if key != "_io":
+                stripped[key] = _strip_streams(item)
+        return stripped
+    if isinstance(value, ListContainer):
+        return ListContainer(_strip_streams(item) for item in value)
+    return value
+
+def snapshot(kp_db: PyKeePass) -> bytes:
+    """Serializes the state of an open database for a worker process. It's the only
+    part of a save left to the calling thread and it's much cheaper than the encryption."""
+    kdbx = _strip_streams(kp_db.kdbx)
+    kdbx.body.payload.xml = etree.tostring(kp_db.tree)
+    return pickle.dumps(kdbx, protocol=pickle.HIGHEST_PROTOCOL)
+
+def encrypt_snapshot(data: bytes, passwd: str | None, keyfile: str | None, transformed_key: bytes | None) -> bytes:
+    """Runs in a worker process: builds the encrypted file from a snapshot."""
+    kdbx = pickle.loads(data)
+    kdbx.body.payload.xml = etree.ElementTree(etree.fromstring(kdbx.body.payload.xml))
+    return KDBX.build(kdbx, password=passwd, keyfile=keyfile, transformed_key=transformed_key, decrypt=True)
+
+def write_atomically(path: str, data: bytes) -> None:
+    """Writes the file next to the old one and swaps them, so a crash leaves either
+    the old or the new database, never a truncated one."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return # e.g. on Windows a directory can't be opened, the rename is durable enough there
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class SavePool:
+    """Pool of processes encrypting the databases being saved, so the compression and
+    the encryption of a save don't hold the GIL of the application and the saves of
+    different databases use different cores. Disabled until it has workers."""
+    def __init__(self) -> None:
+        self._workers = 0
+        self._executor = None
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._workers > 0
+
+    def configure(self, workers: int) -> None:
+        self.close()
+        with self._lock:
+            self._workers = workers
+
+    def save(self, kp_db: PyKeePass, transformed_key: bytes | None) -> None:
+        """Saves the database, encrypting it in a worker process."""
+        data = snapshot(kp_db)
+        try:
+            encrypted = self._get_executor().submit(encrypt_snapshot, data, kp_db.password, kp_db.keyfile, transformed_key).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed by the system: the next save starts a new pool.
+            with self._lock:
+                self._executor = None
+            encrypted = encrypt_snapshot(data, kp_db.password, kp_db.keyfile, transformed_key)
+        write_atomically(kp_db.filename, encrypted)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # The workers are spawned: forking a process with running threads could copy held locks.
+                self._executor = ProcessPoolExecutor(self._workers, multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+save_pool = SavePool()
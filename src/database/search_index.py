@@ -0,0 +1,100 @@
+import re
+from bisect import bisect_left, insort
+from collections import defaultdict
+from collections.abc import Iterator
+from heapq import nlargest
+
+_WORD = re.compile(r"\w+")
+FIELD_WEIGHTS = {"title": 3.0, "username": 2.0, "url": 1.0, "group": 1.0} # a match in the title counts more than one in the URL
+PREFIX_FACTOR = 0.6 # score of a token that starts with the searched word, compared to an exact match
+FUZZY_FACTOR = 0.3 # score of a token one typo away from the searched word
+FUZZY_MIN_LENGTH = 4 # shorter words would match too many unrelated tokens
+
+def tokenize(text: str) -> list[str]:
+    return _WORD.findall(text.casefold())
+
+def _deletions(token: str) -> set[str]:
+    """Returns the strings obtained removing one character from the token."""
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+class SearchIndex:
+    """Inverted index of the entries of a database, from the words of their title,
+    username, URL and group path to the entries holding them. The words are also
+    kept sorted, for the prefix matches, and by their deletions, so the ones a single
+    typo away from a searched word are found without comparing it with every word.
+    It isn't thread-safe: the database lock protects it."""
+    def __init__(self) -> None:
+        self._postings = {} # word -> {entry key -> weight of the best field holding the word}
+        self._entry_words = {} # entry key -> its words
+        self._words = [] # sorted words
+        self._deletes = defaultdict(set) # word with a character removed -> words
+
+    def add(self, key: tuple[str, ...], username: str, url: str) -> None:
+        """Indexes an entry, identified by its group path followed by its title."""
+        self.remove(key)
+        weights = {}
+        for field, text in (("title", key[-1]), ("username", username), ("url", url), ("group", " ".join(key[:-1]))):
+            for word in tokenize(text):
+                weights[word] = max(weights.get(word, 0.0), FIELD_WEIGHTS[field])
+        for word, weight in weights.items():
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = {}
+                insort(self._words, word)
+                for deletion in _deletions(word):
+                    self._deletes[deletion].add(word)
+            postings[key] = weight
+        self._entry_words[key] = list(weights)
+
+    def remove(self, key: tuple[str, ...]) -> None:
+        for word in self._entry_words.pop(key, ()):
+            postings = self._postings[word]
+            del postings[key]
+            if postings:
+                continue
+            del self._postings[word]
+            del self._words[bisect_left(self._words, word)]
+            for deletion in _deletions(word):
+                words = self._deletes[deletion]
+                words.discard(word)
+                if not words:
+                    del self._deletes[deletion]
+
+    def search(self, query: str, limit: int) -> list[tuple[float, tuple[str, ...]]]:
+        """Returns the keys of the best entries with their score. An entry must match
+        every word of the query, exactly, as a prefix or with a typo."""
+        scores = None
+        for term in tokenize(query):
+            term_scores = {}
+            for word, factor in self._matches(term):
+                for key, weight in self._postings[word].items():
+                    term_scores[key] = max(term_scores.get(key, 0.0), weight * factor)
+            scores = term_scores if scores is None else {key: scores[key] + score for key, score in term_scores.items() if key in scores}
+            if not scores:
+                return []
+        return nlargest(limit, ((score, key) for key, score in scores.items())) if scores else []
+
+    def _matches(self, term: str) -> Iterator[tuple[str, float]]:
+        """Yields the indexed words matching a searched word, with the factor of their score."""
+        matched = set()
+        if term in self._postings:
+            matched.add(term)
+            yield (term, 1.0)
+        for i in range(bisect_left(self._words, term), len(self._words)):
+            word = self._words[i]
+            if not word.startswith(term):
+                break
+            if word not in matched:
+                matched.add(word)
+                yield (word, PREFIX_FACTOR)
+        if len(term) < FUZZY_MIN_LENGTH:
+            return
+        # A word with a character more, less or different shares a deletion with the term.
+        term_deletions = _deletions(term)
+        candidates = set(self._deletes.get(term, ()))
+        for deletion in term_deletions:
+            if deletion in self._postings:
+                candidates.add(deletion)
+            candidates.update(self._deletes.get(deletion, ()))
+        for word in candidates - matched:
+            yield (word, FUZZY_FACTOR)
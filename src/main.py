@@ -1,14 +1,34 @@
-import sys
+import argparse
 from cli.cli_app import CLIApp
-from context.context import ContextApp
+from context.context import ContextApp, ContextConfig, ServerPolicy, ServerType
+from database.db_local import Durability, WriteBehindPolicy
 
 def main():
-    if len(sys.argv) < 3:
-        print("You need to pass the client certificate and its key!\n" \
-        "Usage: python follower.py <client_cert> <client_key>")
-        sys.exit(1)
-    ctx = ContextApp(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(description="Shares KeePass databases with the peers of the local network.")
+    parser.add_argument("client_cert", help="certificate of this peer, from one of the directories of certs/clients")
+    parser.add_argument("client_key", help="private key of the certificate")
+    parser.add_argument("--max-pending-ops", type=int, default=WriteBehindPolicy.max_pending_ops,
+                        help="mutations of a database saved together, with 1 every mutation is saved immediately")
+    parser.add_argument("--flush-interval", type=float, default=WriteBehindPolicy.flush_interval,
+                        help="seconds a mutation can stay unsaved, with 0 it waits for the next group of mutations")
+    parser.add_argument("--durability", choices=[durability.name.lower() for durability in Durability],
+                        help="durability of the mutations, by default flushed only if --max-pending-ops is 1")
+    parser.add_argument("--save-workers", type=int, default=ContextConfig.save_workers,
+                        help="processes encrypting the saved databases, with 0 a database is encrypted by the thread saving it")
+    parser.add_argument("--server-type", choices=[server_type.value for server_type in ServerType], default=ServerPolicy.server_type.value,
+                        help="server model of the Pyro daemon")
+    parser.add_argument("--max-workers", type=int, default=ServerPolicy.max_workers, help="connections served at the same time by the thread server")
+    parser.add_argument("--min-workers", type=int, default=ServerPolicy.min_workers, help="idle workers kept ready by the thread server")
+    parser.add_argument("--backlog", type=int, default=ServerPolicy.backlog, help="connections waiting to be accepted")
+    args = parser.parse_args()
+
+    server = ServerPolicy(ServerType(args.server_type), args.max_workers, min(args.min_workers, args.max_workers), args.backlog)
+    durability = Durability[args.durability.upper()] if args.durability else None
+    write_behind = WriteBehindPolicy(max(args.max_pending_ops, 1), args.flush_interval, durability)
+    config = ContextConfig(write_behind=write_behind, save_workers=args.save_workers, server=server)
+    ctx = ContextApp(args.client_cert, args.client_key, config)
     ctx.start_daemon_loop()
+    ctx.start_discovery()
     app = CLIApp(ctx)
     app.run()
 
@@ -0,0 +1,26 @@
+from collections.abc import Callable, Iterable
+from concurrent.futures import Executor
+from typing import Any
+from Pyro5.api import Proxy
+from context.tracing import tracer, trace_context, current_trace_id
+from .connection_pool import ConnectionPool, DEFAULT_TIMEOUT
+
+def broadcast(executor: Executor, pool: ConnectionPool, uris: Iterable[str], call: Callable[[Proxy], Any], timeout: float = DEFAULT_TIMEOUT) -> dict[str, Any]:
+    """Runs the call on every peer at the same time and gathers the results by URI.
+    An exception raised while contacting a peer is returned as its result, so a
+    slow or dead peer only delays the broadcast up to its own timeout.
+    The calls belong to the trace of the caller, if any."""
+    trace_id = current_trace_id()
+
+    def traced_call(uri: str) -> Any:
+        with trace_context(trace_id), tracer.span("call", target=uri):
+            return pool.call(uri, call, timeout)
+
+    futures = {uri: executor.submit(traced_call, uri) for uri in uris}
+    results = {}
+    for uri, future in futures.items():
+        try:
+            results[uri] = future.result()
+        except Exception as e:
+            results[uri] = e
+    return results
@@ -0,0 +1,154 @@
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from select import select
+from threading import BoundedSemaphore, Lock
+from time import time
+from typing import Any
+from Pyro5.core import URI
+from Pyro5.api import Proxy
+from Pyro5.errors import PyroError
+
+# Wait at most 5 seconds to establish a connection, otherwise the follower is
+# overwhelmed with connections and can't respond.
+DEFAULT_TIMEOUT = 5.0
+
+class ConnectionPool:
+    """Keeps the mutual TLS connections to the peers open between remote calls.
+    A Pyro proxy can only be used by the thread that owns it, so every call
+    borrows an idle proxy for the URI, claims its ownership and gives it back
+    when it is done. At most max_in_use proxies are lent at the same time, which
+    bounds the remote calls made by the peer."""
+    def __init__(self, max_idle_per_uri: int = 4, max_idle: int = 64, max_idle_time: float = 60.0, max_in_use: int = 32) -> None:
+        self._max_idle_per_uri = max_idle_per_uri
+        self._max_idle = max_idle
+        self._max_idle_time = max_idle_time # seconds after which an idle connection is closed
+        self._idle = {} # URI -> [(proxy, release time)], the most recently released proxy is the last one
+        self._idle_count = 0
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max_in_use)
+        self._in_use = 0
+        self._waiting = 0 # threads waiting for a free slot
+        self.handshakes = 0 # new connections opened
+        self.reused = 0 # handshakes saved by reusing an idle connection
+        self.evicted = 0 # connections closed because broken, expired or over the size cap
+
+    @contextmanager
+    def connection(self, uri: str, timeout: float | None = DEFAULT_TIMEOUT) -> Iterator[Proxy]:
+        """Lends a proxy to the URI owned by the calling thread. If the call fails
+        because of a communication problem the connection is closed instead of
+        being returned to the pool."""
+        self._take_slot()
+        try:
+            proxy = self._acquire(uri)
+            proxy._pyroTimeout = timeout
+            try:
+                yield proxy
+            except PyroError:
+                self._close(proxy)
+                raise
+            except BaseException:
+                self._release(uri, proxy)
+                raise
+            self._release(uri, proxy)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def call(self, uri: str, call: Callable[[Proxy], Any], timeout: float | None = DEFAULT_TIMEOUT) -> Any:
+        """Runs the call on a pooled proxy to the URI"""
+        with self.connection(uri, timeout) as proxy:
+            return call(proxy)
+
+    def get_stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "idle": self._idle_count,
+                "handshakes": self.handshakes,
+                "reused": self.reused,
+                "evicted": self.evicted,
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+            }
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle = [proxy for proxies in self._idle.values() for proxy, _ in proxies]
+            self._idle.clear()
+            self._idle_count = 0
+        for proxy in idle:
+            self._close(proxy)
+
+    def _take_slot(self) -> None:
+        with self._lock:
+            self._waiting += 1
+        self._slots.acquire()
+        with self._lock:
+            self._waiting -= 1
+            self._in_use += 1
+
+    def _acquire(self, uri: str) -> Proxy:
+        stale = []
+        proxy = None
+        with self._lock:
+            idle = self._idle.get(uri, [])
+            while idle:
+                candidate, released_at = idle.pop()
+                self._idle_count -= 1
+                if time() - released_at <= self._max_idle_time and self._is_healthy(candidate):
+                    proxy = candidate
+                    self.reused += 1
+                    break
+                stale.append(candidate)
+                self.evicted += 1
+            if not idle:
+                self._idle.pop(uri, None)
+            if proxy is None:
+                self.handshakes += 1
+        for candidate in stale:
+            self._close(candidate)
+        if proxy is None:
+            return Proxy(URI(uri))
+        proxy._pyroClaimOwnership()
+        return proxy
+
+    def _release(self, uri: str, proxy: Proxy) -> None:
+        evicted = []
+        with self._lock:
+            idle = self._idle.setdefault(uri, [])
+            idle.append((proxy, time()))
+            self._idle_count += 1
+            if len(idle) > self._max_idle_per_uri:
+                evicted.append(idle.pop(0)[0])
+                self._idle_count -= 1
+            while self._idle_count > self._max_idle:
+                # Close the connection that has been idle for the longest time.
+                oldest_uri = min(self._idle, key=lambda u: self._idle[u][0][1])
+                evicted.append(self._idle[oldest_uri].pop(0)[0])
+                self._idle_count -= 1
+                if not self._idle[oldest_uri]:
+                    del self._idle[oldest_uri]
+            self.evicted += len(evicted)
+        for candidate in evicted:
+            self._close(candidate)
+
+    @staticmethod
+    def _is_healthy(proxy: Proxy) -> bool:
+        """An idle connection should never have something to read: if its socket
+        is readable the peer has closed it or the protocol is out of sync."""
+        connection = proxy._pyroConnection
+        if connection is None:
+            return False
+        try:
+            readable, _, _ = select([connection.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    @staticmethod
+    def _close(proxy: Proxy) -> None:
+        try:
+            proxy._pyroClaimOwnership()
+            proxy._pyroRelease()
+        except Exception:
+            pass
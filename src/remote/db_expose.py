@@ -1,34 +1,82 @@
-from typing import Self
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
-from time import time, sleep
+from typing import Self, TextIO
+from collections.abc import Iterable
+from collections import OrderedDict, deque
+from functools import partial
+from threading import Condition, Lock, Timer
+from time import time
 from uuid import uuid4
 from Pyro5.server import expose, oneway
 from Pyro5.errors import CommunicationError, NamingError, PyroError
-from Pyro5.core import URI
 from Pyro5.api import Proxy, current_context
-from pykeepass import Entry, Group
 from database.db_interface import DBInterface
 from database.db_local import DBLocal
+from database.bulk_io import ImportRow
 from context.context import ContextApp
-from .remote_data_structures import StatusCode, Operation, OperationData, ReturnCode, Notification
-
+from context.metrics import metrics, instrument_exposed
+from context.tracing import tracer, trace_context, proposal_trace_id
+from .snapshot_transfer import send_snapshot
+from .remote_data_structures import EntrySummary, EntryData, SearchResult, StatusCode, Operation, OperationData, BatchItem, ReturnCode, Notification, ProposalStatus, Proposal, OperationLog, MembershipView, MemberStatus, operation_paths, paths_conflict
+
+TICKETS_HISTORY = 1024 # number of proposals whose status can still be queried
+BATCH_PREVIEW = 5 # number of operations of a batch shown in its notification
+UNKNOWN_EPOCH = -1 # membership epoch of a follower whose whole view is replaced by the next gossip
+
+def describe_operation(operation: Operation, data: OperationData) -> str | None:
+    """Returns the message shown to the voters of a change, None if the operation is not supported"""
+    match operation:
+        case Operation.ADD_ENTRY:
+            return f"Entry addition titled {data["username"]} with username {data["username"]} and password {data["passwd"]} in path {'/'.join(data["destination_group"])}"
+        case Operation.ADD_GROUP:
+            return f"Group addition named {data["group_name"]} in parent group {'/'.join(data["parent_group"])}"
+        case Operation.DELETE_ENTRY:
+            return f"Entity elimination with path {'/'.join(data["entry_path"])}"
+        case Operation.DELETE_GROUP:
+            return f"Group elimination with path {'/'.join(data["path"])}"
+        case Operation.BATCH:
+            descriptions = [describe_operation(Operation(item["operation"]), item["data"]) for item in data["operations"]]
+            if None in descriptions:
+                return None
+            preview = "; ".join(descriptions[:BATCH_PREVIEW])
+            if len(descriptions) > BATCH_PREVIEW:
+                preview += f"; and {len(descriptions) - BATCH_PREVIEW} more"
+            return f"Batch of {len(descriptions)} changes ({preview})"
+    return None
+
+@instrument_exposed
 class DBExpose(DBInterface):
 
-    def __init__(self, db_local: DBLocal, context: ContextApp) -> None:
+    def __init__(self, db_local: DBLocal, context: ContextApp, log: OperationLog | None = None, membership: MembershipView | None = None) -> None:
         self._db_local = db_local
         self._followers_cn = {} # followers Common Names
         self._followers_id = {} # followers IDs
         self._uri = None # leader URI
         self._is_leader = True
         self._ctx = context
-        self._executor = ThreadPoolExecutor(max_workers=1)
-        self._operation_lock = Lock()
+        # The proposals run as steps on the scheduler shared by all the databases of the context,
+        # the local ID tells apart two databases with the same name.
+        self._queue_key = f"{db_local.get_name()}#{db_local.local_id}"
+        context.scheduler.add_queue(self._queue_key, self._held_proposals)
+        self._queue_lock = Lock()
+        self._queue_cond = Condition(self._queue_lock) # Signaled every time a ballot ends or the queue is unblocked.
+        self._waiting = deque() # proposals that haven't started yet, in sequence order
+        self._running = {} # sequence -> proposal being voted or applied
+        self._tickets = OrderedDict() # sequence -> status of the most recent proposals
+        self._next_sequence = 0
+        self._blocked = None # status that prevents new ballots from starting (follower joining or leader election)
         self._vote_lock = Lock()
         self._followers_lock = Lock()
         self._leader_lock = Lock()
-        self._current_proposition = None
-        self._status = StatusCode.FREE
+        self._propositions = {} # proposition ID -> ballot of a running proposal
+        if log is None or log.log_id is None:
+            # Without a complete history the followers can't be caught up with a log suffix, so a new history starts.
+            log = OperationLog(uuid4().hex, context.config.max_log_entries, log.last_index if log is not None else 0)
+        self._log = log
+        self._apply_lock = Lock() # Keeps the order of the log equal to the order in which the changes are applied.
+        self._applied_index = log.last_index # index of the last change applied to the local copy
+        self._replica_index = {} # follower URI -> index of the last log entry sent to it
+        self._membership = membership or MembershipView(max_tombstones=context.config.max_membership_tombstones)
+        self._member_epochs = {} # follower URI -> epoch of the membership view known by it
+        self._readers = {} # thin client URI -> Common Name, they read through the leader without a replica
 
     @property
     def uri(self) -> str | None:
@@ -45,250 +93,423 @@ class DBExpose(DBInterface):
         return self._db_local.local_id
 
     @classmethod
-    def create_and_register(cls, db_local: DBLocal, context: ContextApp) -> Self:
-        obj = cls(db_local, context)
+    def create_and_register(cls, db_local: DBLocal, context: ContextApp, log: OperationLog | None = None, membership: MembershipView | None = None) -> Self:
+        obj = cls(db_local, context, log, membership)
         uri = context.daemon.register(obj)
         obj.uri = str(uri)
         return obj
     
     def add_entry(self, destination_group: list[str], title: str, username: str, passwd: str) -> bool:
-        if not self._operation_lock.acquire(timeout=5):
-            self._process_status_code(self._status, False)
-            return False
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.ADD_ENTRY, {"destination_group": destination_group, "title": title, "username": username, "passwd": passwd}, self.uri)
-        self._process_status_code(self._status, True)
-        return True
+        return self._submit_local(Operation.ADD_ENTRY, {"destination_group": destination_group, "title": title, "username": username, "passwd": passwd})
 
     def add_group(self, parent_group: list[str], group_name: str) -> bool:
-        if not self._operation_lock.acquire(timeout=5):
-            self._process_status_code(self._status, False)
-            return False
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.ADD_GROUP, {"parent_group": parent_group, "group_name": group_name}, self.uri)
-        self._process_status_code(self._status, True)
-   
-        return True
+        return self._submit_local(Operation.ADD_GROUP, {"parent_group": parent_group, "group_name": group_name})
     
     def delete_entry(self, entry_path: list[str]) -> bool:
-        if not self._operation_lock.acquire(timeout=5):
-            self._process_status_code(self._status, False)
-            return False
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.DELETE_ENTRY, {"entry_path": entry_path}, self.uri)
-        self._process_status_code(self._status, True)
-
-        return True
+        return self._submit_local(Operation.DELETE_ENTRY, {"entry_path": entry_path})
     
     def delete_group(self, path: list[str]) -> bool:
-        if not self._operation_lock.acquire(timeout=5):
-            self._process_status_code(self._status, False)
+        return self._submit_local(Operation.DELETE_GROUP, {"path": path})
+
+    def submit_batch(self, operations: list[BatchItem]) -> bool:
+        return self._submit_local(Operation.BATCH, {"operations": operations})
+
+    def import_entries(self, rows: Iterable[ImportRow]) -> tuple[int, list[str]]:
+        """Validates the rows against the local copy and proposes the valid ones as a
+        single batch. Returns the number of entries proposed and the reasons of the rejected rows."""
+        return self._db_local.import_rows(rows, self.submit_batch)
+
+    def export_csv(self, f: TextIO) -> int:
+        return self._db_local.export_csv(f)
+
+    def submit_operation(self, operation: Operation, data: OperationData) -> int | None:
+        """Queues a change proposed by this peer and returns its ticket, or None if the queue is full."""
+        return self._enqueue(operation, data, self.uri)
+
+    def _submit_local(self, operation: Operation, data: OperationData) -> bool:
+        ticket = self.submit_operation(operation, data)
+        if ticket is None:
+            self.print_message("I was unable to proceed with the request because there are too many pending requests")
             return False
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.DELETE_GROUP, {"path": path}, self.uri)
-        self._process_status_code(self._status, True)
-        
+        self.print_message(f"You request is being processed with ticket {ticket}")
         return True
-    
-    def _process_status_code(self, status_code: StatusCode, lock_acquired: bool) -> None:
-        if lock_acquired:
-            self.print_message("You request is being processed")
-        else:
-            match status_code:
-                case StatusCode.FOLLOWER_CHANGE:
-                    self.print_message("I was unable to proceed with the request because someone is trying to join the database")
-                case StatusCode.DATABASE_CHANGE:
-                    self.print_message("I was unable to proceed with the request because there is already a pending request")
-                case StatusCode.FREE:
-                    self.print_message("I was unable to proceed with the request but the database should be free, try again")
+
+    def _submit_remote(self, operation: Operation, data: OperationData, uri: str) -> tuple[ReturnCode, StatusCode, int | None]:
+        ticket = self._enqueue(operation, data, uri)
+        return_code = ReturnCode.ERROR if ticket is None else ReturnCode.OK
+        return (return_code, self._current_status(), ticket)
+
+    def _enqueue(self, operation: Operation, data: OperationData, uri: str) -> int | None:
+        """Queues a change proposal and returns its ticket, or None if the queue is full."""
+        with self._queue_lock:
+            if len(self._waiting) >= self._ctx.config.max_queued_proposals:
+                return None
+            self._next_sequence += 1
+            proposal = Proposal(self._next_sequence, operation, data, uri, operation_paths(operation, data))
+            self._waiting.append(proposal)
+            self._set_ticket(proposal.sequence, ProposalStatus.QUEUED)
+            self._dispatch()
+            return proposal.sequence
+
+    def _dispatch(self) -> None:
+        """Starts the queued proposals that don't conflict with a running one or with an older
+        queued one, so conflicting changes are voted and applied in sequence order.
+        Must be called while holding the queue lock."""
+        if self._blocked is not None:
+            return
+        skipped = []
+        for proposal in list(self._waiting):
+            if len(self._running) >= self._ctx.config.max_concurrent_ballots:
+                break
+            if any(paths_conflict(proposal.paths, other.paths) for other in [*self._running.values(), *skipped]):
+                skipped.append(proposal)
+                continue
+            self._waiting.remove(proposal)
+            self._running[proposal.sequence] = proposal
+            self._set_ticket(proposal.sequence, ProposalStatus.VOTING)
+            self._ctx.scheduler.submit(self._queue_key, partial(self._start_ballot, proposal))
+
+    def _held_proposals(self) -> int:
+        """Proposals queued but not started yet, reported with the depth of the scheduler queue."""
+        with self._queue_lock:
+            return len(self._waiting)
+
+    def _finish_proposal(self, proposal: Proposal, status: ProposalStatus) -> None:
+        with self._queue_cond:
+            if self._running.pop(proposal.sequence, None) is None:
+                return # failed when the database was closed
+            self._set_ticket(proposal.sequence, status)
+            self._queue_cond.notify_all()
+            self._dispatch()
+
+    def _set_ticket(self, sequence: int, status: ProposalStatus) -> None:
+        """Must be called while holding the queue lock."""
+        self._tickets[sequence] = status
+        while len(self._tickets) > TICKETS_HISTORY:
+            self._tickets.popitem(last=False)
+
+    def _block_proposals(self, status: StatusCode, timeout: float | None) -> bool:
+        """Stops new ballots from starting and waits for the running ones to end.
+        Returns False if the running ballots didn't end before the timeout."""
+        deadline = None if timeout is None else time() + timeout
+        with self._queue_cond:
+            if not self._queue_cond.wait_for(lambda: self._blocked is None, timeout):
+                return False
+            self._blocked = status
+            remaining = None if deadline is None else max(0, deadline - time())
+            if not self._queue_cond.wait_for(lambda: not self._running, remaining):
+                self._blocked = None
+                self._queue_cond.notify_all()
+                self._dispatch()
+                return False
+            return True
+
+    def _unblock_proposals(self) -> None:
+        with self._queue_cond:
+            self._blocked = None
+            self._queue_cond.notify_all()
+            self._dispatch()
+
+    def _current_status(self) -> StatusCode:
+        with self._queue_lock:
+            if self._blocked is not None:
+                return self._blocked
+            return StatusCode.DATABASE_CHANGE if self._running or self._waiting else StatusCode.FREE
+
+    def get_request_status(self, ticket: int) -> ProposalStatus | None:
+        """Returns the status of a proposal, or None if the ticket is unknown or too old."""
+        with self._queue_lock:
+            return self._tickets.get(ticket)
+
+    def wait_request(self, ticket: int, timeout: float | None = None) -> ProposalStatus | None:
+        """Waits until a proposal is approved, denied or failed and returns its status,
+        which is still pending if the timeout expires first."""
+        pending = (ProposalStatus.QUEUED, ProposalStatus.VOTING)
+        with self._queue_cond:
+            self._queue_cond.wait_for(lambda: self._tickets.get(ticket) not in pending, timeout)
+            return self._tickets.get(ticket)
+
+    @expose
+    def proposal_status(self, ticket: int) -> ProposalStatus | None:
+        if not self._cn_check():
+            return None
+        return self.get_request_status(ticket)
     
     @expose
-    def login(self, password: str, uri: str) -> tuple[ReturnCode, StatusCode]:
-        """Check if the client knows the password. This allows to modify the shared database"""
-        if not self._operation_lock.acquire(timeout=5):
-            return (ReturnCode.ERROR, self._status)
-
-        self._status = StatusCode.FOLLOWER_CHANGE
+    def login(self, password: str, uri: str, log_id: str | None = None, last_index: int | None = None) -> tuple[ReturnCode, StatusCode]:
+        """Check if the client knows the password. This allows to modify the shared database.
+        A returning follower passes its log position to receive only the changes it missed."""
+        if not self._block_proposals(StatusCode.FOLLOWER_CHANGE, timeout=5):
+            return (ReturnCode.ERROR, self._current_status())
+        try:
+            return self._login(password, uri, log_id, last_index)
+        finally:
+            self._unblock_proposals()
 
+    def _login(self, password: str, uri: str, log_id: str | None, last_index: int | None) -> tuple[ReturnCode, StatusCode]:
         if not password == self.get_password():
-            return (ReturnCode.ERROR, self._status)
+            return (ReturnCode.ERROR, self._current_status())
         
         caller_cn = self._get_caller_cn()
-        client_uri = URI(uri)
-        proxy = Proxy(client_uri)
 
+        joined = False
         try:
-            proxy._pyroBind()
             unique_id = uuid4().int
-            dead_followers = set()
-            has_failure = False
-
-            with open(self.get_filename(), "rb") as f:
-                db_data = f.read()
-            if not proxy.receive_db(db_data):
-                return (ReturnCode.ERROR, self._status)
-            with self._followers_lock:
-                uris_ids_snapshot = self._followers_id.copy() # Because other threads might modify the dictionary while I iterate.
-                uris_cns_snapshot = self._followers_cn.copy()
-            if not proxy.receive_uris(uris_ids_snapshot, uris_cns_snapshot):
-                return (ReturnCode.ERROR, self._status)
-            if not proxy.set_unique_id(unique_id):
-                return (ReturnCode.ERROR, self._status)
-            proxy._pyroRelease()
-
-            # Inform the followers that a new one is joining.
-            with self._followers_lock:
-                uris_snapshot = list(self._followers_cn.keys())
-            for follower_uri in uris_snapshot:
-                with Proxy(URI(follower_uri)) as follower_proxy:
-                    follower_proxy._pyroTimeout = 5.0 # Wait at most 5 seconds to establish a connection, 
-                                                      # otherwise the follower is overwhelmed with connections and can't respond.
-                    try:
-                        if not follower_proxy.add_uri(uri, unique_id, caller_cn):
-                            has_failure = True
-                    except (CommunicationError, NamingError, PyroError):
-                        dead_followers.add(follower_uri)
-            
-            self._followers_cleanup(dead_followers)
+            with self._ctx.connection(uri, timeout=None) as proxy:
+                proxy._pyroBind()
+                base_index, entries = self._log.last_index, None
+                if log_id is not None and log_id == self._log.log_id and last_index is not None:
+                    base_index, entries = last_index, self._log.suffix(last_index)
+                if entries is None:
+                    # New follower or log compacted past its position: it needs the whole database.
+                    base_index, entries = self._log.last_index, []
+                    self.flush() # The follower must receive every change already applied in memory.
+                    if not send_snapshot(proxy, self.get_filename(), self._ctx.config.snapshot_chunk_size, self._ctx.config.snapshot_compression):
+                        return (ReturnCode.ERROR, self._current_status())
+                if not proxy.receive_log(self._log.log_id, base_index, entries):
+                    return (ReturnCode.ERROR, self._current_status())
+                if not proxy.set_unique_id(unique_id):
+                    return (ReturnCode.ERROR, self._current_status())
+                with self._followers_lock:
+                    self._followers_cn[uri] = caller_cn
+                    self._followers_id[uri] = unique_id
+                    self._replica_index[uri] = base_index + len(entries)
+                    self._member_epochs[uri] = UNKNOWN_EPOCH
+                    self._membership.join(uri, unique_id, caller_cn)
+                joined = True
+                # The new follower receives the whole view now, the others learn about it with the next heartbeat.
+                if not self._gossip(uri, proxy):
+                    self._followers_cleanup({uri})
+                    return (ReturnCode.ERROR, self._current_status())
 
         except (CommunicationError, NamingError, PyroError):
-            return (ReturnCode.ERROR, self._status)
-            
-        with self._followers_lock:
-            self._followers_cn[uri] = caller_cn
-            self._followers_id[uri] = unique_id
-        self._status = StatusCode.FREE
-        self._operation_lock.release()
-    
-        if has_failure:
-            self.print_message(f"A client was added to database {self.get_name()} but some of the followers couldn't add them")
-        else:
-            self.print_message(f"A client was added to database {self.get_name()}")
+            if joined:
+                self._followers_cleanup({uri})
+            return (ReturnCode.ERROR, self._current_status())
 
-        return (ReturnCode.OK, self._status)
+        self._watch_follower(uri)
+        self.print_message(f"A client was added to database {self.get_name()}")
+        return (ReturnCode.OK, self._current_status())
     
     @expose
-    def propose_add_entry(self, destination_group: list[str], title: str, username: str, passwd: str, uri: str) -> tuple[ReturnCode, StatusCode]:
+    def reader_login(self, password: str, uri: str) -> tuple[ReturnCode, str | None]:
+        """Lets a thin client read the database through the leader, returns the name of the database."""
+        if not password == self.get_password():
+            return (ReturnCode.ERROR, None)
+        with self._followers_lock:
+            self._readers[uri] = self._get_caller_cn()
+        self.print_message(f"A thin client connected to database {self.get_name()}")
+        return (ReturnCode.OK, self.get_name())
+
+    @expose
+    @oneway
+    def reader_logout(self, uri: str) -> None:
+        with self._followers_lock:
+            if self._readers.get(uri) == self._get_caller_cn():
+                del self._readers[uri]
+
+    # The reads return the index of the last change applied to the local copy too, taken
+    # before reading it: a thin client doesn't cache an answer older than an invalidation
+    # it already received. The index of the log can't be used, it grows before the apply.
+
+    @expose
+    def read_list_entries(self, group_path: list[str] | None, prefix: str, offset: int, limit: int) -> tuple[int, list[EntrySummary] | None]:
+        if not self._reader_check():
+            return (0, None)
+        applied_index = self._applied_index
+        return (applied_index, self._db_local.list_entries(group_path, prefix, offset, limit))
+
+    @expose
+    def read_list_groups(self, group_path: list[str] | None, prefix: str, offset: int, limit: int) -> tuple[int, list[list[str]] | None]:
+        if not self._reader_check():
+            return (0, None)
+        applied_index = self._applied_index
+        return (applied_index, self._db_local.list_groups(group_path, prefix, offset, limit))
+
+    @expose
+    def read_search_entries(self, query: str, limit: int) -> tuple[int, list[SearchResult] | None]:
+        if not self._reader_check():
+            return (0, None)
+        applied_index = self._applied_index
+        return (applied_index, self._db_local.search_entries(query, limit))
+
+    @expose
+    def read_entry(self, entry_path: list[str]) -> tuple[int, EntryData | None]:
+        if not self._reader_check():
+            return (0, None)
+        applied_index = self._applied_index
+        return (applied_index, self._db_local.get_entry(entry_path))
+
+    def _reader_check(self) -> bool:
+        """Checks if the caller is a follower or a thin client"""
+        client_cn = self._get_caller_cn()
+        with self._followers_lock:
+            return client_cn in self._followers_cn.values() or client_cn in self._readers.values()
+
+    def _invalidate_readers(self, log_index: int, paths: list[tuple[str, ...]]) -> None:
+        """Tells the thin clients which paths a committed change touched, so they drop
+        the cached answers that could be stale. The unreachable ones are forgotten."""
+        with self._followers_lock:
+            readers = list(self._readers)
+        if not readers:
+            return
+        results = self._ctx.broadcast(readers, lambda reader_proxy: reader_proxy.invalidate(log_index, paths))
+        with self._followers_lock:
+            for reader_uri, result in results.items():
+                if isinstance(result, PyroError):
+                    self._readers.pop(reader_uri, None)
+
+    @expose
+    def propose_add_entry(self, destination_group: list[str], title: str, username: str, passwd: str, uri: str) -> tuple[ReturnCode, StatusCode, int | None]:
         if not self._cn_check():
-            return (ReturnCode.ERROR, self._status)
-        
-        if not self._operation_lock.acquire(timeout=5):
-            return (ReturnCode.ERROR, self._status)
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.ADD_ENTRY, {"destination_group": destination_group, "title": title, "username": username, "passwd": passwd}, uri)
-        return (ReturnCode.OK, self._status)
+            return (ReturnCode.ERROR, self._current_status(), None)
+        return self._submit_remote(Operation.ADD_ENTRY, {"destination_group": destination_group, "title": title, "username": username, "passwd": passwd}, uri)
     
     @expose
-    def propose_add_group(self, parent_group: list[str], group_name: str, uri: str) -> tuple[ReturnCode, StatusCode]:
+    def propose_add_group(self, parent_group: list[str], group_name: str, uri: str) -> tuple[ReturnCode, StatusCode, int | None]:
         if not self._cn_check():
-            return (ReturnCode.ERROR, self._status)
-
-        if not self._operation_lock.acquire(timeout=5):
-            return (ReturnCode.ERROR, self._status)
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.ADD_GROUP, {"parent_group": parent_group, "group_name": group_name}, uri)
-        return (ReturnCode.OK, self._status)
+            return (ReturnCode.ERROR, self._current_status(), None)
+        return self._submit_remote(Operation.ADD_GROUP, {"parent_group": parent_group, "group_name": group_name}, uri)
 
     @expose
-    def propose_delete_entry(self, entry_path: list[str], uri: str) -> tuple[ReturnCode, StatusCode]:
+    def propose_delete_entry(self, entry_path: list[str], uri: str) -> tuple[ReturnCode, StatusCode, int | None]:
         if not self._cn_check():
-            return (ReturnCode.ERROR, self._status)
-
-        if not self._operation_lock.acquire(timeout=5):
-            return (ReturnCode.ERROR, self._status)
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.DELETE_ENTRY, {"entry_path": entry_path}, uri)
-        return (ReturnCode.OK, self._status)
+            return (ReturnCode.ERROR, self._current_status(), None)
+        return self._submit_remote(Operation.DELETE_ENTRY, {"entry_path": entry_path}, uri)
 
     @expose
-    def propose_delete_group(self, path: list[str], uri: str) -> tuple[ReturnCode, StatusCode]:
+    def propose_delete_group(self, path: list[str], uri: str) -> tuple[ReturnCode, StatusCode, int | None]:
         if not self._cn_check():
-            return (ReturnCode.ERROR, self._status)
+            return (ReturnCode.ERROR, self._current_status(), None)
+        return self._submit_remote(Operation.DELETE_GROUP, {"path": path}, uri)
 
-        if not self._operation_lock.acquire(timeout=5):
-            return (ReturnCode.ERROR, self._status)
-        
-        self._status = StatusCode.DATABASE_CHANGE
-        self._executor.submit(self.propose_change, Operation.DELETE_GROUP, {"path": path}, uri)
-        return (ReturnCode.OK, self._status)
+    @expose
+    def propose_batch(self, operations: list[BatchItem], uri: str) -> tuple[ReturnCode, StatusCode, int | None]:
+        if not self._cn_check():
+            return (ReturnCode.ERROR, self._current_status(), None)
+        return self._submit_remote(Operation.BATCH, {"operations": operations}, uri)
     
-    def propose_change(self, operation: Operation, data: OperationData, uri: str) -> None:
-        notification_message = ""
-        match operation:
-            case Operation.ADD_ENTRY:
-                notification_message = f"Entry addition titled {data["username"]} with username {data["username"]} and password {data["passwd"]} in path {'/'.join(data["destination_group"])}"
-            case Operation.ADD_GROUP:
-                notification_message = f"Group addition named {data["group_name"]} in parent group {'/'.join(data["parent_group"])}"
-            case Operation.DELETE_ENTRY:
-                notification_message = f"Entity elimination with path {'/'.join(data["entry_path"])}"
-            case Operation.DELETE_GROUP:
-                notification_message = f"Group elimination with path {'/'.join(data["path"])}"
-            case _:
-                with Proxy(URI(uri)) as proxy:
-                    proxy._pyroTimeout = 5.0
-                    proxy.remote_print_message("The specified operation is not supported")
-                    self._operation_lock.release()
-                    return
-                
+    def _start_ballot(self, proposal: Proposal) -> None:
+        """First step of a proposal: notifies the peers and opens the ballot. No worker waits
+        for the votes, the ballot is closed by the vote deciding it or at its deadline."""
+        # Every remote call made for the proposal carries its ID, so the spans of all the peers can be merged.
         proposition_id = uuid4().int
-        with self._vote_lock:
-            self._current_proposition = {
-                        "votes": [True],
-                        "voters": {uri},
-                        "deadlines": {},
-                        "proposition_id": proposition_id
-                    }
+        try:
+            with trace_context(proposal_trace_id(proposition_id)):
+                if self._open_ballot(proposal, proposition_id):
+                    return
+        except Exception as e:
+            print(e)
+        self._finish_proposal(proposal, ProposalStatus.FAILED)
+
+    def _open_ballot(self, proposal: Proposal, proposition_id: int) -> bool:
+        operation, data, uri = proposal.operation, proposal.data, proposal.uri
+        notification_message = describe_operation(operation, data)
+        if notification_message is None:
+            with self._ctx.connection(uri) as proxy:
+                proxy.remote_print_message("The specified operation is not supported")
+            return False
+
         with self._followers_lock:
-            followers_uris = (follower_uri for follower_uri in self._followers_cn.keys() if follower_uri != uri)
+            followers_uris = [follower_uri for follower_uri in self._followers_cn.keys() if follower_uri != uri]
+            electorate = len(self._followers_cn) + 1 # followers + leader
+        deadline = time() + self._ctx.config.ballot_timeout
+        proposition = {
+                    "votes": [True],
+                    "voters": {uri},
+                    "deadlines": {follower_uri: deadline for follower_uri in followers_uris},
+                    "proposition_id": proposition_id,
+                    "electorate": electorate,
+                    # The decision is approved if at least the ceiling half the followers + leader has approved the change.
+                    # - ( (-n1) // n2) is a trick to perform a ceiling division instead of a floor division.
+                    "quorum": -((-electorate) // 2),
+                    "started": time(),
+                    "proposal": proposal,
+                    "message": notification_message,
+                    "open": False, # the votes can't close the ballot until all the peers have been notified
+                    "closing": False,
+                    "timer": None,
+                }
+        with self._vote_lock:
+            self._propositions[proposition_id] = proposition
 
-        for follower_uri in followers_uris:
-            with Proxy(URI(follower_uri)) as follower_proxy:
-                follower_proxy._pyroTimeout = 5.0 # Wait at most 5 seconds to establish a connection, 
-                                                  # otherwise the follower is overwhelmed with connections and can't respond.
-                try:
-                    follower_proxy._pyroBind()
-                    with self._vote_lock:
-                        deadline = time() + 30
-                        self._current_proposition["deadlines"][follower_uri] = deadline
-                    follower_proxy.add_notification(notification_message, deadline, proposition_id)
-                except (CommunicationError, NamingError, PyroError):
-                    self.print_message(f"A follower was unreachable during a change proposition for database {self.get_name()}")
-                except Exception as e:
-                    print(e)
+        def notify(follower_proxy: Proxy) -> None:
+            follower_proxy._pyroBind()
+            follower_proxy.add_notification(notification_message, deadline, proposition_id)
+
+        with metrics.time("broadcast_duration_seconds", {"phase": "notify"}, "Time spent contacting all the followers"), tracer.span("notify"):
+            notify_results = self._ctx.broadcast(followers_uris, notify)
+        for result in notify_results.values():
+            if isinstance(result, PyroError):
+                self.print_message(f"A follower was unreachable during a change proposition for database {self.get_name()}")
+            elif isinstance(result, Exception):
+                print(result)
 
         if uri != self.uri:
-            deadline = time() + 30
+            deadline = time() + self._ctx.config.ballot_timeout
             with self._vote_lock:
-                self._current_proposition["deadlines"][self.uri] = deadline
+                proposition["deadlines"][self.uri] = deadline
             self.add_notification(notification_message, deadline, proposition_id)
-        
-        sleep(30) # Wait for answers
 
-        # The decision is approved if at least the ceiling half the followers + leader has approved the change.
-        # - ( (-n1) // n2) is a trick to perform a ceiling division instead of a floor division.
-        decision = True if sum(self._current_proposition["votes"]) >= -( (-(len(self._followers_cn)+1)) // 2) else False
+        # The ballot is closed as soon as the outcome can't change anymore, or when the voting deadline expires.
+        with self._vote_lock:
+            proposition["open"] = True
+            if self._ballot_decided(proposition):
+                self._schedule_close(proposition)
+            else:
+                proposition["timer"] = self._ctx.scheduler.call_at(deadline, self._queue_key, partial(self._close_ballot, proposition_id))
+        return True
+
+    def _schedule_close(self, proposition: dict) -> None:
+        """Must be called while holding the vote lock."""
+        if proposition["closing"]:
+            return
+        proposition["closing"] = True
+        if proposition["timer"] is not None:
+            proposition["timer"].cancel()
+        self._ctx.scheduler.submit(self._queue_key, partial(self._close_ballot, proposition["proposition_id"]))
+
+    def _close_ballot(self, proposition_id: int) -> None:
+        """Last step of a proposal: counts the votes and applies the approved change."""
+        with self._vote_lock:
+            proposition = self._propositions.pop(proposition_id, None)
+        if proposition is None:
+            return # already closed by a vote or by the database closing
+        proposal = proposition["proposal"]
+        status = ProposalStatus.FAILED
+        try:
+            with trace_context(proposal_trace_id(proposition_id)):
+                tracer.record("vote", proposition["started"], time() - proposition["started"])
+                status = self._decide(proposition)
+                tracer.record("proposal", proposition["started"], time() - proposition["started"],
+                              operation=Operation(proposal.operation).value, proposer=proposal.uri)
+        except Exception as e:
+            print(e)
+        finally:
+            self._finish_proposal(proposal, status)
+
+    def _decide(self, proposition: dict) -> ProposalStatus:
+        proposal = proposition["proposal"]
+        operation, data = proposal.operation, proposal.data
+        notification_message = proposition["message"]
+        # The ballot is closed, no vote can change it anymore.
+        decision = sum(proposition["votes"]) >= proposition["quorum"]
+        approvals = sum(proposition["votes"])
+        rejections = len(proposition["votes"]) - approvals
+        metrics.observe("ballot_duration_seconds", time() - proposition["started"], help="Time from the start of a ballot to its outcome")
+        metrics.inc("ballot_votes_total", {"vote": "approve"}, approvals, "Votes cast on the change proposals")
+        metrics.inc("ballot_votes_total", {"vote": "reject"}, rejections)
+        metrics.inc("ballots_total", {"outcome": "approved" if decision else "denied"}, help="Ballots ended, by outcome")
         decision_message_template = f"Database change \'{notification_message}\' has been "
         decision_message = decision_message_template + "approved" if decision else decision_message_template + "denied"
 
         with self._followers_lock:
             uris_snapshot = list(self._followers_cn.keys()) # Because other threads might modify the dictionary while I iterate.
-        for follower_uri in uris_snapshot:
-            with Proxy(URI(follower_uri)) as follower_proxy:
-                follower_proxy._pyroTimeout = 5.0 # Wait at most 5 seconds to establish a connection, 
-                                                  # otherwise the follower is overwhelmed with connections and can't respond.
-                try:
-                    follower_proxy.remote_print_message(decision_message)
-                except (CommunicationError, NamingError, PyroError):
-                    pass
-                except Exception as e:
-                    print(e)
+        with metrics.time("broadcast_duration_seconds", {"phase": "decision"}), tracer.span("decision", approved=decision):
+            decision_results = self._ctx.broadcast(uris_snapshot, lambda follower_proxy: follower_proxy.remote_print_message(decision_message))
+        for result in decision_results.values():
+            if isinstance(result, Exception) and not isinstance(result, PyroError):
+                print(result)
         
         self.print_message(decision_message)
 
@@ -309,33 +530,39 @@ class DBExpose(DBInterface):
                 case Operation.DELETE_GROUP:
                     follower_method = "remote_delete_group"
                     leader_method = "local_delete_group"
-
-            with self._followers_lock:
-                uris_snapshot = list(self._followers_cn.keys())
-            for follower_uri in uris_snapshot:
-                with Proxy(URI(follower_uri)) as follower_proxy:
-                    follower_proxy._pyroTimeout = 5.0 # Wait at most 5 seconds to establish a connection, 
-                                                      # otherwise the follower is overwhelmed with connections and can't respond.
-                    try:
-                        method = getattr(follower_proxy, follower_method)
-                        method(data)
-                    except (CommunicationError, NamingError, PyroError):
+                case Operation.BATCH:
+                    follower_method = "remote_batch"
+                    leader_method = "local_batch"
+
+            with self._apply_lock:
+                entry = self._log.append(operation, data)
+                with self._followers_lock:
+                    uris_snapshot = list(self._followers_cn.keys())
+                with metrics.time("broadcast_duration_seconds", {"phase": "apply"}), tracer.span("apply", log_index=entry["index"]):
+                    results = self._ctx.broadcast(uris_snapshot, lambda follower_proxy: getattr(follower_proxy, follower_method)(data, entry["index"]))
+                for follower_uri, result in results.items():
+                    if isinstance(result, PyroError):
                         dead_followers.add(follower_uri)
-                    except AttributeError:
+                    elif isinstance(result, AttributeError):
                         self.print_message("I tried to call a method that doesn't exist on the client")
+                with self._followers_lock:
+                    for follower_uri, result in results.items():
+                        if not isinstance(result, Exception) and follower_uri in self._followers_cn:
+                            self._replica_index[follower_uri] = entry["index"]
 
-            try:
-                method = getattr(self, leader_method)
-                method(data)
-            except AttributeError:
-                self.print_message("I tried to call a method that doesn't exist on the leader")
+                try:
+                    method = getattr(self, leader_method)
+                    with tracer.span("apply_local"):
+                        method(data)
+                except AttributeError:
+                    self.print_message("I tried to call a method that doesn't exist on the leader")
+                self._applied_index = entry["index"]
+                # Only after the local apply, so a read served in the meantime is invalidated too.
+                self._invalidate_readers(entry["index"], operation_paths(operation, data))
 
             self._followers_cleanup(dead_followers)
 
-        self._status = StatusCode.FREE
-        with self._vote_lock:
-            self._current_proposition = None
-        self._operation_lock.release()
+        return ProposalStatus.APPROVED if decision else ProposalStatus.DENIED
 
     def local_add_entry(self, data: OperationData) -> None:
         # Add a try catch because the approved change could raise an exception if ill-formed
@@ -366,6 +593,13 @@ class DBExpose(DBInterface):
         except Exception:
             self.print_message(f"An error occured while trying to delete a group of database {self.get_name()}")
 
+    def local_batch(self, data: OperationData) -> None:
+        try:
+            self._db_local.submit_batch(data["operations"])
+            self.print_message(f"A batch of {len(data["operations"])} changes was applied to database {self.get_name()}")
+        except Exception:
+            self.print_message(f"An error occured while trying to apply a batch of changes to database {self.get_name()}, none of them was applied")
+
     @expose
     @oneway
     def leave_database(self) -> None:
@@ -374,56 +608,68 @@ class DBExpose(DBInterface):
         cn_name = self._get_caller_cn()
         with self._followers_lock:
             uri = next((k for k, v in self._followers_cn.items() if v == cn_name), None)
-            removed = False
-            try:
-                del self._followers_cn[uri]
-                del self._followers_id[uri]
-                removed = True
-            except AttributeError:
-                pass
-            if removed:
-                self.print_message("A follower has left the database")
-            uri_set = {uri} # Need to adapt the URI into a set because that's what the remove method requires.
-            dead_followers = set()
-            for follower_uri in self._followers_cn:
-                with Proxy(URI(follower_uri)) as follower_proxy:
-                    follower_proxy._pyroTimeout = 5.0 # Wait at most 5 seconds to establish a connection,
-                                                        # otherwise the follower is overwhelmed with connections and can't respond.
-                    try:
-                        follower_proxy.remove_uris(uri_set)
-                    except (CommunicationError, NamingError, PyroError):
-                        dead_followers.add(follower_uri)
+        # The other followers learn about it through the gossip carried by the heartbeats.
+        if uri is not None and self._remove_followers({uri}, MemberStatus.LEFT):
+            self.print_message("A follower has left the database")
 
-        self._followers_cleanup(dead_followers)
+    def _watch_follower(self, uri: str) -> None:
+        """Monitors a follower with heartbeats that carry the membership changes it doesn't know yet."""
+        self._ctx.watch_peer(uri, self._suspect_follower, lambda proxy: self._gossip(uri, proxy))
 
+    def _gossip(self, uri: str, proxy: Proxy) -> bool:
+        """Sends to a follower the membership changes that followed the last epoch it
+        acknowledged. An answer refutes the suspicion on the follower, if any."""
+        with self._followers_lock:
+            known_epoch = self._member_epochs.get(uri)
+        if known_epoch is None:
+            return False # removed in the meantime
+        follower_epoch = proxy.gossip(*self._membership.changes_since(known_epoch))
+        if follower_epoch is None:
+            return False
+        with self._followers_lock:
+            if uri in self._member_epochs:
+                self._member_epochs[uri] = follower_epoch
+        if self._membership.refute(uri):
+            self.print_message(f"A suspected follower of database {self.get_name()} is answering again")
+        return True
+
+    def _suspect_follower(self, uri: str) -> None:
+        """Called by the heartbeat monitor when a follower stops answering. The suspicion
+        is gossiped to the other followers and the follower is removed only if it doesn't
+        answer before the suspicion timeout."""
+        if not self._membership.suspect(uri):
+            return
+        self.print_message(f"A follower of database {self.get_name()} stopped answering the heartbeats")
+        self._ctx.watch_peer(uri, self._evict_follower, lambda proxy: self._gossip(uri, proxy))
+        timer = Timer(self._ctx.config.suspicion_timeout, self._confirm_suspicion, args=(uri,))
+        timer.daemon = True
+        timer.start()
+
+    def _confirm_suspicion(self, uri: str) -> None:
+        if self._membership.status(uri) == MemberStatus.SUSPECT:
+            self._evict_follower(uri)
+
+    def _evict_follower(self, uri: str) -> None:
+        self._followers_cleanup({uri})
 
     def _followers_cleanup(self, dead_followers: set[str]) -> None:
-        # Cleanup dead followers.
-        while len(dead_followers) > 0:
-            new_dead_followers = set() # Other followers could stop responding, so we delete them too.
-                                        # The loop will eventually end because in the worst case every follower is removed.
-            removed = False
-            with self._followers_lock:
-                for dead_follower in dead_followers:
-                    try:
-                        del self._followers_cn[dead_follower]
-                        del self._followers_id[dead_follower]
-                        removed = True
-                    except KeyError:
-                        pass
-                if removed:
-                    self.print_message(f"Dead followers were removed from database {self.get_name()}")
-
-                uris_snapshot = list(self._followers_cn.keys())
-            for follower_uri in uris_snapshot:
-                    with Proxy(URI(follower_uri)) as follower_proxy:
-                        follower_proxy._pyroTimeout = 5.0
-                        try:
-                            follower_proxy.remove_uris(dead_followers)
-                        except (CommunicationError, NamingError, PyroError):
-                            new_dead_followers.add(follower_uri)
-
-            dead_followers = new_dead_followers
+        # The removal is gossiped with the next heartbeats instead of being sent to every follower now.
+        if self._remove_followers(dead_followers, MemberStatus.DEAD):
+            self.print_message(f"Dead followers were removed from database {self.get_name()}")
+
+    def _remove_followers(self, uris: set[str], status: MemberStatus) -> bool:
+        """Returns True if at least one of the followers was still in the database."""
+        removed = False
+        with self._followers_lock:
+            for uri in uris:
+                self._replica_index.pop(uri, None)
+                self._member_epochs.pop(uri, None)
+                self._ctx.unwatch_peer(uri)
+                self._membership.remove(uri, status)
+                if self._followers_cn.pop(uri, None) is not None:
+                    self._followers_id.pop(uri, None)
+                    removed = True
+        return removed
 
     def _cn_check(self) -> bool:
         """Checks if the client that is making a call has a common name in the allowed list"""
@@ -441,19 +687,37 @@ class DBExpose(DBInterface):
     def cast_vote(self, vote: bool, uri: str, proposition_id: int) -> bool:
         if not self._cn_check():
             return False
+        return self._record_vote(vote, uri, proposition_id)
+
+    def _record_vote(self, vote: bool, uri: str, proposition_id: int) -> bool:
+        """Counts a vote, closing the ballot if it decides the outcome."""
         with self._vote_lock:
+            proposition = self._propositions.get(proposition_id)
             if (
-                not self._current_proposition
-                or self._current_proposition["proposition_id"] != proposition_id
-                or uri in self._current_proposition["voters"]
-                or time() > self._current_proposition["deadlines"][uri]
+                not proposition
+                or uri in proposition["voters"]
+                or time() > proposition["deadlines"].get(uri, 0)
             ):
                 return False
 
-            self._current_proposition["voters"].add(uri)
-            self._current_proposition["votes"].append(vote)
+            proposition["voters"].add(uri)
+            proposition["votes"].append(vote)
+            if proposition["open"] and self._ballot_decided(proposition):
+                self._schedule_close(proposition)
+        metrics.observe("vote_delay_seconds", time() - proposition["started"], help="Time from the start of a ballot to each vote")
         return True
     
+    def _ballot_decided(self, proposition: dict) -> bool:
+        """Checks if the proposition has reached a majority of approvals, if enough
+        rejections make the approval impossible or if everyone has voted. Must be called while
+        holding the vote lock."""
+        votes = proposition["votes"]
+        approvals = sum(votes)
+        rejections = len(votes) - approvals
+        electorate = proposition["electorate"]
+        quorum = proposition["quorum"]
+        return approvals >= quorum or electorate - rejections < quorum or len(votes) >= electorate
+
     @expose
     def ping(self) -> bool:
         with self._leader_lock:
@@ -463,41 +727,59 @@ class DBExpose(DBInterface):
         self.print_message("I'm notifying the followers of your decision")
         with self._leader_lock:
             self._is_leader = False
+        self._abort_ballots()
         with self._followers_lock:
             uris_snapshot = list(self._followers_cn.keys())
         for follower_uri in uris_snapshot:
-            try:
-                with Proxy(follower_uri) as proxy:
-                    proxy._pyroTimeout = 5.0
-                    proxy.start_election()
-            except (CommunicationError, NamingError, PyroError):
-                continue
-            except Exception as e:
-                print(e)
-                continue
+            self._ctx.unwatch_peer(follower_uri)
+        for result in self._ctx.broadcast(uris_snapshot, lambda proxy: proxy.start_election()).values():
+            if isinstance(result, Exception) and not isinstance(result, PyroError):
+                print(result)
+        # The thin clients aren't members, they look for the new leader by themselves.
+        with self._followers_lock:
+            readers, self._readers = list(self._readers), {}
+        self._ctx.broadcast(readers, lambda reader_proxy: reader_proxy.leader_closed())
         return self._db_local
     
+    def _abort_ballots(self) -> None:
+        """Fails the queued and running proposals of a database that is no longer exposed
+        and frees its queue in the scheduler."""
+        self._ctx.scheduler.remove_queue(self._queue_key)
+        with self._vote_lock:
+            timers = [proposition["timer"] for proposition in self._propositions.values() if proposition["timer"] is not None]
+            self._propositions.clear()
+        for timer in timers:
+            timer.cancel()
+        with self._queue_cond:
+            self._blocked = StatusCode.DATABASE_CHANGE # the database is closing, no ballot starts anymore
+            for proposal in [*self._waiting, *self._running.values()]:
+                self._set_ticket(proposal.sequence, ProposalStatus.FAILED)
+            self._waiting.clear()
+            self._running.clear()
+            self._queue_cond.notify_all()
+
     def add_notification(self, message: str, timestamp: float, proposition_id: int) -> None:
         notification_message = f"- {message} for database {self.get_name()}"
         self._ctx.add_notification(Notification(notification_message, timestamp, proposition_id, self.local_id))
         self.print_message(f"A new notification regarding database {self.get_name()} was added!")
 
     def answer_notification(self, vote: bool, notification: Notification) -> bool:
-        with self._vote_lock:
-            if (
-                not self._current_proposition
-                or self._current_proposition["proposition_id"] != notification.proposition_id
-                or self.uri in self._current_proposition["voters"]
-                or time() > self._current_proposition["deadlines"][self.uri]
-            ):
-                return False
-
-            self._current_proposition["voters"].add(self.uri)
-            self._current_proposition["votes"].append(vote)
-        return True
+        return self._record_vote(vote, self.uri, notification.proposition_id)
     
     def print_message(self, message: str) -> None:
         self._ctx.print_message(message)
+
+    def flush(self) -> None:
+        self._db_local.flush()
+
+    def get_log_position(self) -> tuple[str, int]:
+        """Returns the ID of the operation log and the index of its last entry."""
+        return (self._log.log_id, self._log.last_index)
+
+    def get_replica_positions(self) -> dict[str, int]:
+        """Returns the index of the last log entry sent to each follower."""
+        with self._followers_lock:
+            return self._replica_index.copy()
     
     def unregister_object(self) -> None:
         self._ctx.daemon.unregister(self)
@@ -511,8 +793,14 @@ class DBExpose(DBInterface):
     def get_filename(self) -> str:
         return self._db_local.get_filename()
     
-    def get_entries(self) -> list[Entry]:
-        return self._db_local.get_entries()
-    
-    def get_groups(self) -> list[Group]:
-        return self._db_local.get_groups()
+    def list_entries(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[EntrySummary]:
+        return self._db_local.list_entries(group_path, prefix, offset, limit)
+
+    def list_groups(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[list[str]]:
+        return self._db_local.list_groups(group_path, prefix, offset, limit)
+
+    def search_entries(self, query: str, limit: int = 20) -> list[SearchResult]:
+        return self._db_local.search_entries(query, limit)
+
+    def get_entry_password(self, entry_path: list[str]) -> str | None:
+        return self._db_local.get_entry_password(entry_path)
@@ -1,19 +1,24 @@
-from typing import Self
-from threading import Lock
-from time import sleep
-from base64 import b64decode
-from time import time, sleep
+from typing import Self, TextIO
+from collections.abc import Iterable
+from threading import Condition, Lock, Thread
+from time import monotonic, time
+from uuid import uuid4
 from Pyro5.core import URI
 from Pyro5.server import expose, oneway
 from Pyro5.api import Proxy, current_context
 from Pyro5.errors import CommunicationError, NamingError, PyroError
-from pykeepass import Entry, Group
+from pykeepass.exceptions import CredentialsError
 from database.db_interface import DBInterface
 from database.db_local import DBLocal
+from database.bulk_io import ImportRow
 from context.context import ContextApp
-from .db_expose import DBExpose
-from .remote_data_structures import Notification, ReturnCode, StatusCode, OperationData
+from context.metrics import instrument_exposed
+from context.tracing import trace_context, proposal_trace_id
+from .db_expose import DBExpose, UNKNOWN_EPOCH
+from .snapshot_transfer import SnapshotReceiver, send_snapshot, save_log_position, load_log_position
+from .remote_data_structures import EntrySummary, SearchResult, Notification, ReturnCode, StatusCode, Operation, OperationData, BatchItem, ProposalStatus, OperationLog, LogEntry, MembershipView, Member, MemberStatus
 
+@instrument_exposed
 class DBRemote(DBInterface):
 
     def __init__(self, leader_uri_str: str, context: ContextApp) -> None:
@@ -29,14 +34,21 @@ class DBRemote(DBInterface):
         self._db_local = None
         self._followers_ids = {} # dictionary with the URIs and the IDs of the other followers.
         self._followers_cns = {} # dictionary holding the URIs and Common Names of the other followers.
+        self._membership = MembershipView(max_tombstones=context.config.max_membership_tombstones) # copy of the leader view, the dictionaries above derive from it
         self._uri = None
         self._db_path = None
         self._password = None
         self._ctx = context
         self._local_id = None # ID assigned by the context class.
         self._unique_id = None # ID assigned by the leader.
+        self._snapshot = None # snapshot being received from the leader
+        self._log = None # copy of the leader operation log, used to catch up when rejoining or to become the leader
+        self._position_lock = Lock() # Held while a change of the leader is applied and logged, so the saved log position matches the saved file.
+        self._last_gossip = monotonic() # when the leader last sent the membership, it stops once this follower is removed
+        self._rejoin_lock = Lock() # Held while rejoining after an eviction.
         self._election_lock = Lock()
         self._leader_lock = Lock() # Lock used to signal that a leader election is taking place.
+        self._leader_changed = Condition(self._leader_lock) # Signaled when a new leader is accepted.
 
     @property
     def uri(self) -> str | None:
@@ -86,12 +98,16 @@ class DBRemote(DBInterface):
             remote_db.uri = uri
             remote_db._db_path = path
             remote_db._password = password
+            log_id, last_index = remote_db._load_replica()
 
-            return_code, _ = remote_db._leader.login(password, uri)
+            # The join is traced: the leader forwards the trace ID to the calls made to let this peer in.
+            with trace_context(str(uuid4())):
+                return_code, _ = remote_db._leader.login(password, uri, log_id, last_index)
             return_code = ReturnCode(return_code)
             match return_code:
                 case ReturnCode.OK:
                     remote_db.print_message("You have joined the remote database!")
+                    remote_db._watch_leader()
                     return remote_db
                 case ReturnCode.ERROR:
                     remote_db.print_message("An error occured while trying to join the remote database!")
@@ -114,8 +130,8 @@ class DBRemote(DBInterface):
             return False
         try:
             self._leader._pyroClaimOwnership()
-            return_code, status_code = self._leader.propose_add_entry(destination_group, title, username, passwd, self.uri)
-            return self._process_return_code(return_code, status_code)
+            return_code, status_code, ticket = self._leader.propose_add_entry(destination_group, title, username, passwd, self.uri)
+            return self._process_return_code(return_code, status_code, ticket)
         except (CommunicationError, NamingError, PyroError):
             self.print_message("Error when trying to communicate with the leader!")
             return False
@@ -125,8 +141,8 @@ class DBRemote(DBInterface):
             return False
         try:
             self._leader._pyroClaimOwnership()
-            return_code, status_code = self._leader.propose_add_group(parent_group, group_name, self.uri)
-            return self._process_return_code(return_code, status_code)
+            return_code, status_code, ticket = self._leader.propose_add_group(parent_group, group_name, self.uri)
+            return self._process_return_code(return_code, status_code, ticket)
         except (CommunicationError, NamingError, PyroError):
             self.print_message("Error when trying to communicate with the leader!")
             return False
@@ -136,8 +152,8 @@ class DBRemote(DBInterface):
             return False
         try:
             self._leader._pyroClaimOwnership()
-            return_code, status_code = self._leader.propose_delete_entry(entry_path, self.uri)
-            return self._process_return_code(return_code, status_code)
+            return_code, status_code, ticket = self._leader.propose_delete_entry(entry_path, self.uri)
+            return self._process_return_code(return_code, status_code, ticket)
         except (CommunicationError, NamingError, PyroError):
             self.print_message("Error when trying to communicate with the leader!")
             return False
@@ -147,23 +163,42 @@ class DBRemote(DBInterface):
             return False
         try:
             self._leader._pyroClaimOwnership()
-            return_code, status_code = self._leader.propose_delete_group(path, self.uri)
-            return self._process_return_code(return_code, status_code)
+            return_code, status_code, ticket = self._leader.propose_delete_group(path, self.uri)
+            return self._process_return_code(return_code, status_code, ticket)
         except (CommunicationError, NamingError, PyroError):
             self.print_message("Error when trying to communicate with the leader!")
             return False
     
-    def _process_return_code(self, return_code: ReturnCode, status_code: StatusCode) -> bool:
+    def submit_batch(self, operations: list[BatchItem]) -> bool:
+        if self._election_lock.locked():
+            return False
+        try:
+            self._leader._pyroClaimOwnership()
+            return_code, status_code, ticket = self._leader.propose_batch(operations, self.uri)
+            return self._process_return_code(return_code, status_code, ticket)
+        except (CommunicationError, NamingError, PyroError):
+            self.print_message("Error when trying to communicate with the leader!")
+            return False
+    
+    def import_entries(self, rows: Iterable[ImportRow]) -> tuple[int, list[str]]:
+        """Validates the rows against the local copy and proposes the valid ones as a
+        single batch. Returns the number of entries proposed and the reasons of the rejected rows."""
+        return self._db_local.import_rows(rows, self.submit_batch)
+
+    def export_csv(self, f: TextIO) -> int:
+        return self._db_local.export_csv(f)
+
+    def _process_return_code(self, return_code: ReturnCode, status_code: StatusCode, ticket: int | None) -> bool:
         return_code = ReturnCode(return_code)
         status_code = StatusCode(status_code)
         match return_code:
             case ReturnCode.OK:
-                self.print_message("The request is being processed by the leader")
+                self.print_message(f"The request is being processed by the leader with ticket {ticket}")
                 return True
             case ReturnCode.ERROR:
                 match status_code:
                     case StatusCode.DATABASE_CHANGE:
-                        self.print_message("There is already a request being processed")
+                        self.print_message("There are too many requests waiting to be processed")
                     case StatusCode.FOLLOWER_CHANGE:
                         self.print_message("Someone is trying to join the database")
                     case StatusCode.FREE:
@@ -174,45 +209,58 @@ class DBRemote(DBInterface):
                 return False
     
     @expose
-    def add_uri(self, uri: str, unique_id: int, cn: str) -> bool:
-        if not self._cn_check():
-            return False
-        
-        self._followers_ids[uri] = unique_id
-        self._followers_cns[uri] = cn
-        self.print_message(f"A new follower was added to database {self.get_name()}")
-        return True
-    
-    @expose
-    def remove_uris(self, uris: set[str]) -> bool:
+    def gossip(self, epoch: int, members: list[Member], reset: bool) -> int | None:
+        """Heartbeat of the leader carrying the membership changes this follower
+        doesn't know yet. Returns the epoch of the view reached, None if refused."""
         if not self._cn_check():
-            return False
-        
-        before_len = len(self._followers_ids)
-        for uri in uris:
-            self._followers_ids.pop(uri, None)
-            self._followers_cns.pop(uri, None)
-        if before_len != len(self._followers_ids):
+            return None
+        self._last_gossip = monotonic()
+        if not members and not reset:
+            return self._membership.apply(epoch, [], False)
+        members = [Member({**member, "status": MemberStatus(member["status"])}) for member in members]
+        before = set(self._followers_ids)
+        reached_epoch = self._membership.apply(epoch, members, reset)
+        alive = {uri: member for uri, member in self._membership.members().items() if uri != self.uri}
+        # New dictionaries are assigned at once, so an election in progress never sees a half updated view.
+        self._followers_ids = {uri: member["unique_id"] for uri, member in alive.items()}
+        self._followers_cns = {uri: member["cn"] for uri, member in alive.items()}
+        if set(alive) - before:
+            self.print_message(f"A new follower was added to database {self.get_name()}")
+        if before - set(alive):
             self.print_message(f"Some followers were removed from the database {self.get_name()}")
-        return True
-    
+        return reached_epoch
+
     @expose
-    def receive_uris(self, ids: dict[str, int], cns: dict[str, int]) -> bool:
+    def begin_snapshot(self, digest: str, size: int) -> int:
+        """Prepares to receive a copy of the database and returns the offset from
+        which the leader has to send it."""
         if not self._cn_check():
-            return False
-        self._followers_ids = ids
-        self._followers_cns = cns
-        return True
+            return -1
+        if self._snapshot is not None and self._snapshot.digest != digest:
+            self._snapshot.discard()
+        if self._snapshot is None or self._snapshot.digest != digest:
+            self._snapshot = SnapshotReceiver(self._db_path, digest, size)
+        return self._snapshot.offset
 
     @expose
-    def receive_db(self, db_data: bytes) -> bool:
-        if not self._cn_check():
+    def receive_snapshot_chunk(self, digest: str, offset: int, chunk: bytes, compressed: bool) -> int:
+        if not self._cn_check() or self._snapshot is None or self._snapshot.digest != digest:
+            return -1
+        return self._snapshot.write(offset, chunk, compressed)
+
+    @expose
+    def commit_snapshot(self, digest: str) -> bool:
+        if not self._cn_check() or self._snapshot is None or self._snapshot.digest != digest:
             return False
         
-        decoded_data = b64decode(db_data["data"])
-        with open(self._db_path, "wb") as f:
-            f.write(decoded_data)
-        self._db_local = DBLocal(self._db_path, self._password)
+        if self._db_local is not None:
+            # Pending group commits of the old copy must not overwrite the snapshot later on.
+            self._db_local.flush()
+        snapshot, self._snapshot = self._snapshot, None
+        if not snapshot.commit():
+            self.print_message("A corrupted copy of the database was received and discarded")
+            return False
+        self._db_local = DBLocal(self._db_path, self._password, self._ctx.config.write_behind)
         if self.local_id:
             self._db_local.local_id = self.local_id
         return True
@@ -242,228 +290,383 @@ class DBRemote(DBInterface):
         self.print_message(f"A new notification regarding database {self.get_name()} was added!")
 
     @expose
-    def remote_add_entry(self, data: OperationData) -> bool:
+    def remote_add_entry(self, data: OperationData, log_index: int | None = None) -> bool:
         if not self._cn_check():
             return False
-        try:
-            self._db_local.add_entry(data["destination_group"], data["title"], data["username"], data["passwd"])
-            self.print_message(f"A new entry was added to database {self.get_name()}")
-        except Exception:
-            self.print_message(f"An error occured while trying to add a new entry to database {self.get_name()}")
-            return False
+        with self._position_lock:
+            try:
+                self._db_local.add_entry(data["destination_group"], data["title"], data["username"], data["passwd"])
+                self.print_message(f"A new entry was added to database {self.get_name()}")
+            except Exception:
+                self.print_message(f"An error occured while trying to add a new entry to database {self.get_name()}")
+                return False
+            finally:
+                self._record_operation(Operation.ADD_ENTRY, data, log_index)
         return True
     
     @expose
-    def remote_add_group(self, data: OperationData) -> bool:
+    def remote_add_group(self, data: OperationData, log_index: int | None = None) -> bool:
         if not self._cn_check():
             return False
-        try:
-            self._db_local.add_group(data["parent_group"], data["group_name"])
-            self.print_message(f"A new group was added to database {self.get_name()}")
-        except Exception:
-            self.print_message(f"An error occured while trying to add a new group to database {self.get_name()}")
-            return False
+        with self._position_lock:
+            try:
+                self._db_local.add_group(data["parent_group"], data["group_name"])
+                self.print_message(f"A new group was added to database {self.get_name()}")
+            except Exception:
+                self.print_message(f"An error occured while trying to add a new group to database {self.get_name()}")
+                return False
+            finally:
+                self._record_operation(Operation.ADD_GROUP, data, log_index)
         return True
     
     @expose
-    def remote_delete_entry(self, data: OperationData) -> bool:
+    def remote_delete_entry(self, data: OperationData, log_index: int | None = None) -> bool:
         if not self._cn_check():
             return False
-        try:
-            self._db_local.delete_entry(data["entry_path"])
-            self.print_message(f"An entry was deleted from database {self.get_name()}")
-        except Exception:
-            self.print_message(f"An error occured while trying to delete an entry of database {self.get_name()}")
+        with self._position_lock:
+            try:
+                self._db_local.delete_entry(data["entry_path"])
+                self.print_message(f"An entry was deleted from database {self.get_name()}")
+            except Exception:
+                self.print_message(f"An error occured while trying to delete an entry of database {self.get_name()}")
+            finally:
+                self._record_operation(Operation.DELETE_ENTRY, data, log_index)
         return True
     
     @expose
-    def remote_delete_group(self, data: OperationData) -> bool:
+    def remote_delete_group(self, data: OperationData, log_index: int | None = None) -> bool:
         if not self._cn_check():
             return False
-        try:
-            self._db_local.delete_group(data["path"])
-            self.print_message(f"A group was deleted from database {self.get_name()}")
-        except Exception:
-            self.print_message(f"An error occured while trying to delete a group of database {self.get_name()}")
+        with self._position_lock:
+            try:
+                self._db_local.delete_group(data["path"])
+                self.print_message(f"A group was deleted from database {self.get_name()}")
+            except Exception:
+                self.print_message(f"An error occured while trying to delete a group of database {self.get_name()}")
+            finally:
+                self._record_operation(Operation.DELETE_GROUP, data, log_index)
+        return True
+
+    @expose
+    def remote_batch(self, data: OperationData, log_index: int | None = None) -> bool:
+        if not self._cn_check():
+            return False
+        with self._position_lock:
+            try:
+                self._db_local.submit_batch(data["operations"])
+                self.print_message(f"A batch of {len(data["operations"])} changes was applied to database {self.get_name()}")
+            except Exception:
+                self.print_message(f"An error occured while trying to apply a batch of changes to database {self.get_name()}, none of them was applied")
+                return False
+            finally:
+                self._record_operation(Operation.BATCH, data, log_index)
         return True
     
+    def _record_operation(self, operation: Operation, data: OperationData, log_index: int | None) -> None:
+        """Copies in the local log an operation applied by the leader, even if it failed
+        here: it failed on the leader as well, so the copies are still the same."""
+        if log_index is not None and self._log is not None:
+            self._log.record(LogEntry(index=log_index, operation=operation, data=data))
+
     @expose
-    @oneway
-    def start_election(self) -> None:
-        # Only start election if the leader URI is still set and the leader is unreachable or responds negatively to the ping.
-        with self._leader_lock:
-            if self.leader_uri:
+    def receive_log(self, log_id: str, base_index: int, entries: list[LogEntry]) -> bool:
+        """Applies the log entries that follow base_index. Without entries, the local
+        database is in the state of the leader at base_index, e.g. after a snapshot."""
+        if not self._cn_check():
+            return False
+
+        if self._log is None or self._log.log_id != log_id or self._log.last_index != base_index:
+            if entries:
+                return False
+            self._log = OperationLog(log_id, self._ctx.config.max_log_entries, base_index)
+            return True
+
+        with self._position_lock, self._db_local.batch():
+            for entry in entries:
                 try:
-                    self._leader._pyroClaimOwnership()
-                    self._leader._pyroTimeout = 5.0
-                    if self._leader.ping():
-                        self._leader._pyroTimeout = None
-                        return
-                except (CommunicationError, NamingError, PyroError):
-                    pass 
-                except Exception as e:
-                    print(e)
-                    return
+                    self._db_local.apply_operation(Operation(entry["operation"]), entry["data"])
+                except Exception:
+                    pass # the operation failed on the leader too
+                self._log.record(entry)
+        if entries:
+            self.print_message(f"{len(entries)} missed changes were applied to database {self.get_name()}")
+        return True
+
+    @expose
+    def get_log_position(self) -> tuple[str | None, int | None]:
+        """Returns the ID of the local copy of the log and the index of its last entry."""
+        if not self._cn_check() or self._log is None:
+            return (None, None)
+        return (self._log.log_id, self._log.last_index)
+
+    def _load_replica(self) -> tuple[str | None, int | None]:
+        """Opens the copy left by a previous connection to the database, if its log position
+        was saved with it, and returns that position: the leader then sends only the changes
+        made in the meantime, or the whole database if they are no longer in its log."""
+        position = load_log_position(self._db_path)
+        if position is None:
+            return (None, None)
+        try:
+            self._db_local = DBLocal(self._db_path, self._password, self._ctx.config.write_behind)
+        except CredentialsError:
+            return (None, None)
+        log_id, last_index = position
+        self._log = OperationLog(log_id, self._ctx.config.max_log_entries, last_index)
+        return position
 
+    def _save_log_position(self) -> None:
+        """Saves the local copy and, next to it, the position of the log it reached."""
+        with self._position_lock:
+            self._db_local.flush()
+            if self._log is not None and self._log.log_id is not None:
+                save_log_position(self.get_filename(), self._log.log_id, self._log.last_index)
 
+    def rejoin(self) -> bool:
+        """Logs in again to the leader after being removed from its followers. If the
+        leader still has the changes missed in the meantime, only those are received."""
+        log_id, last_index = (self._log.log_id, self._log.last_index) if self._log is not None else (None, None)
+        previous_id = self._unique_id
+        self._unique_id = None # the leader assigns a new one
+        try:
+            self._leader._pyroClaimOwnership()
+            with trace_context(str(uuid4())):
+                return_code, _ = self._leader.login(self._password, self.uri, log_id, last_index)
+            return_code = ReturnCode(return_code)
+        except (CommunicationError, NamingError, PyroError):
+            return_code = ReturnCode.ERROR
+        if self._unique_id is None:
+            self._unique_id = previous_id
+        if return_code != ReturnCode.OK:
+            self.print_message(f"Unable to rejoin database {self.get_name()}")
+            return False
+        self._watch_leader()
+        return True
+
+    def _watch_leader(self) -> None:
+        self._ctx.watch_peer(self.leader_uri, self._on_leader_suspected, self._probe_leader)
+
+    def _probe_leader(self, leader_proxy: Proxy) -> bool:
+        """Heartbeat sent to the leader. If the leader answers but hasn't gossiped for
+        longer than the maximum silence, it removed this follower, e.g. after missing
+        its heartbeats for a while: the database is joined again in the background."""
+        alive = leader_proxy.ping()
+        silence = monotonic() - self._last_gossip
+        if alive and silence > self._ctx.config.heartbeat_max_silence and not self._election_lock.locked() and self._rejoin_lock.acquire(blocking=False):
+            Thread(target=self._rejoin_evicted, daemon=True, name="rejoin").start()
+        return alive
+
+    def _rejoin_evicted(self) -> None:
+        try:
+            self.print_message(f"The leader of database {self.get_name()} removed you from its followers, joining it again")
+            self.rejoin()
+        finally:
+            self._last_gossip = monotonic() # a failed attempt is retried after another silence
+            self._rejoin_lock.release()
+
+    def _on_leader_suspected(self, leader_uri: str) -> None:
+        """Called by the heartbeat monitor when the leader stops answering."""
+        if leader_uri == self.leader_uri:
+            self.print_message(f"The leader of database {self.get_name()} stopped answering the heartbeats")
+            self.start_election()
+
+    @expose
+    @oneway
+    def start_election(self) -> None:
         if not self._election_lock.acquire(blocking=False):
-            # Election already started.
+            # Election already started: the heartbeats, the closing leader and the lower followers can all ask for one.
             return
-        
-        self.print_message(f"Starting leader election for database {self.get_name()}")
+
+        # Only start election if the leader is unreachable or responds negatively to the ping.
+        old_leader_uri = self.leader_uri
+        if old_leader_uri is not None and self._leader_alive():
+            self._election_lock.release()
+            return
+
         with self._leader_lock:
+            if self.leader_uri != old_leader_uri:
+                # A new leader was announced in the meantime.
+                self._election_lock.release()
+                return
+            self.print_message(f"Starting leader election for database {self.get_name()}")
             self._ctx.unregister_ignored_service(self.leader_uri)
+            self._ctx.unwatch_peer(self.leader_uri)
             self.leader_uri = None
             self._leader = None
             self._leader_cn = None
-        tries_number = 5 # Number of times to try to elect a leader, after that the db disconnects.
+        tries_number = self._ctx.config.election_rounds # Number of times to try to elect a leader, after that the db disconnects.
         dead_followers = set()
         while tries_number > 0:
             # Exclude followers with an ID lower than mine and that were unable to answer in the previous rounds.
             higher_follower_uris = [follower_uri for (follower_uri, follower_id) in self._followers_ids.items() if ((follower_uri not in dead_followers) and (follower_id > self.unique_id))]
+
+            def probe(follower_proxy: Proxy) -> bool:
+                alive = follower_proxy.ping()
+                follower_proxy.start_election()
+                return alive
+
+            # Probing the higher nodes all at once.
             got_response = False
-            for follower_uri in higher_follower_uris:
-                # Probing the higher nodes.
-                with Proxy(URI(follower_uri)) as follower_proxy:
-                    follower_proxy._pyroTimeout = 5.0 # Wait at most 5 seconds to establish a connection, 
-                                                # otherwise the follower is overwhelmed with connections and can't respond.
-                    try:
-                        if follower_proxy.ping():
-                            got_response = True
-                        follower_proxy.start_election()
-                    except (CommunicationError, NamingError, PyroError):
-                        dead_followers.add(follower_uri)
-                    except Exception as e:
-                        print(e)
-
-            if got_response:
-                # Wait for the new leader message.
-                self.print_message(f"A new leader should be announced shortly for database {self.get_name()}")
-                start = time()
-                # Wait for at most a minute before redoing the probing.
-                while time() - start < 60:
-                    with self._leader_lock:
-                        if self.leader_uri is not None:
-                            self._election_lock.release()
-                            self.print_message(f"A new leader has been elected for database {self.get_name()}")
-                            return
-                    sleep(5)
-                tries_number -= 1
-
-            else:
+            for follower_uri, result in self._ctx.broadcast(higher_follower_uris, probe).items():
+                if isinstance(result, Exception):
+                    dead_followers.add(follower_uri)
+                elif result:
+                    got_response = True
+
+            if not got_response:
                 # No higher node responded so I am the new leader.
-                expose_db = DBExpose.create_and_register(self._db_local, self._ctx)
-                expose_db._operation_lock.acquire() # This will be useful if someone tries to start an operation while the leader election process hasn't ended for all the followers.
-                expose_db._status = StatusCode.DATABASE_CHANGE
-                new_dead_followers = set()
-                with open(self.get_filename(), "rb") as f:
-                    db_data = f.read()
-                if len(dead_followers) > 0:
-                    self.print_message("Dead followers were removed during the leader election process")
-                expose_db._followers_cn = {follower_uri:follower_cn for (follower_uri, follower_cn) in self._followers_cns.items() if follower_uri not in dead_followers}
-                expose_db._followers_id = {follower_uri:follower_id for (follower_uri, follower_id) in self._followers_ids.items() if follower_uri not in dead_followers}
-                dead_followers.add(self.uri) # Up until now we were followers like the others, so we need to remove our URI from their dictionaries.
-                for follower_uri in expose_db._followers_cn:
-                    # Probing the higher nodes.
-                    with Proxy(URI(follower_uri)) as follower_proxy:
-                        follower_proxy._pyroTimeout = 5.0
-                        try:
-                            if not follower_proxy.new_leader(self.unique_id, expose_db.uri):
-                                new_dead_followers.add(follower_uri)
-                            if not follower_proxy.receive_db(db_data):
-                                new_dead_followers.add(follower_uri)
-                            if not follower_proxy.remove_uris(dead_followers):
-                                new_dead_followers.add(follower_uri)
-                        except (CommunicationError, NamingError, PyroError):
-                            new_dead_followers.add(follower_uri)
-                        except Exception as e:
-                            print(e)
-
-                # Clean up eventual nodes that disconnected during the new leader declaration.
-                dead_followers = new_dead_followers
-                while len(dead_followers) > 0:
-                    new_dead_followers = set()
-                    removed = False
-                    with expose_db._followers_lock:
-                        for dead_follower in dead_followers:
-                            try:
-                                del expose_db._followers_cn[dead_follower]
-                                del expose_db._followers_id[dead_follower]
-                                removed = True
-                            except KeyError:
-                                pass
-                        if removed:
-                            expose_db.print_message(f"Dead followers were removed from database {self.get_name()}")
-                        uris_snapshot = list(expose_db._followers_cn.keys())
-
-                    for follower_uri in uris_snapshot:
-                        with Proxy(URI(follower_uri)) as follower_proxy:
-                            follower_proxy._pyroTimeout = 5.0
-                            try:
-                                follower_proxy.remove_uris(dead_followers)
-                            except (CommunicationError, NamingError, PyroError):
-                                new_dead_followers.add(follower_uri)
-
-                    dead_followers = new_dead_followers
-
-                self._ctx.daemon.unregister(self)
-                expose_db._status = StatusCode.FREE
-                expose_db._operation_lock.release()
-                self._ctx.register_ignored_service(expose_db.uri)
-                self._ctx.register_uri(expose_db.get_name(), expose_db.uri)
-                try:
-                    expose_db.local_id = self.local_id
-                    expose_db._db_local.local_id = self.local_id
-                except AttributeError:
-                    pass
-                self._ctx.replace_database(expose_db.local_id, expose_db)
+                self._become_leader(dead_followers)
+                return
+
+            # Wait for the new leader message, which wakes this thread up as soon as it arrives.
+            self.print_message(f"A new leader should be announced shortly for database {self.get_name()}")
+            with self._leader_changed:
+                elected = self._leader_changed.wait_for(lambda: self.leader_uri is not None, timeout=self._ctx.config.election_timeout)
+            if elected:
                 self._election_lock.release()
-                self.print_message(f"You became the new leader for database {self.get_name()}")
+                self.print_message(f"A new leader has been elected for database {self.get_name()}")
                 return
+            tries_number -= 1
 
+        self._election_lock.release()
         self.print_message(f"The leader election process failed. Database {self.get_name()} will be disconnected")
-        self._ctx.replace_database(self.local_id, self._db_local) 
+        self._ctx.replace_database(self.local_id, self._db_local)
 
-    @expose
-    def new_leader(self, unique_id: int, leader_uri: str) -> bool:
-        # Accept someone as the leader if an election is taking place and if their ID is bigger than yours.
-        # These controls are used to prevent a random rogue follower from becoming the leader for a follower.
-        if self._election_lock.locked() and unique_id > self.unique_id:
-            # Try to connect with the new leader. If a connection cannot be established, continue with the leader election.
-            leader_proxy = Proxy(URI(leader_uri))
+    def _leader_alive(self) -> bool:
+        """Pings the current leader, which answers False if it is closing the database."""
+        with self._leader_lock:
+            if self._leader is None:
+                return False
             try:
-                leader_proxy._pyroBind()
-                with self._leader_lock:
-                    self._leader_uri = leader_uri
-                    self._leader = leader_proxy
-                    self._ctx.register_ignored_service(leader_uri)
-                cert = current_context.client.getpeercert()
-                subject = dict(x[0] for x in cert["subject"])
-                self._leader_cn = subject.get("commonName")
-                return True
-            except (ConnectionError, NamingError, PyroError):
+                self._leader._pyroClaimOwnership()
+                self._leader._pyroTimeout = self._ctx.config.heartbeat_timeout
+                alive = self._leader.ping()
+                self._leader._pyroTimeout = None
+                return alive
+            except (CommunicationError, NamingError, PyroError):
+                return False
+
+    def _become_leader(self, dead_followers: set[str]) -> None:
+        """Exposes the local copy of the database and announces it to the other followers in parallel.
+        Must be called while holding the election lock, which is released at the end."""
+        # Up until now we were followers like the others, so our URI leaves the view of the followers.
+        self._membership.remove(self.uri, MemberStatus.LEFT)
+        for dead_follower in dead_followers:
+            self._membership.remove(dead_follower, MemberStatus.DEAD)
+        expose_db = DBExpose.create_and_register(self._db_local, self._ctx, self._log, self._membership)
+        expose_db._block_proposals(StatusCode.DATABASE_CHANGE, None) # This will be useful if someone tries to start an operation while the leader election process hasn't ended for all the followers.
+        self.flush() # The followers without the missed changes in the log must receive every change applied in memory.
+        if len(dead_followers) > 0:
+            self.print_message("Dead followers were removed during the leader election process")
+        expose_db._followers_cn = {follower_uri:follower_cn for (follower_uri, follower_cn) in self._followers_cns.items() if follower_uri not in dead_followers}
+        expose_db._followers_id = {follower_uri:follower_id for (follower_uri, follower_id) in self._followers_ids.items() if follower_uri not in dead_followers}
+        # The views of the followers may be ahead of ours, with changes of the old leader we never received, so they are all replaced.
+        expose_db._member_epochs = {follower_uri: UNKNOWN_EPOCH for follower_uri in expose_db._followers_cn}
+
+        def announce(follower_proxy: Proxy) -> bool:
+            if not follower_proxy.new_leader(self.unique_id, expose_db.uri, self.uri):
                 return False
-        return False
-            
+            # Send only the changes the follower missed, or the whole database if they aren't in the log.
+            log_id, last_index = expose_db.get_log_position()
+            follower_log_id, follower_index = follower_proxy.get_log_position()
+            entries = expose_db._log.suffix(follower_index) if follower_log_id == log_id and follower_index is not None else None
+            if entries is None:
+                if not send_snapshot(follower_proxy, self.get_filename(), self._ctx.config.snapshot_chunk_size, self._ctx.config.snapshot_compression):
+                    return False
+                follower_index, entries = last_index, []
+            if not follower_proxy.receive_log(log_id, follower_index, entries):
+                return False
+            follower_uri = str(follower_proxy._pyroUri)
+            with expose_db._followers_lock:
+                expose_db._replica_index[follower_uri] = follower_index + len(entries)
+            return expose_db._gossip(follower_uri, follower_proxy)
+
+        results = self._ctx.broadcast(list(expose_db._followers_cn), announce)
+        for result in results.values():
+            if isinstance(result, Exception) and not isinstance(result, PyroError):
+                print(result)
+        # Clean up eventual nodes that disconnected or refused the new leader during the declaration.
+        new_dead_followers = {follower_uri for follower_uri, result in results.items() if result is not True}
+        expose_db._followers_cleanup(new_dead_followers)
+
+        for follower_uri in list(expose_db._followers_cn):
+            expose_db._watch_follower(follower_uri)
+        self._ctx.daemon.unregister(self)
+        expose_db._unblock_proposals()
+        self._ctx.register_ignored_service(expose_db.uri)
+        self._ctx.register_uri(expose_db.get_name(), expose_db.uri)
+        try:
+            expose_db.local_id = self.local_id
+            expose_db._db_local.local_id = self.local_id
+        except AttributeError:
+            pass
+        self._ctx.replace_database(expose_db.local_id, expose_db)
+        self._election_lock.release()
+        self.print_message(f"You became the new leader for database {self.get_name()}")
+
+    @expose
+    def new_leader(self, unique_id: int, leader_uri: str, member_uri: str) -> bool:
+        # Accept someone as the leader if their ID is bigger than yours and an election is taking place,
+        # or the current leader is gone but this follower didn't notice yet.
+        # These controls are used to prevent a random rogue follower from becoming the leader for a follower.
+        if unique_id <= self.unique_id:
+            return False
+        # The caller must be a follower known from the last gossip, with the same ID and certificate. It announces the
+        # URI it was a follower with, since the URI of the database it now exposes was never a member.
+        caller_cn = self._get_caller_cn()
+        if member_uri not in self._followers_cns or caller_cn != self._followers_cns[member_uri] or unique_id != self._followers_ids.get(member_uri):
+            return False
+        if not self._election_lock.locked() and self.leader_uri is not None and self._leader_alive():
+            return False
+        # Try to connect with the new leader. If a connection cannot be established, continue with the leader election.
+        leader_proxy = Proxy(URI(leader_uri))
+        try:
+            leader_proxy._pyroBind()
+        except (ConnectionError, NamingError, PyroError):
+            return False
+        with self._leader_changed:
+            if self.leader_uri is not None:
+                self._ctx.unregister_ignored_service(self.leader_uri)
+                self._ctx.unwatch_peer(self.leader_uri)
+            self._leader_uri = leader_uri
+            self._leader = leader_proxy
+            self._leader_cn = caller_cn
+            self._last_gossip = monotonic() # the new leader gossips right after the announcement
+            self._ctx.register_ignored_service(leader_uri)
+            self._watch_leader()
+            self._leader_changed.notify_all()
+        return True
 
     @expose
     def ping(self) -> bool:
         return True
 
+    def get_request_status(self, ticket: int) -> ProposalStatus | None:
+        """Asks the leader the status of a proposal, None if it is unknown or unreachable."""
+        try:
+            self._leader._pyroClaimOwnership()
+            status = self._leader.proposal_status(ticket)
+        except (CommunicationError, NamingError, PyroError):
+            self.print_message("Error when trying to communicate with the leader!")
+            return None
+        return ProposalStatus(status) if status is not None else None
+
     def answer_notification(self, vote: bool, notification: Notification) -> bool:
         if time() > notification.timestamp:
             return False
         self._leader._pyroClaimOwnership()
-        return self._leader.cast_vote(vote, self.uri, notification.proposition_id)
+        with trace_context(proposal_trace_id(notification.proposition_id)):
+            return self._leader.cast_vote(vote, self.uri, notification.proposition_id)
     
     def leave_db(self) -> DBLocal:
+        self._ctx.unwatch_peer(self.leader_uri)
         try:
             self._leader._pyroClaimOwnership()
             self._leader.leave_database()
             self._leader._pyroRelease()
         except (CommunicationError, NamingError, PyroError):
             self.print_message("Error when trying to communicate with the leader!")
-        
+        # Connecting again to the database with this file will only need the changes made until then.
+        self._save_log_position()
         return self._db_local
 
     def _cn_check(self) -> bool:
@@ -479,6 +682,9 @@ class DBRemote(DBInterface):
     
     def set_name(self, name: str) -> None:
         self._db_local.set_name(name)
+
+    def flush(self) -> None:
+        self._save_log_position()
     
     def get_name(self) -> str:
         return self._db_local.get_name()
@@ -489,9 +695,14 @@ class DBRemote(DBInterface):
     def get_filename(self) -> str:
         return self._db_local.get_filename()
     
-    def get_entries(self) -> list[Entry]:
-        return self._db_local.get_entries()
-    
-    def get_groups(self) -> list[Group]:
-        return self._db_local.get_groups()
-    
\ No newline at end of file
+    def list_entries(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[EntrySummary]:
+        return self._db_local.list_entries(group_path, prefix, offset, limit)
+
+    def list_groups(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[list[str]]:
+        return self._db_local.list_groups(group_path, prefix, offset, limit)
+
+    def search_entries(self, query: str, limit: int = 20) -> list[SearchResult]:
+        return self._db_local.search_entries(query, limit)
+
+    def get_entry_password(self, entry_path: list[str]) -> str | None:
+        return self._db_local.get_entry_password(entry_path)
@@ -0,0 +1,285 @@
+import re
+from typing import Self, TextIO
+from collections import OrderedDict
+from collections.abc import Iterable
+from threading import Lock
+from time import monotonic
+from Pyro5.core import URI
+from Pyro5.server import expose, oneway
+from Pyro5.api import Proxy, current_context
+from Pyro5.errors import CommunicationError, NamingError, PyroError
+from database.db_interface import DBInterface
+from database.bulk_io import ImportRow, write_csv
+from context.context import ContextApp
+from context.metrics import metrics, instrument_exposed
+from .remote_data_structures import EntrySummary, EntryData, SearchResult, ReturnCode, ProposalStatus, BatchItem, Notification, paths_conflict
+
+EXPORT_PAGE_SIZE = 256 # entries listed with each remote call of an export
+INSTANCE_SUFFIX = re.compile(r"-\d+$") # added by mDNS to a service name already in use
+
+@instrument_exposed
+class DBThin(DBInterface):
+    """Read-only client of a shared database that keeps no replica: every read is
+    served by the leader, so the database is never downloaded nor decrypted here.
+    The answers are kept in a bounded LRU cache, which the leader invalidates when
+    it commits a change."""
+
+    def __init__(self, leader_uri_str: str, context: ContextApp) -> None:
+        proxy = Proxy(URI(leader_uri_str))
+        proxy._pyroBind() # Forces the connection to the remote object.
+        self._leader = proxy
+        cert = proxy._pyroConnection.sock.getpeercert()
+        subject = dict(x[0] for x in cert["subject"])
+        self._leader_cn = subject.get("commonName")
+        self._leader_uri = leader_uri_str
+        self._ctx = context
+        self._uri = None
+        self._local_id = None # ID assigned by the context class.
+        self._name = None
+        self._password = None
+        self._cache = OrderedDict() # (method, arguments) -> (paths the answer depends on or None for all, expiry, answer)
+        self._cache_lock = Lock()
+        self._valid_from = 0 # log index of the last invalidation, older answers are not cached
+        self._leader_lock = Lock() # The proxy is shared by the threads reading the database.
+        self._leader_closed = False # set by the leader when it stops exposing the database
+
+    @property
+    def uri(self) -> str | None:
+        return self._uri
+
+    @uri.setter
+    def uri(self, value: str) -> None:
+        if self._uri is not None:
+            raise AttributeError("URI has already been set and cannot be modified.")
+        self._uri = value
+
+    @property
+    def local_id(self) -> int | None:
+        return self._local_id
+
+    @local_id.setter
+    def local_id(self, value: int) -> None:
+        if self._local_id is not None:
+            raise AttributeError("Local ID has already been set and cannot be modified.")
+        self._local_id = value
+
+    @property
+    def leader_uri(self) -> str:
+        return self._leader_uri
+
+    @classmethod
+    def create_and_register(cls, leader_uri: str, context: ContextApp, password: str) -> Self | None:
+        thin_db = None
+        try:
+            thin_db = cls(leader_uri, context)
+            thin_db.uri = str(context.daemon.register(thin_db))
+            thin_db._password = password
+            return_code, name = thin_db._leader.reader_login(password, thin_db.uri)
+            if ReturnCode(return_code) != ReturnCode.OK:
+                thin_db.print_message("An error occured while trying to connect to the remote database!")
+                context.daemon.unregister(thin_db)
+                return None
+            thin_db._name = name
+            thin_db.print_message("You are reading the remote database as a thin client!")
+            return thin_db
+        except (CommunicationError, NamingError, PyroError):
+            if thin_db is not None and thin_db.uri:
+                context.daemon.unregister(thin_db)
+            return None
+
+    def _read(self, method: str, args: tuple, paths: list[tuple[str, ...]] | None = None, cached: bool = True) -> object:
+        """Asks the leader, unless the cache holds a fresh answer. An answer that depends
+        only on some paths survives the changes to other paths."""
+        key = (method, repr(args))
+        if cached:
+            with self._cache_lock:
+                item = self._cache.get(key)
+                if item is not None and item[1] > monotonic():
+                    self._cache.move_to_end(key)
+                    metrics.inc("read_cache_total", {"result": "hit"}, help="Reads of the thin clients, by cache result")
+                    return item[2]
+        metrics.inc("read_cache_total", {"result": "miss"})
+        leader_uri = self._leader_uri
+        try:
+            if self._leader_closed:
+                raise CommunicationError("the leader closed the database")
+            log_index, answer = self._ask_leader(method, args)
+        except (CommunicationError, NamingError, PyroError):
+            # The leader closed the database or died: the read is retried once on its successor.
+            try:
+                if not self._find_leader(leader_uri):
+                    self.print_message("Error when trying to communicate with the leader!")
+                    return None
+                log_index, answer = self._ask_leader(method, args)
+            except (CommunicationError, NamingError, PyroError):
+                self.print_message("Error when trying to communicate with the leader!")
+                return None
+        if cached and answer is not None:
+            with self._cache_lock:
+                if log_index >= self._valid_from:
+                    self._cache[key] = (paths, monotonic() + self._ctx.config.read_cache_ttl, answer)
+                    self._cache.move_to_end(key)
+                    while len(self._cache) > self._ctx.config.read_cache_entries:
+                        self._cache.popitem(last=False)
+        return answer
+
+    def _ask_leader(self, method: str, args: tuple) -> tuple[int, object]:
+        with self._leader_lock:
+            self._leader._pyroClaimOwnership()
+            return getattr(self._leader, method)(*args)
+
+    def _find_leader(self, failed_uri: str) -> bool:
+        """Looks for the new leader of the database among the advertised services and
+        logs in to it as a reader. The cache is emptied: the invalidations of the old leader are lost.
+        The connections are made without holding the leader lock, so the other reads don't
+        wait for them, and the lock is taken only to swap the proxy."""
+        if self._leader_uri != failed_uri:
+            return True # another reader already moved to the new leader
+        base_name = INSTANCE_SUFFIX.sub("", self._name or "")
+        for service_name, (uri, _, _) in self._ctx.get_services_information(base_name):
+            if uri == failed_uri or INSTANCE_SUFFIX.sub("", service_name.split(".")[0]) != base_name:
+                continue
+            try:
+                proxy = Proxy(URI(uri))
+                proxy._pyroBind()
+                cert = proxy._pyroConnection.sock.getpeercert()
+                return_code, _ = proxy.reader_login(self._password, self.uri)
+            except (CommunicationError, NamingError, PyroError):
+                continue
+            if ReturnCode(return_code) != ReturnCode.OK:
+                proxy._pyroRelease()
+                continue
+            with self._leader_lock:
+                if self._leader_uri != failed_uri:
+                    proxy._pyroRelease() # another reader moved in the meantime, its login is the one kept
+                    return True
+                self._leader._pyroClaimOwnership()
+                self._leader._pyroRelease()
+                self._leader = proxy
+                self._leader_cn = dict(x[0] for x in cert["subject"]).get("commonName")
+                self._leader_uri = uri
+                self._leader_closed = False
+                with self._cache_lock:
+                    self._cache.clear()
+                    self._valid_from = 0
+            self._ctx.unregister_ignored_service(failed_uri)
+            self._ctx.register_ignored_service(uri)
+            self.print_message(f"The thin client of database {self._name} moved to the new leader")
+            return True
+        return False
+
+    @expose
+    @oneway
+    def invalidate(self, log_index: int, paths: list[list[str]]) -> None:
+        """Called by the leader after committing a change that touched the paths."""
+        if not self._cn_check():
+            return
+        paths = [tuple(path) for path in paths]
+        with self._cache_lock:
+            self._valid_from = max(self._valid_from, log_index)
+            stale = [key for key, (key_paths, _, _) in self._cache.items() if key_paths is None or paths_conflict(key_paths, paths)]
+            for key in stale:
+                del self._cache[key]
+
+    @expose
+    @oneway
+    def leader_closed(self) -> None:
+        """Called by the leader when it stops exposing the database: the cached answers
+        could miss the changes of the next leader, and the next read looks for it."""
+        if not self._cn_check():
+            return
+        with self._cache_lock:
+            self._cache.clear()
+        self._leader_closed = True
+
+    def list_entries(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[EntrySummary]:
+        return self._read("read_list_entries", (group_path, prefix, offset, limit)) or []
+
+    def list_groups(self, group_path: list[str] | None = None, prefix: str = "", offset: int = 0, limit: int = 50) -> list[list[str]]:
+        return self._read("read_list_groups", (group_path, prefix, offset, limit)) or []
+
+    def search_entries(self, query: str, limit: int = 20) -> list[SearchResult]:
+        return self._read("read_search_entries", (query, limit)) or []
+
+    def get_entry(self, entry_path: list[str]) -> EntryData | None:
+        return self._read("read_entry", (entry_path,), [tuple(entry_path)])
+
+    def get_entry_password(self, entry_path: list[str]) -> str | None:
+        entry = self.get_entry(entry_path)
+        return entry["passwd"] if entry is not None else None
+
+    def export_csv(self, f: TextIO) -> int:
+        """Writes the entries page by page, bypassing the cache so an export doesn't evict it."""
+        def rows() -> Iterable[ImportRow]:
+            offset = 0
+            while page := self._read("read_list_entries", (None, "", offset, EXPORT_PAGE_SIZE), cached=False):
+                for summary in page:
+                    entry = self._read("read_entry", (summary["path"],), cached=False)
+                    if entry is not None:
+                        yield ImportRow(group=entry["path"][:-1], title=entry["title"], username=entry["username"], passwd=entry["passwd"])
+                offset += EXPORT_PAGE_SIZE
+        return write_csv(rows(), f)
+
+    def _read_only(self) -> bool:
+        self.print_message("A thin client can only read the database, join it with a full copy to change it")
+        return False
+
+    def add_entry(self, destination_group: list[str], title: str, username: str, passwd: str) -> bool:
+        return self._read_only()
+
+    def add_group(self, parent_group: list[str], group_name: str) -> bool:
+        return self._read_only()
+
+    def delete_entry(self, entry_path: list[str]) -> bool:
+        return self._read_only()
+
+    def delete_group(self, path: list[str]) -> bool:
+        return self._read_only()
+
+    def submit_batch(self, operations: list[BatchItem]) -> bool:
+        return self._read_only()
+
+    def import_entries(self, rows: Iterable[ImportRow]) -> tuple[int, list[str]]:
+        self._read_only()
+        return (0, [])
+
+    def get_request_status(self, ticket: int) -> ProposalStatus | None:
+        return None # a thin client doesn't propose changes
+
+    def answer_notification(self, vote: bool, notification: Notification) -> bool:
+        return False # a thin client doesn't vote
+
+    def leave(self) -> None:
+        try:
+            with self._leader_lock:
+                self._leader._pyroClaimOwnership()
+                self._leader.reader_logout(self.uri)
+                self._leader._pyroRelease()
+        except (CommunicationError, NamingError, PyroError):
+            self.print_message("Error when trying to communicate with the leader!")
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _cn_check(self) -> bool:
+        """Checks if the caller is the leader"""
+        cert = current_context.client.getpeercert()
+        subject = dict(x[0] for x in cert["subject"])
+        return subject.get("commonName") == self._leader_cn
+
+    def print_message(self, message: str) -> None:
+        self._ctx.print_message(message)
+
+    def set_name(self, name: str) -> None:
+        self._name = name
+
+    def flush(self) -> None:
+        pass # nothing is stored locally
+
+    def get_name(self) -> str:
+        return self._name
+
+    def get_password(self) -> str:
+        return self._password
+
+    def get_filename(self) -> str:
+        return self._leader_uri # there is no local file
@@ -0,0 +1,106 @@
+from collections import deque
+from collections.abc import Callable, Iterable
+from math import erfc, log10, sqrt
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any
+from Pyro5.api import Proxy
+
+class PhiAccrualDetector:
+    """Phi accrual failure detector of a single peer. Instead of a yes/no answer
+    it returns how suspicious the current silence is, given the distribution of
+    the intervals between the heartbeats received so far: phi = 8 means that the
+    probability of the peer being alive but still silent is 10^-8."""
+    def __init__(self, expected_interval: float, window: int, min_std: float, now: float) -> None:
+        # The first heartbeats are assumed to arrive on time, so a peer that never answers is suspected too.
+        self._intervals = deque([expected_interval, expected_interval], maxlen=window)
+        self._min_std = min_std
+        self.last_heartbeat = now
+
+    def heartbeat(self, now: float) -> None:
+        self._intervals.append(now - self.last_heartbeat)
+        self.last_heartbeat = now
+
+    def phi(self, now: float) -> float:
+        mean = sum(self._intervals) / len(self._intervals)
+        variance = sum((i - mean) ** 2 for i in self._intervals) / len(self._intervals)
+        std = max(sqrt(variance), self._min_std)
+        elapsed = now - self.last_heartbeat
+        # Probability that a heartbeat arrives later than the current silence, with normally distributed intervals.
+        p_later = 0.5 * erfc((elapsed - mean) / (std * sqrt(2)))
+        return -log10(max(p_later, 1e-300))
+
+class HeartbeatMonitor:
+    """Pings the watched peers at a fixed interval from a background thread and
+    calls the callback of a peer, once, when it becomes suspected: either its phi
+    exceeds the threshold or it has been silent for longer than max_silence.
+    The failure of a peer is therefore noticed in at most max_silence + interval seconds.
+    A peer can be watched with its own probe instead of a ping, e.g. to piggyback
+    other messages on the heartbeats."""
+    def __init__(self, broadcast: Callable[[Iterable[str], Callable[[Proxy], Any], float], dict[str, Any]],
+                 interval: float, timeout: float, phi_threshold: float, max_silence: float,
+                 window: int = 100, min_std: float = 0.5) -> None:
+        self._broadcast = broadcast
+        self._interval = interval
+        self._timeout = timeout
+        self._phi_threshold = phi_threshold
+        self._max_silence = max_silence
+        self._window = window
+        self._min_std = min_std
+        self._peers = {} # URI -> (detector, callback called with the URI when suspected, probe)
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = Thread(target=self._loop, daemon=True, name="heartbeat")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def watch(self, uri: str, on_suspect: Callable[[str], None], probe: Callable[[Proxy], bool] | None = None) -> None:
+        """Starts monitoring a peer, replacing the callback if it was already watched.
+        The probe must return True when the peer answered correctly."""
+        detector = PhiAccrualDetector(self._interval, self._window, self._min_std, monotonic())
+        with self._lock:
+            self._peers[uri] = (detector, on_suspect, probe or _ping)
+
+    def unwatch(self, uri: str) -> None:
+        with self._lock:
+            self._peers.pop(uri, None)
+
+    def get_phi(self, uri: str) -> float | None:
+        """Returns the current suspicion level of a peer, None if it isn't watched."""
+        with self._lock:
+            peer = self._peers.get(uri)
+            return peer[0].phi(monotonic()) if peer else None
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self._interval):
+            self._check()
+
+    def _check(self) -> None:
+        with self._lock:
+            probes = {uri: probe for uri, (_, _, probe) in self._peers.items()}
+        # A peer that answers False (e.g. a leader that is closing the database) counts as silent.
+        results = self._broadcast(list(probes), lambda proxy: probes[str(proxy._pyroUri)](proxy), self._timeout)
+        now = monotonic()
+        suspected = []
+        with self._lock:
+            for uri, result in results.items():
+                peer = self._peers.get(uri)
+                if peer is None:
+                    continue
+                detector, on_suspect, _ = peer
+                if result is True:
+                    detector.heartbeat(now)
+                elif detector.phi(now) > self._phi_threshold or now - detector.last_heartbeat > self._max_silence:
+                    del self._peers[uri]
+                    suspected.append((uri, on_suspect))
+        for uri, on_suspect in suspected:
+            # The reaction (an eviction or an election) can be slow and must not delay the next heartbeats.
+            Thread(target=on_suspect, args=(uri,), daemon=True).start()
+
+def _ping(proxy: Proxy) -> bool:
+    return proxy.ping()
@@ -1,57 +1,150 @@
-from collections.abc import ItemsView
+import asyncio
 import socket
-from zeroconf import Zeroconf, ServiceInfo
+from threading import Lock
+from time import monotonic
+from zeroconf import Zeroconf, ServiceInfo, ServiceStateChange
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo
 
 SERVICE_TYPE = "_uri._tcp.local."
 
+class ServiceCache:
+    """Thread-safe cache of the resolved services. An entry expires after a TTL
+    unless it is resolved again in the meantime, and it's still served until the
+    service is removed or resolved with a new address."""
+    def __init__(self, ttl: float) -> None:
+        self._ttl = ttl
+        self._entries = {} # service name -> (URI, IP address, port, expiry)
+        self._lock = Lock()
+
+    def put(self, name: str, uri: str, ip_address: str, port: int) -> None:
+        with self._lock:
+            self._entries[name] = (uri, ip_address, port, monotonic() + self._ttl)
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def remove_uri(self, uri: str) -> None:
+        with self._lock:
+            for name in [name for name, entry in self._entries.items() if entry[0] == uri]:
+                del self._entries[name]
+
+    def items(self, prefix: str = "") -> tuple[list[tuple[str, tuple[str, str, int]]], list[str]]:
+        """Returns the services whose name starts with the prefix (case insensitive) and
+        the names of the expired ones among them, which must be refreshed."""
+        prefix = prefix.casefold()
+        now = monotonic()
+        services = []
+        expired = []
+        with self._lock:
+            for name, (uri, ip_address, port, expiry) in self._entries.items():
+                if name.casefold().startswith(prefix):
+                    services.append((name, (uri, ip_address, port)))
+                    if expiry <= now:
+                        expired.append(name)
+        return (services, expired)
+
 class ContinuousListener:
-    """Keeps track of discovered services in real time."""
-    def __init__(self, ip: str, port: str) -> None:
-        self._ip = socket.inet_aton(socket.gethostbyname(ip))
-        self._port = int(port)
-        self._services = {}
+    """Keeps track of discovered services in real time. The browser and the resolutions
+    run in the event loop of zeroconf, so a new service never blocks it nor the
+    reader of the services, which only reads the cache."""
+    def __init__(self, zeroconf: Zeroconf, ttl: float, resolve_timeout: float) -> None:
+        self._zeroconf = zeroconf
+        self._resolve_timeout_ms = resolve_timeout * 1000
+        self._services = ServiceCache(ttl)
         # set used to avoid adding to the services variable my own services and already used ones
         self._ignored_services = set()
+        self._ignored_lock = Lock()
+        self._browser = None
+        self._tasks = set() # running resolutions, referenced until they end
 
-    def add_service(self, zeroconf: Zeroconf, service_type: str, name: str) -> None:
-        """Adds new services to a dictionary to keep track of them"""
-        info = zeroconf.get_service_info(service_type, name)
-        if not info:
-            return
+    def start(self) -> None:
+        """Starts browsing the services from the event loop of zeroconf."""
+        asyncio.run_coroutine_threadsafe(self._async_start(), self._zeroconf.loop).result()
+
+    async def _async_start(self) -> None:
+        self._browser = AsyncServiceBrowser(self._zeroconf, SERVICE_TYPE, handlers=[self._on_service_state_change])
+
+    def stop(self) -> None:
+        if self._browser is not None and self._zeroconf.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._browser.async_cancel(), self._zeroconf.loop).result()
+            self._browser = None
+
+    def _on_service_state_change(self, zeroconf: Zeroconf, service_type: str, name: str, state_change: ServiceStateChange) -> None:
+        """Called in the event loop of zeroconf."""
+        if state_change == ServiceStateChange.Removed:
+            self._services.remove(name)
+        else:
+            self._start_resolution(service_type, name)
+
+    def _start_resolution(self, service_type: str, name: str) -> None:
+        """Must be called in the event loop of zeroconf."""
+        task = asyncio.ensure_future(self._resolve(service_type, name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _resolve(self, service_type: str, name: str) -> None:
+        info = AsyncServiceInfo(service_type, name)
+        if await info.async_request(self._zeroconf, self._resolve_timeout_ms):
+            self._store(name, info)
+
+    def _store(self, name: str, info: ServiceInfo) -> None:
         uri = info.properties.get(b'uri', b'').decode('utf-8')
-        ip_address = info.parsed_addresses()[0]
-        if uri not in self._ignored_services:
-            self._services[name] = (uri, ip_address, info.port)
+        addresses = info.parsed_addresses()
+        if not addresses:
+            return
+        # Under the same lock as add_ignored_service, so a service ignored meanwhile isn't stored back.
+        with self._ignored_lock:
+            if uri in self._ignored_services:
+                return
+            self._services.put(name, uri, addresses[0], info.port)
 
-    def remove_service(self, _zeroconf: Zeroconf, _service_type: str, name: str) -> None:
-        """Removes from the services dictionaries one that is no longer available"""
-        if name in self._services:
-            del self._services[name]
+    def add_service(self, name: str) -> None:
+        """Resolves a service again in the background, e.g. one that was ignored."""
+        self._zeroconf.loop.call_soon_threadsafe(self._start_resolution, SERVICE_TYPE, name)
 
-    def update_service(self, zeroconf, service_type, name):
-        """Mandatory method for a listener"""
-        pass
+    def remove_service(self, name: str) -> None:
+        """Removes from the services dictionaries one that is no longer available"""
+        self._services.remove(name)
 
     def add_ignored_service(self, uri: str) -> None:
-        self._ignored_services.add(uri)
+        with self._ignored_lock:
+            self._ignored_services.add(uri)
+            self._services.remove_uri(uri)
 
     def remove_ignored_service(self, uri: str) -> None:
-        self._ignored_services.remove(uri)
+        with self._ignored_lock:
+            self._ignored_services.discard(uri)
 
-    def get_services_information(self) -> ItemsView[str, tuple[str, str, int]]:
-        return self._services.items()
+    def get_services_information(self, prefix: str = "") -> list[tuple[str, tuple[str, str, int]]]:
+        """Returns the services whose name starts with the prefix. The expired ones are
+        still returned while they are renewed from the records cached by zeroconf, or
+        asked again to the network in the background."""
+        services, expired = self._services.items(prefix)
+        renewed = False
+        for name in expired:
+            info = ServiceInfo(SERVICE_TYPE, name)
+            if info.load_from_cache(self._zeroconf):
+                self._store(name, info)
+                renewed = True
+            else:
+                self.add_service(name)
+        return self._services.items(prefix)[0] if renewed else services
 
 
 class UriAdvertiser:
     """Handles service registration."""
     def __init__(self, zeroconf: Zeroconf, ip: str, port: str) -> None:
         self.zeroconf = zeroconf
-        self._ip = socket.inet_aton(socket.gethostbyname(ip))
+        self._host = ip
+        self._ip = None # resolved at the first registration, so creating the advertiser never waits for DNS
         self._port = int(port)
         self._services = {}
 
     def register_uri(self, name: str, uri: str) -> None:
         """Registers a URI with the specified name"""
+        if self._ip is None:
+            self._ip = socket.inet_aton(socket.gethostbyname(self._host))
         props = {'uri': uri.encode('utf-8')}
         service_name = f"{name}._uri._tcp.local."
         info = ServiceInfo(
@@ -1,6 +1,7 @@
 from enum import Enum, auto
 from typing import TypedDict
 from dataclasses import dataclass
+import heapq
 import threading
 import time
 from collections import deque
@@ -17,12 +18,21 @@ class ReturnCode(Enum):
     ERROR = auto()
     BANNED = auto()
 
+class ProposalStatus(Enum):
+    """Possible states of a change proposal submitted to the leader"""
+    QUEUED = auto()
+    VOTING = auto()
+    APPROVED = auto()
+    DENIED = auto()
+    FAILED = auto()
+
 class Operation(str, Enum):
     """Available operations on an exposed database"""
     ADD_ENTRY = "add_entry"
     ADD_GROUP = "add_group"
     DELETE_ENTRY = "remove_entry"
     DELETE_GROUP = "update_group"
+    BATCH = "batch"
 
 @dataclass
 class Notification():
@@ -52,52 +62,330 @@ class DeleteGroupData(TypedDict):
     """Data necessary to delete a group of an exposed database"""
     path: list[str]
 
+class BatchItem(TypedDict):
+    """Single operation of a batch"""
+    operation: Operation
+    data: "OperationData"
+
+class BatchData(TypedDict):
+    """Data necessary to apply an ordered list of operations to an exposed database at once"""
+    operations: list[BatchItem]
+
 # A more concise representation of the possible data type for the database operatiosn
-OperationData = AddEntryData | AddGroupData | DeleteEntryData | DeleteGroupData
+OperationData = AddEntryData | AddGroupData | DeleteEntryData | DeleteGroupData | BatchData
+
+class LogEntry(TypedDict):
+    """Committed operation of a shared database with its position in the log"""
+    index: int
+    operation: Operation
+    data: OperationData
+
+class EntrySummary(TypedDict):
+    """Fields of an entry shown when listing a database, the password is fetched only on demand"""
+    path: list[str] # group path followed by the title
+    title: str
+    username: str
+    url: str
+
+class EntryData(EntrySummary):
+    """Entry with its password, as read by a thin client"""
+    passwd: str
+
+class SearchResult(EntrySummary):
+    """Entry found by a search, with how well it matches the query"""
+    score: float
+
+class MemberStatus(str, Enum):
+    """States of a follower in the membership view of a shared database"""
+    ALIVE = "alive"
+    SUSPECT = "suspect"
+    DEAD = "dead"
+    LEFT = "left"
+
+class Member(TypedDict):
+    """Follower of a shared database as known by the membership view"""
+    uri: str
+    unique_id: int
+    cn: str
+    status: MemberStatus
+    version: int # epoch of the view in which the follower last changed
+
+@dataclass
+class Proposal():
+    """Change proposal waiting in the leader queue"""
+    sequence: int
+    operation: Operation
+    data: OperationData
+    uri: str
+    paths: list[tuple[str, ...]]
+
+def operation_paths(operation: Operation, data: OperationData) -> list[tuple[str, ...]]:
+    """Returns the paths of the groups and entries touched by an operation"""
+    match operation:
+        case Operation.ADD_ENTRY:
+            path = data["destination_group"] + [data["title"]]
+        case Operation.ADD_GROUP:
+            path = data["parent_group"] + [data["group_name"]]
+        case Operation.DELETE_ENTRY:
+            path = data["entry_path"]
+        case Operation.DELETE_GROUP:
+            path = data["path"]
+        case Operation.BATCH:
+            return [path for item in data["operations"] for path in operation_paths(Operation(item["operation"]), item["data"])]
+        case _:
+            return [()]
+    # Empty names are how the root group is typed, they don't change the position in the tree.
+    return [tuple(name for name in path if name)]
+
+def paths_conflict(paths: list[tuple[str, ...]], other_paths: list[tuple[str, ...]]) -> bool:
+    """Two operations conflict if one touches a path contained in a path touched by the other,
+    so their result would depend on the order in which they are applied."""
+    return any(
+        path[:len(other)] == other or other[:len(path)] == path
+        for path in paths for other in other_paths
+    )
 
 class NotificationQueue:
-    def __init__(self):
-        self._queue = deque()
-        self._lock = threading.Lock()
+    """Notifications waiting for an answer, ordered by deadline in a heap and indexed
+    by database and proposition. A background thread removes each one when its
+    deadline passes; when the queue is full the one closest to expiring is dropped."""
+    def __init__(self, max_entries: int = 256):
+        self._max_entries = max_entries
+        self._heap = [] # (deadline, insertion number, key), entries of removed notifications are skipped lazily
+        self._items = {} # (database ID, proposition ID) -> notification
+        self._counter = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    @staticmethod
+    def _key(notification: Notification) -> tuple[int, int]:
+        # Proposition IDs are assigned by each leader, the database tells them apart.
+        return (notification.db_id, notification.proposition_id)
 
     def push(self, notification: Notification) -> None:
-        """Push a new notification (top of stack)."""
-        with self._lock:
-            self._queue.appendleft(notification)
+        """Adds a notification, replacing the one of the same proposition."""
+        key = self._key(notification)
+        with self._cond:
+            if key not in self._items and len(self._items) >= self._max_entries:
+                self._pop_first()
+            self._items[key] = notification
+            self._counter += 1
+            heapq.heappush(self._heap, (notification.timestamp, self._counter, key))
+            if len(self._heap) > 2 * len(self._items) + self._max_entries:
+                self._compact()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._expire_loop, daemon=True, name="notifications")
+                self._thread.start()
+            elif self._heap[0][2] == key:
+                self._cond.notify() # the deadline to wait for has changed
+
+    def get(self, db_id: int, proposition_id: int) -> Notification | None:
+        with self._cond:
+            return self._items.get((db_id, proposition_id))
+
+    def remove(self, db_id: int, proposition_id: int) -> bool:
+        """Removes the notification of a proposition. Returns True if it was there."""
+        with self._cond:
+            return self._items.pop((db_id, proposition_id), None) is not None
+
+    def remove_expired(self) -> int:
+        """Removes the notifications whose deadline has passed and returns how many they were."""
+        with self._cond:
+            return self._remove_expired_locked(time.time())
+
+    def _remove_expired_locked(self, now: float) -> int:
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            if self._pop_first() is not None:
+                removed += 1
+        return removed
+
+    def _pop_first(self) -> Notification | None:
+        """Removes the notification with the closest deadline, skipping the stale heap entries."""
+        while self._heap:
+            deadline, _, key = heapq.heappop(self._heap)
+            notification = self._items.get(key)
+            if notification is not None and notification.timestamp == deadline:
+                del self._items[key]
+                return notification
+        return None
+
+    def _compact(self) -> None:
+        """Drops the heap entries left by removed or replaced notifications."""
+        self._heap = [item for item in self._heap if (notification := self._items.get(item[2])) is not None and notification.timestamp == item[0]]
+        heapq.heapify(self._heap)
+
+    def _expire_loop(self) -> None:
+        with self._cond:
+            while not self._closed:
+                self._remove_expired_locked(time.time())
+                timeout = self._heap[0][0] - time.time() if self._heap else None
+                self._cond.wait(timeout)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def get_all(self) -> list[Notification]:
+        """Return a snapshot of all notifications, the most recent first."""
+        with self._cond:
+            return sorted(self._items.values(), key=lambda notification: notification.timestamp, reverse=True)
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._items)
 
-    def pop(self) -> Notification | None:
-        """Pop most recent notification, or None if empty."""
+    def __iter__(self):
+        """Safe iterator: it's a snapshot copy to free the lock rapidly."""
+        return iter(self.get_all())
+
+class OperationLog:
+    """Bounded, sequence-numbered log of the operations committed on a shared database.
+    The oldest entries are compacted away when the log is full."""
+    def __init__(self, log_id: str | None, max_entries: int, last_index: int = 0):
+        self._log_id = log_id
+        self._entries = deque(maxlen=max_entries)
+        self._last_index = last_index
+        self._lock = threading.Lock()
+
+    @property
+    def log_id(self) -> str | None:
+        """Identifies the history of the database, None if this copy has missed some entries."""
+        return self._log_id
+
+    @property
+    def last_index(self) -> int:
         with self._lock:
-            if self._queue:
-                return self._queue.popleft()
-            return None
+            return self._last_index
 
-    def remove_expired(self) -> None:
-        """Remove expired notifications."""
-        now = time.time()
+    def append(self, operation: Operation, data: OperationData) -> LogEntry:
+        """Adds a newly committed operation at the end of the log."""
         with self._lock:
-            self._queue = deque(
-                n for n in self._queue if (now - n.timestamp) <= 30
-            )
+            self._last_index += 1
+            entry = LogEntry(index=self._last_index, operation=operation, data=data)
+            self._entries.append(entry)
+            return entry
 
-    def remove_at(self, index: int) -> bool:
-        """Remove notification at given index. Returns True if successful."""
+    def record(self, entry: LogEntry) -> bool:
+        """Adds an entry received from the leader. A gap in the sequence means that
+        this copy missed some operations, so the log is invalidated and the next
+        catch-up will need a full snapshot."""
         with self._lock:
-            if 0 <= index < len(self._queue):
-                del self._queue[index]
+            if entry["index"] <= self._last_index:
                 return True
-            return False
-        
-    def get_all(self) -> list[Notification]:
-        """Return a snapshot of all notifications."""
+            if entry["index"] != self._last_index + 1:
+                self._log_id = None
+                return False
+            self._last_index = entry["index"]
+            self._entries.append(entry)
+            return True
+
+    def suffix(self, after_index: int) -> list[LogEntry] | None:
+        """Returns the entries that follow the given index, None if some of them
+        were already compacted away or the index is ahead of the log."""
         with self._lock:
-            return list(self._queue)
+            if after_index > self._last_index:
+                return None
+            first_index = self._last_index - len(self._entries) + 1
+            if after_index + 1 < first_index:
+                return None
+            return list(self._entries)[after_index + 1 - first_index:]
 
     def __len__(self) -> int:
         with self._lock:
-            return len(self._queue)
+            return len(self._entries)
 
-    def __iter__(self):
-        """Safe iterator: it's a snapshot copy to free the lock rapidly."""
+
+class MembershipView:
+    """Versioned view of the followers of a shared database, kept by the leader and
+    spread to the followers by gossip. Every join, suspicion or removal increases the
+    epoch of the view and stamps the follower with it, so a copy that is up to date
+    until some epoch only needs the followers changed after it. Removed followers are
+    kept as tombstones for a while, so that their removal can be gossiped as well."""
+    def __init__(self, epoch: int = 0, max_tombstones: int = 256):
+        self._members = {} # URI -> member
+        self._epoch = epoch
+        self._floor = epoch # changes up to this epoch may have been compacted away
+        self._max_tombstones = max_tombstones
+        self._lock = threading.Lock()
+
+    @property
+    def epoch(self) -> int:
+        with self._lock:
+            return self._epoch
+
+    def join(self, uri: str, unique_id: int, cn: str) -> None:
         with self._lock:
-            return iter(list(self._queue))
+            self._set_locked(uri, unique_id, cn, MemberStatus.ALIVE)
+
+    def suspect(self, uri: str) -> bool:
+        """Marks an alive follower as suspected, returns False if it wasn't alive."""
+        return self._transition(uri, (MemberStatus.ALIVE,), MemberStatus.SUSPECT)
+
+    def refute(self, uri: str) -> bool:
+        """Marks a suspected follower that answered again as alive, returns False if it wasn't suspected."""
+        return self._transition(uri, (MemberStatus.SUSPECT,), MemberStatus.ALIVE)
+
+    def remove(self, uri: str, status: MemberStatus = MemberStatus.DEAD) -> bool:
+        """Turns a follower into a tombstone, returns False if it was already removed."""
+        return self._transition(uri, (MemberStatus.ALIVE, MemberStatus.SUSPECT), status)
+
+    def status(self, uri: str) -> MemberStatus | None:
+        with self._lock:
+            member = self._members.get(uri)
+            return member["status"] if member else None
+
+    def members(self) -> dict[str, Member]:
+        """Returns the followers that are alive or suspected, by URI."""
+        with self._lock:
+            return {uri: member.copy() for uri, member in self._members.items()
+                    if member["status"] in (MemberStatus.ALIVE, MemberStatus.SUSPECT)}
+
+    def changes_since(self, epoch: int) -> tuple[int, list[Member], bool]:
+        """Returns the current epoch, the followers changed after the given epoch and
+        whether the receiver must replace its view with them: when some changes were
+        compacted away, or the epoch comes from the view of another leader."""
+        with self._lock:
+            if epoch == self._epoch:
+                return (self._epoch, [], False)
+            if epoch < self._floor or epoch > self._epoch:
+                return (self._epoch, [member.copy() for member in self._members.values()
+                                      if member["status"] in (MemberStatus.ALIVE, MemberStatus.SUSPECT)], True)
+            return (self._epoch, [member.copy() for member in self._members.values() if member["version"] > epoch], False)
+
+    def apply(self, epoch: int, members: list[Member], reset: bool) -> int:
+        """Merges the changes received from the leader and returns the epoch reached.
+        A follower is replaced only by a newer version of itself."""
+        with self._lock:
+            if reset:
+                self._members = {}
+                self._floor = epoch
+            for member in members:
+                current = self._members.get(member["uri"])
+                if current is None or member["version"] > current["version"]:
+                    self._members[member["uri"]] = member
+            self._epoch = epoch if reset else max(self._epoch, epoch)
+            self._compact_locked()
+            return self._epoch
+
+    def _transition(self, uri: str, allowed: tuple[MemberStatus, ...], status: MemberStatus) -> bool:
+        with self._lock:
+            member = self._members.get(uri)
+            if member is None or member["status"] not in allowed:
+                return False
+            self._set_locked(uri, member["unique_id"], member["cn"], status)
+            return True
+
+    def _set_locked(self, uri: str, unique_id: int, cn: str, status: MemberStatus) -> None:
+        self._epoch += 1
+        self._members[uri] = Member(uri=uri, unique_id=unique_id, cn=cn, status=status, version=self._epoch)
+        self._compact_locked()
+
+    def _compact_locked(self) -> None:
+        tombstones = sorted((member["version"], uri) for uri, member in self._members.items()
+                            if member["status"] in (MemberStatus.DEAD, MemberStatus.LEFT))
+        for version, uri in tombstones[:max(0, len(tombstones) - self._max_tombstones)]:
+            del self._members[uri]
+            self._floor = max(self._floor, version)
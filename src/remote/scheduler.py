@@ -0,0 +1,117 @@
+import heapq
+from collections import deque
+from collections.abc import Callable, Hashable
+from threading import Condition, Lock, Thread
+from time import time
+
+class TimerHandle:
+    """Task scheduled at a given time, it can be cancelled until it starts."""
+    def __init__(self, when: float, queue: Hashable, task: Callable[[], None]) -> None:
+        self.when = when
+        self.queue = queue
+        self.task = task
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+class FairScheduler:
+    """Runs the work of every exposed database of the context on a fixed set of workers.
+    Each database has its own FIFO queue of tasks and the workers take them round robin,
+    so a database with a long backlog can't starve the others. A task must not wait
+    for an event: it schedules a new task when the event happens, or at a deadline."""
+    def __init__(self, workers: int) -> None:
+        lock = Lock()
+        self._cond = Condition(lock) # signaled when a queue becomes ready
+        self._timers_cond = Condition(lock) # signaled when the closest timer changes
+        self._queues = {} # queue key -> tasks waiting for a worker
+        self._ready = deque() # keys of the non empty queues, in the order they are served
+        self._backlogs = {} # queue key -> work held back by its owner, reported with the depths
+        self._timers = [] # (time, insertion number, handle)
+        self._timers_counter = 0
+        self._closed = False
+        self._threads = [Thread(target=self._work_loop, daemon=True, name=f"scheduler-{i}") for i in range(workers)]
+        self._threads.append(Thread(target=self._timer_loop, daemon=True, name="scheduler-timers"))
+        for thread in self._threads:
+            thread.start()
+
+    def add_queue(self, queue: Hashable, backlog: Callable[[], int] | None = None) -> None:
+        """Declares a queue. The backlog tells how much work its owner keeps aside, e.g. the
+        proposals that can't start yet."""
+        with self._cond:
+            self._queues.setdefault(queue, deque())
+            if backlog is not None:
+                self._backlogs[queue] = backlog
+
+    def remove_queue(self, queue: Hashable) -> None:
+        """Forgets a queue, its waiting tasks are dropped."""
+        with self._cond:
+            self._queues.pop(queue, None)
+            self._backlogs.pop(queue, None)
+            if queue in self._ready:
+                self._ready.remove(queue)
+
+    def submit(self, queue: Hashable, task: Callable[[], None]) -> None:
+        """Queues a task, dropped if the queue has been removed."""
+        with self._cond:
+            tasks = self._queues.get(queue)
+            if tasks is None:
+                return
+            if not tasks:
+                self._ready.append(queue)
+            tasks.append(task)
+            self._cond.notify()
+
+    def call_at(self, when: float, queue: Hashable, task: Callable[[], None]) -> TimerHandle:
+        """Submits the task to the queue at the given time."""
+        handle = TimerHandle(when, queue, task)
+        with self._cond:
+            self._timers_counter += 1
+            heapq.heappush(self._timers, (when, self._timers_counter, handle))
+            if self._timers[0][2] is handle:
+                self._timers_cond.notify()
+        return handle
+
+    def depths(self) -> dict[Hashable, tuple[int, int]]:
+        """Returns, for every queue, the tasks waiting for a worker and its backlog."""
+        with self._cond:
+            queues = {queue: len(tasks) for queue, tasks in self._queues.items()}
+            backlogs = dict(self._backlogs)
+        return {queue: (waiting, backlogs[queue]() if queue in backlogs else 0) for queue, waiting in queues.items()}
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            self._timers_cond.notify()
+
+    def _work_loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready or self._closed)
+                if self._closed:
+                    return
+                queue = self._ready.popleft()
+                tasks = self._queues[queue]
+                task = tasks.popleft()
+                if tasks:
+                    self._ready.append(queue) # its next task waits for the other databases
+            try:
+                task()
+            except Exception as e:
+                print(e)
+
+    def _timer_loop(self) -> None:
+        with self._timers_cond:
+            while not self._closed:
+                now = time()
+                while self._timers and self._timers[0][0] <= now:
+                    _, _, handle = heapq.heappop(self._timers)
+                    if not handle.cancelled and handle.queue in self._queues:
+                        tasks = self._queues[handle.queue]
+                        if not tasks:
+                            self._ready.append(handle.queue)
+                        tasks.append(handle.task)
+                        self._cond.notify()
+                timeout = self._timers[0][0] - now if self._timers else None
+                self._timers_cond.wait(timeout)
@@ -0,0 +1,107 @@
+import os
+import json
+import zlib
+from hashlib import file_digest, sha256
+from Pyro5.api import Proxy
+from serpent import tobytes
+from context.metrics import metrics
+from database.save_pool import write_atomically
+
+def snapshot_digest(path: str) -> str:
+    """Returns the SHA-256 of a file, reading it in small blocks"""
+    with open(path, "rb") as f:
+        return file_digest(f, sha256).hexdigest()
+
+def log_position_path(path: str) -> str:
+    return f"{path}.position"
+
+def save_log_position(path: str, log_id: str, last_index: int) -> None:
+    """Records next to a replica the position of the leader log its file reached,
+    together with the digest of the file: once the file changes the position no longer holds."""
+    position = {"log_id": log_id, "last_index": last_index, "digest": snapshot_digest(path)}
+    write_atomically(log_position_path(path), json.dumps(position).encode())
+
+def load_log_position(path: str) -> tuple[str, int] | None:
+    """Returns the log position saved with a replica, None if there is none or the
+    file was changed after it was saved."""
+    try:
+        with open(log_position_path(path)) as f:
+            position = json.load(f)
+        if snapshot_digest(path) != position["digest"]:
+            return None
+        return (position["log_id"], position["last_index"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def send_snapshot(proxy: Proxy, path: str, chunk_size: int, compression_level: int) -> bool:
+    """Streams a database file to a follower in chunks of at most chunk_size bytes.
+    Every chunk is compressed on its own, so the transfer can resume from any
+    offset of the file: if the follower already holds part of the same snapshot
+    it only receives the rest. A compression level of 0 disables the compression."""
+    digest = snapshot_digest(path)
+    size = os.path.getsize(path)
+    offset = proxy.begin_snapshot(digest, size)
+    with open(path, "rb") as f:
+        while 0 <= offset < size:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return False # the file shrank since its size was taken
+            compressed = False
+            if compression_level > 0:
+                compressed_chunk = zlib.compress(chunk, compression_level)
+                # An encrypted database barely compresses, so the chunk is sent as is when it doesn't get smaller.
+                if len(compressed_chunk) < len(chunk):
+                    chunk, compressed = compressed_chunk, True
+            offset = proxy.receive_snapshot_chunk(digest, offset, chunk, compressed)
+            metrics.inc("snapshot_sent_bytes_total", {"compressed": str(compressed).lower()}, len(chunk), "Bytes of database snapshots sent to the followers")
+    if offset != size:
+        return False
+    return proxy.commit_snapshot(digest)
+
+class SnapshotReceiver:
+    """Writes the chunks of a snapshot to a temporary file next to the database.
+    The database is replaced only once the whole file is received and its
+    SHA-256 matches the one announced by the leader."""
+    def __init__(self, path: str, digest: str, size: int) -> None:
+        self._path = path
+        self._part_path = f"{path}.{digest[:16]}.part"
+        self.digest = digest
+        self._size = size
+        self.offset = 0
+        # Resume a previous transfer of the same snapshot, which is identified by its digest.
+        if os.path.exists(self._part_path) and os.path.getsize(self._part_path) <= size:
+            self.offset = os.path.getsize(self._part_path)
+        with open(self._part_path, "ab") as f:
+            f.truncate(self.offset)
+
+    def write(self, offset: int, data: object, compressed: bool) -> int:
+        """Appends a chunk and returns the offset of the next one. A chunk at an
+        unexpected offset is ignored, the returned offset tells the leader where to resume."""
+        if offset != self.offset:
+            return self.offset
+        chunk = tobytes(data)
+        if compressed:
+            chunk = zlib.decompress(chunk)
+        if self.offset + len(chunk) > self._size:
+            return -1
+        with open(self._part_path, "ab") as f:
+            f.write(chunk)
+        self.offset += len(chunk)
+        return self.offset
+
+    def commit(self) -> bool:
+        """Checks the received file and atomically replaces the database with it."""
+        if self.offset != self._size or snapshot_digest(self._part_path) != self.digest:
+            self.discard()
+            return False
+        with open(self._part_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(self._part_path, self._path)
+        return True
+
+    def discard(self) -> None:
+        try:
+            os.remove(self._part_path)
+        except FileNotFoundError:
+            pass
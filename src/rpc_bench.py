@@ -0,0 +1,49 @@
+import os
+import argparse
+from dataclasses import asdict
+from pathlib import Path
+from context.context import ContextConfig, ServerPolicy, ServerType
+from benchmark.rpc_load import run_rpc_load
+from benchmark.report import write_results
+
+def parse_policy(spec: str, min_workers: int, backlog: int) -> ServerPolicy:
+    """Parses a server model written as type[:max_workers], e.g. thread:32 or multiplex."""
+    server_type, _, max_workers = spec.partition(":")
+    max_workers = int(max_workers) if max_workers else ServerPolicy.max_workers
+    return ServerPolicy(ServerType(server_type), max_workers, min(min_workers, max_workers), backlog)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the RPC throughput and tail latency of a leader under every server model.")
+    parser.add_argument("--servers", nargs="+", default=["thread:80", "thread:16", "multiplex"],
+                        help="server models to compare, as type[:max_workers]")
+    parser.add_argument("--min-workers", type=int, default=ServerPolicy.min_workers)
+    parser.add_argument("--backlog", type=int, default=ServerPolicy.backlog)
+    parser.add_argument("--clients", type=int, default=4, help="peers reading from the leader")
+    parser.add_argument("--threads", type=int, default=8, help="connections opened by every client")
+    parser.add_argument("--calls", type=int, default=200, help="reads made on every connection")
+    parser.add_argument("--entries", type=int, default=50, help="entries of the read database")
+    parser.add_argument("--output", default="rpc_bench_results.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    # The certificates paths used by the context are relative to the root of the project.
+    os.chdir(Path(__file__).resolve().parent.parent)
+    config = ContextConfig()
+    policies = [parse_policy(spec, args.min_workers, args.backlog) for spec in args.servers]
+    runs = run_rpc_load(policies, args.clients, args.threads, args.calls, args.entries, config)
+    write_results(args.output, {
+        "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+        "config": asdict(config),
+        "runs": runs,
+    })
+    for run in runs:
+        policy = run["policy"]
+        label = f"{policy["server_type"]} ({policy["max_workers"]} workers)" if policy["server_type"] == ServerType.THREAD else policy["server_type"]
+        latency = run["latency"]
+        if latency is None:
+            print(f"{label}: every read failed")
+            continue
+        print(f"{label}: p50 {latency["p50"] * 1000:.1f} ms, p99 {latency["p99"] * 1000:.1f} ms, "
+              f"{run["throughput"]:.1f} reads/s, {run["errors"]} failed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import sys
+import json
+import argparse
+from context.tracing import merge_traces
+
+def main():
+    parser = argparse.ArgumentParser(description="Merges the trace files of several peers into a timeline per proposal or join.")
+    parser.add_argument("files", nargs="+", help="trace files of the peers, their rotated backups are read too")
+    parser.add_argument("--trace", help="show only the trace with this ID")
+    parser.add_argument("--json", action="store_true", help="print the merged traces as JSON")
+    args = parser.parse_args()
+
+    traces = merge_traces(args.files)
+    if args.trace:
+        traces = {trace_id: spans for trace_id, spans in traces.items() if trace_id == args.trace}
+    if args.json:
+        json.dump(traces, sys.stdout, indent=2)
+        return
+
+    hidden = {"trace_id", "name", "peer", "start", "duration", "thread"}
+    for trace_id, spans in traces.items():
+        origin = spans[0]["start"]
+        end = max(span["start"] + span["duration"] for span in spans)
+        print(f"Trace {trace_id} ({len(spans)} spans, {(end - origin) * 1000:.1f} ms)")
+        for span in spans:
+            attributes = " ".join(f"{key}={value}" for key, value in span.items() if key not in hidden)
+            print(f"  +{(span["start"] - origin) * 1000:9.1f} ms {span["duration"] * 1000:9.1f} ms  {span["peer"]:<30} {span["name"]:<24} {attributes}")
+        print()
+
+if __name__ == "__main__":
+    main()